@@ -0,0 +1,48 @@
+"""A small HTTP server for operating a running chat server.
+
+It listens on a local admin port (`ADMIN_HOST`, `ADMIN_PORT`), separate from
+the chat protocol, and serves each path from a route: a callable that takes the
+query parameters and returns the content type and body of the response.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import threading
+from config import *
+
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET requests from the server's routes"""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            self.send_error(404)
+            return
+        try:
+            content_type, body = route({name: values[-1] for name, values in parse_qs(url.query).items()})
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; don't print a line for each one
+        pass
+
+
+def start_admin_server(routes, host=ADMIN_HOST, port=ADMIN_PORT):
+    """Serve `routes` (path -> route) from a background thread and return the HTTP server"""
+
+    server = ThreadingHTTPServer((host, port), AdminRequestHandler)
+    server.daemon_threads = True
+    server.routes = routes
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Admin server started on host {host} and port {server.server_address[1]}.")
+    return server
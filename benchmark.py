@@ -0,0 +1,308 @@
+"""Micro-benchmarks for the chat server's internals.
+
+Each subcommand exercises one subsystem in-process and prints its results:
+
+    python benchmark.py wal [--messages N] [--threads T]
+    python benchmark.py restart [--messages N] [--users U] [--tail T]
+    python benchmark.py users [--users U] [--repeat R]
+    python benchmark.py history [--messages N] [--users U]
+    python benchmark.py groups [--sizes S ...] [--messages N]
+"""
+from collections import defaultdict
+import argparse
+import fnmatch
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from threading import Lock
+from config import *
+import server
+from snapshot import snapshot_path
+from groups import Groups
+from history import MessageHistory, UserMessage
+from offline_queue import OfflineQueues
+from user_directory import UserDirectory
+from wal import FSYNC_POLICIES, WriteAheadLog, ACCOUNT_CREATED, MESSAGE_SENT
+
+
+class CountingSocket:
+    """Stands in for a client socket and counts the frames the server sends it"""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.count = 0
+        self.lock = Lock()
+        self.done = threading.Event()
+
+    def sendall(self, data):
+        with self.lock:
+            self.count += 1
+            if self.count >= self.expected:
+                self.done.set()
+
+
+def reset_server_state():
+    """Give the server empty state, so benchmarks don't see each other's data"""
+
+    server.accounts = UserDirectory()
+    server.messages = MessageHistory()
+    server.unsent_message_queue = OfflineQueues()
+    server.connected_clients = UserDirectory(set)
+    server.groups = Groups()
+
+
+def bench_wal(arguments):
+    """Report SEND_MESSAGE throughput, counted to the sender's acknowledgement, under each fsync policy"""
+
+    per_thread = arguments.messages // arguments.threads
+    print(f"{per_thread * arguments.threads} sends from {arguments.threads} threads to offline recipients:")
+
+    for policy in FSYNC_POLICIES:
+        reset_server_state()
+        with tempfile.TemporaryDirectory() as directory:
+            server.open_log(directory, policy)
+            senders = []
+            for i in range(arguments.threads):
+                sender = CountingSocket(per_thread)
+                server.client_locks[sender] = Lock()
+                senders.append(sender)
+
+            def send(i):
+                for n in range(per_thread):
+                    server.deliver_new_message(senders[i], f'sender{i}', f'recipient{i}', str(n), 'now')
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target=send, args=(i,)) for i in range(arguments.threads)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for sender in senders:
+                sender.done.wait()
+            elapsed = time.perf_counter() - start
+
+            server.wal.close()
+            server.wal = None
+            for sender in senders:
+                del server.client_locks[sender]
+
+        print(f"  {policy:>8}: {per_thread * arguments.threads / elapsed:>10,.0f} sends/sec")
+
+
+def bench_restart(arguments):
+    """Compare startup time replaying the whole log against loading a snapshot plus a short log tail"""
+
+    def log_messages(log, count, offset=0):
+        for n in range(offset, offset + count):
+            sender, recipient = f'user{n % arguments.users}', f'user{(n * 7 + 1) % arguments.users}'
+            log.append(MESSAGE_SENT, sender, recipient, f'message number {n}', '2023-03-01 12:00', '1' if n % 10 == 0 else '0')
+
+    def timed_recovery(directory):
+        reset_server_state()
+        start = time.perf_counter()
+        records = server.recover_state(directory)
+        elapsed = time.perf_counter() - start
+        return elapsed, records
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Writing {arguments.messages:,} messages between {arguments.users:,} users to the log...")
+        log = WriteAheadLog(directory, 'os')
+        for i in range(arguments.users):
+            log.append(ACCOUNT_CREATED, f'user{i}', 'hash')
+        log_messages(log, arguments.messages)
+        elapsed, records = timed_recovery(directory)
+        print(f"  full log replay: {elapsed:6.2f} s ({records:,} records)")
+
+        segment = log.rotate()
+        reset_server_state()
+        start = time.perf_counter()
+        server.compact_log(directory, segment)
+        print(f"  snapshot written in {time.perf_counter() - start:.2f} s "
+              f"({os.path.getsize(snapshot_path(directory, segment)) / 1e6:.0f} MB)")
+
+        log_messages(log, arguments.tail, arguments.messages)
+        log.close()
+        elapsed, records = timed_recovery(directory)
+        print(f"  snapshot + tail: {elapsed:6.2f} s ({records:,} tail records)")
+    reset_server_state()
+
+
+def bench_users(arguments):
+    """Compare paged VIEW_USERS lookups in the indexed directory against a scan of every online user"""
+
+    def scan(query):
+        # How `list_users` answered queries before the directory was indexed
+        pattern = re.compile(fnmatch.translate(query))
+        return list(filter(pattern.match, users.keys()))
+
+    def first_page(query):
+        # The server's `user_pages`, as a VIEW_USERS request with a limit and no cursor runs it
+        return next(server.user_pages('', query, '', VIEW_USERS_PAGE_SIZE))[1:]
+
+    def every_page(query):
+        # One request per page, each resuming from the cursor the last one returned
+        names, cursor = [], ''
+        while True:
+            page = next(server.user_pages('', query, cursor, VIEW_USERS_PAGE_SIZE))
+            names += page[1:]
+            cursor = page[0]
+            if not cursor:
+                return names
+
+    start = time.perf_counter()
+    users = UserDirectory(set)
+    for i in random.Random(0).sample(range(arguments.users), arguments.users):
+        users[f'user{i}'].add(i)
+    print(f"Indexed {arguments.users:,} online users in {time.perf_counter() - start:.2f} s. "
+          f"Time per query, in pages of {VIEW_USERS_PAGE_SIZE:,}:")
+
+    saved, server.connected_clients = server.connected_clients, users
+    try:
+        for query in ('user12345', 'user123*', 'user1*', 'user12?4*', 'user?2345', '*99', '*'):
+            timings = []
+            for lookup in (scan, first_page, every_page):
+                start = time.perf_counter()
+                for _ in range(arguments.repeat):
+                    result = lookup(query)
+                timings.append((time.perf_counter() - start) / arguments.repeat)
+            print(f"  {query:>10}: {len(result):>7,} matches, scan {timings[0] * 1e6:>9,.1f} us, "
+                  f"first page {timings[1] * 1e6:>9,.1f} us, every page {timings[2] * 1e6:>9,.1f} us")
+    finally:
+        server.connected_clients = saved
+
+    accounts = UserDirectory(None, {f'user{i}': 'hash' for i in range(arguments.users)})
+    start = time.perf_counter()
+    for i in range(arguments.repeat * 100):
+        f'user{i}' in accounts
+    print(f"  CHECK_ACCOUNT: {(time.perf_counter() - start) / (arguments.repeat * 100) * 1e6:.2f} us")
+
+
+class DictUserMessage:
+    """The original `UserMessage`: one object with a `__dict__` per message"""
+
+    def __init__(self, sender, recipient, message, time):
+        self.sender = sender
+        self.recipient = recipient
+        self.message = message
+        self.time = time
+
+
+def bench_history(arguments):
+    """Report the memory each stored message takes, in the original list of objects and in the columnar history"""
+
+    def sent_messages():
+        # Every field is a fresh string, as it would be when decoded from a frame
+        for n in range(arguments.messages):
+            yield (f'user{n % arguments.users}', f'user{(n * 7 + 1) % arguments.users}',
+                   f'message number {n}, with a little more text', f'2023-03-{1 + n % 28:02d} 12:{n % 60:02d}')
+
+    def measure(store):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        history = store()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return history, used
+
+    def original():
+        history = defaultdict(lambda: defaultdict(list))
+        for sender, recipient, message, time in sent_messages():
+            history[sender][recipient].append(DictUserMessage(sender, recipient, message, time))
+        return history
+
+    def columnar():
+        history = MessageHistory()
+        for sender, recipient, message, time in sent_messages():
+            history[sender][recipient].append(UserMessage(sender, recipient, message, time))
+        return history
+
+    print(f"{arguments.messages:,} messages between {arguments.users:,} users:")
+    for name, store in (('objects', original), ('columnar', columnar)):
+        start = time.perf_counter()
+        history, used = measure(store)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:>8}: {used / arguments.messages:6.1f} bytes/message, stored in {elapsed:.2f} s")
+        del history
+
+
+class NullSocket:
+    """Stands in for a client socket and discards what the server sends it"""
+
+    def sendall(self, data):
+        pass
+
+
+def bench_groups(arguments):
+    """Report the cost per recipient of a group send as the group grows, against sending each member the message alone"""
+
+    print(f"{arguments.messages} messages to groups of each size, microseconds per recipient:")
+    print(f"  {'members':>8} {'group, online':>14} {'one by one, online':>19} {'group, offline':>15} {'one by one, offline':>20}")
+    for size in arguments.sizes:
+        row = []
+        for online in (True, False):
+            reset_server_state()
+            sender = NullSocket()
+            server.client_locks[sender] = Lock()
+            members = [f'member{i}' for i in range(size)]
+            server.groups.create('group', 'sender')
+            for member in members:
+                server.groups.join('group', member, limit=size + 1)
+                if online:
+                    device = NullSocket()
+                    server.client_locks[device] = Lock()
+                    server.connected_clients[member].add(device)
+
+            start = time.perf_counter()
+            for n in range(arguments.messages):
+                server.send_group_message(sender, 'sender', 'group', f'message number {n}', '2023-03-01 12:00')
+            grouped = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for n in range(arguments.messages):
+                for member in members:
+                    server.deliver_new_message(sender, 'sender', member, f'message number {n}', '2023-03-01 12:00')
+            one_by_one = time.perf_counter() - start
+
+            recipients = arguments.messages * size
+            row += [grouped / recipients * 1e6, one_by_one / recipients * 1e6]
+            server.client_locks.clear()
+        print(f"  {size:>8,} {row[0]:>14.2f} {row[1]:>19.2f} {row[2]:>15.2f} {row[3]:>20.2f}")
+    reset_server_state()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks against the chat server.")
+    subcommands = parser.add_subparsers(dest='benchmark', required=True)
+
+    wal_parser = subcommands.add_parser('wal', help="message throughput under each write-ahead log fsync policy")
+    wal_parser.add_argument('--messages', type=int, default=20000, help="total messages to send")
+    wal_parser.add_argument('--threads', type=int, default=16, help="concurrent sending threads")
+    wal_parser.set_defaults(run=bench_wal)
+
+    restart_parser = subcommands.add_parser('restart', help="server restart time with and without a snapshot")
+    restart_parser.add_argument('--messages', type=int, default=1000000, help="stored messages")
+    restart_parser.add_argument('--users', type=int, default=1000, help="accounts the messages are spread over")
+    restart_parser.add_argument('--tail', type=int, default=10000, help="log records written after the snapshot")
+    restart_parser.set_defaults(run=bench_restart)
+
+    users_parser = subcommands.add_parser('users', help="VIEW_USERS wildcard queries against a large directory")
+    users_parser.add_argument('--users', type=int, default=200000, help="online users")
+    users_parser.add_argument('--repeat', type=int, default=20, help="times each query is run")
+    users_parser.set_defaults(run=bench_users)
+
+    history_parser = subcommands.add_parser('history', help="memory per stored message")
+    history_parser.add_argument('--messages', type=int, default=500000, help="messages to store")
+    history_parser.add_argument('--users', type=int, default=1000, help="accounts the messages are spread over")
+    history_parser.set_defaults(run=bench_history)
+
+    groups_parser = subcommands.add_parser('groups', help="cost per recipient of group sends as groups grow")
+    groups_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="group sizes to measure")
+    groups_parser.add_argument('--messages', type=int, default=200, help="messages sent to each group")
+    groups_parser.set_defaults(run=bench_groups)
+
+    arguments = parser.parse_args()
+    arguments.run(arguments)
@@ -1,4 +1,5 @@
 import hashlib
+import queue
 import socket
 import threading
 import inquirer
@@ -6,9 +7,17 @@ from datetime import datetime
 from ipaddress import ip_address
 from textwrap import dedent
 from config import *
+from protocol import FrameReader, ProtocolError, ResponseDispatcher, get_codec
 
-# Queue for message reception thread to load non-message display server messages to
-server_message_queue = []
+# Codec used to encode frames sent to the server
+codec = get_codec(WIRE_FORMAT)
+
+# Queue for message reception thread to load non-message display server messages to.
+# `None` is queued once the connection is gone, to wake up anyone still waiting.
+server_message_queue = queue.Queue()
+
+# Matches responses tagged with a request id to the request waiting on them
+dispatcher = ResponseDispatcher()
 
 def validate_input(input):
     """Validates that an input string is not over `MAX_MESSAGE_LENGTH` and
@@ -30,8 +39,7 @@ def is_registered_user(client, username):
 
     if username == RETURN_KEYWORD:
         return True
-    send_message(client, CHECK_ACCOUNT_COMMAND, username)
-    message = process_response(client, CHECK_ACCOUNT_COMMAND)
+    message = request(client, CHECK_ACCOUNT_COMMAND, username).result(RESPONSE_TIMEOUT)
     if message[0] == 'False':
         raise inquirer.errors.ValidationError("", reason=f"'{username}' is not a registered account.")
     return True
@@ -46,49 +54,71 @@ def hash_password(password):
 def receive_server_messages(client):
     """Continually receive messages from server, displaying messages if they are messages
        otherwise queuing up the message"""
+    reader = FrameReader(client, codec)
     while True:
-        # Receive message from server
-        message = client.recv(BUFSIZE).decode()
-        message = message.rstrip()
-
-
-        # Remove the extra '|' at the end of the message
-        message = message[:-1]
+        # Receive the next whole frame from server
+        try:
+            message = reader.read()
+        except (OSError, ProtocolError):
+            message = None
 
         # If message is None, we know that we've disconnected and we can exit
         if not message:
             print("You have disconnected. Goodbye!")
+            dispatcher.fail_all(ConnectionError("Disconnected from server."))
+            server_message_queue.put(None)
             client.close()
             exit(0)
 
-        # Else, deserialize message
-        command, *args = message.split("|")
+        # If the message answers a tagged request, hand it to whoever is waiting on it
+        if dispatcher.resolve(message):
+            continue
+
+        command, args = message.command, message.args
 
         # If `QUIT_COMMAND`, quit client
-        if int(command) == QUIT_COMMAND:
+        if command == QUIT_COMMAND:
             quit(client)
 
         # Else if `RECEIVE_MESSAGE_COMMAND`, display message
-        elif int(command) == RECEIVE_MESSAGE_COMMAND:
+        elif command == RECEIVE_MESSAGE_COMMAND:
             sender, recipient, message, time = args
             display_message(sender, recipient, message, time)
 
+        # Else if `RECEIVE_MESSAGES_COMMAND`, display each queued message in the order it was sent
+        elif command == RECEIVE_MESSAGES_COMMAND:
+            for i in range(0, len(args), 4):
+                display_message(*args[i:i + 4])
+
+        # Else if `PRESENCE_COMMAND`, display who came online or went offline
+        elif command == PRESENCE_COMMAND:
+            display_presence(args)
+
         # Else queue the operation up
         else:
-            server_message_queue.append(message)
+            server_message_queue.put(message)
+
 
+def process_response(client, desired_command, timeout=RESPONSE_TIMEOUT):
+    """Process the message from the server, hope to get the desired command, and return the arguments if successful.
 
-def process_response(client, desired_command):
-    """Process the message from the server, hope to get the desired command, and return the arguments if successful"""
+    Blocks (without spinning) for up to `timeout` seconds, raising TimeoutError if the
+    server doesn't answer in time and ConnectionError if the connection is gone.
+    """
+
+    try:
+        message = server_message_queue.get(timeout=timeout)
+    except queue.Empty:
+        raise TimeoutError(f"The server did not respond within {timeout} seconds.")
 
-    # Wait until the server message queue is not empty
-    while not server_message_queue:
-        continue
+    if message is None:
+        # Leave the marker in place for any other waiter
+        server_message_queue.put(None)
+        raise ConnectionError("Disconnected from server.")
 
-    message = server_message_queue.pop(0)
-    command, *args = message.split("|")
+    command, args = message.command, message.args
 
-    if int(command) != desired_command:
+    if command != desired_command:
         print("An error occurred. Please try again later.")
         quit(client)
 
@@ -110,19 +140,58 @@ def display_message(sender, recipient, message, time):
     '''))
 
 
+def display_presence(changes):
+    """Display a batch of presence changes, each a username prefixed with '+' (online) or '-' (offline)"""
+
+    online = [change[1:] for change in changes if change.startswith('+')]
+    offline = [change[1:] for change in changes if change.startswith('-')]
+    if online:
+        print(f"Online: {', '.join(online)}")
+    if offline:
+        print(f"Offline: {', '.join(offline)}")
+
+
 def send_message(client, command, *args):
     """Send a message to the server"""
 
-    message = f"{command}|" + "|".join(args)
-    client.send(message.encode())
+    client.sendall(codec.encode(command, *args))
+
+
+def request(client, command, *args):
+    """Send a message tagged with a fresh request id and return a Future for the arguments of its response.
+
+    Any number of requests can be in flight at once; each Future completes when the
+    reception thread sees the response carrying its id, or fails if the connection
+    drops. Wait on it with `future.result(RESPONSE_TIMEOUT)`.
+    """
+
+    request_id, future = dispatcher.register(command)
+    client.sendall(codec.encode(command, *args, request_id=request_id))
+    return future
+
+
+def view_users(client, query):
+    """Yield the usernames matching `query`, as the server streams them in VIEW_USERS pages"""
+
+    request_id, responses = dispatcher.register_stream(VIEW_USERS_COMMAND, lambda args: not args[0])
+    client.sendall(codec.encode(VIEW_USERS_COMMAND, query, '0', '', request_id=request_id))
+    while True:
+        try:
+            page = responses.get(timeout=RESPONSE_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(f"The server did not respond within {RESPONSE_TIMEOUT} seconds.")
+        if isinstance(page, Exception):
+            raise page
+        yield from page[1:]
+        if not page[0]:
+            return
 
 
 def delete_account(client, username):
     """Procedure to delete account"""
 
     # Check if user is logged in on multiple devices
-    send_message(client, MULTIPLE_LOGIN_COMMAND, username)
-    message = process_response(client, MULTIPLE_LOGIN_COMMAND)
+    message = request(client, MULTIPLE_LOGIN_COMMAND, username).result(RESPONSE_TIMEOUT)
 
     # If user is logged in on multiple devices, prompt them to log out of all other devices
     if message[0] == 'True':
@@ -136,8 +205,7 @@ def delete_account(client, username):
             return False
 
         # Log out all other clients if user confirms
-        send_message(client, LOGOUT_COMMAND)
-        message = process_response(client, LOGOUT_COMMAND)
+        message = request(client, LOGOUT_COMMAND).result(RESPONSE_TIMEOUT)
 
     # Prompt user to confirm deletion with password
     question = [inquirer.Password('password',
@@ -146,8 +214,7 @@ def delete_account(client, username):
     password = inquirer.prompt(question)['password']
 
     # Send hashed password to server for authentication
-    send_message(client, DELETE_ACCOUNT_COMMAND, hash_password(password))
-    message = process_response(client, DELETE_ACCOUNT_COMMAND)
+    message = request(client, DELETE_ACCOUNT_COMMAND, hash_password(password)).result(RESPONSE_TIMEOUT)
 
     # If password is incorrect, cancel account deletion and inform user
     if message[0] == 'error':
@@ -168,10 +235,10 @@ def quit(client):
 def handle_client(client):
     """ Send and receive messages to and from the server and print them to the console. """
 
-    # Authenticate the user with the server.
-    user = login(client)
-
     try:
+        # Authenticate the user with the server.
+        user = login(client)
+
         # If the user could not be authenticated, exit the program.
         if user is None:
             send_message(client, QUIT_COMMAND)
@@ -179,7 +246,7 @@ def handle_client(client):
 
         # Prompt the user for a task until they choose to quit.
         task = None
-        choices = ['View Users', 'Send New Message', 'Delete Account', 'Quit/Log Out']
+        choices = ['View Users', 'Watch Presence', 'Send New Message', 'Group Chat', 'View Conversation', 'Delete Account', 'Quit/Log Out']
         while (task != 'Quit/Log Out'):
             questions = [
                 inquirer.List('task',
@@ -204,16 +271,33 @@ def handle_client(client):
                 wildcard_query = inquirer.prompt(question)['query']
 
                 if wildcard_query != RETURN_KEYWORD:
-                    # Send a message to the server requesting the list of available users.
-                    send_message(client, VIEW_USERS_COMMAND, wildcard_query)
-                    # Process the response from the server and print it to the console.
-                    message = process_response(client, VIEW_USERS_COMMAND)
-                    print("\nAvailable users:\n" + "\n".join(message) + "\n")
+                    # Stream the list of available users from the server, printing each page as it arrives.
+                    print("\nAvailable users:")
+                    found = False
+                    for username in view_users(client, wildcard_query):
+                        print(username)
+                        found = True
+                    if not found:
+                        print("No users found.")
+                    print()
+
+            elif task == 'Watch Presence':
+                # Have the server push users coming online or going offline, starting with everyone online now.
+                request(client, SUBSCRIBE_PRESENCE_COMMAND).result(RESPONSE_TIMEOUT)
+                print("You will be told when users come online or go offline.\n")
 
             elif task == 'Send New Message':
                 # Prompt the user to enter a message and recipient.
                 deliver_new_message(client, user)
 
+            elif task == 'Group Chat':
+                # Create, join or leave a group, or send a message to one.
+                group_chat(client, user)
+
+            elif task == 'View Conversation':
+                # Show the conversation with another user, newest messages first.
+                view_conversation(client, user)
+
             elif task == 'Delete Account':
                 # Attempt to delete the user's account from the server.
                 if delete_account(client, user):
@@ -257,8 +341,91 @@ def deliver_new_message(client, username):
     if answer['recipient'] == RETURN_KEYWORD or answer['message'] == RETURN_KEYWORD:
         return
     recipient, message = answer['recipient'], answer['message']
-    send_message(client, SEND_MESSAGE_COMMAND, username, recipient, message, current_time)
-    message = process_response(client, SEND_MESSAGE_COMMAND)
+    # The acknowledgement is checked when it arrives, so the user doesn't wait on a round trip
+    future = request(client, SEND_MESSAGE_COMMAND, username, recipient, message, current_time)
+    future.add_done_callback(report_failed_send)
+
+
+def group_chat(client, username):
+    """Prompts user for a group action and a group, and contacts server"""
+
+    commands = {
+        'Send Group Message': SEND_GROUP_MESSAGE_COMMAND,
+        'Create Group': CREATE_GROUP_COMMAND,
+        'Join Group': JOIN_GROUP_COMMAND,
+        'Leave Group': LEAVE_GROUP_COMMAND,
+    }
+    questions = [
+        inquirer.List('action', message='What would you like to do?', choices=list(commands)),
+        inquirer.Text(
+            'group',
+            message='Which group?',
+            validate=lambda _, x: validate_input(x)
+        ),
+        inquirer.Text(
+            'message',
+            message='Please enter the message you would like to send',
+            validate=lambda _, x: validate_input(x),
+            ignore=lambda x: x['action'] != 'Send Group Message' or x['group'] == RETURN_KEYWORD
+        )
+    ]
+    answer = inquirer.prompt(questions)
+    if answer['group'] == RETURN_KEYWORD or answer['message'] == RETURN_KEYWORD:
+        return
+
+    command, group = commands[answer['action']], answer['group']
+    if command == SEND_GROUP_MESSAGE_COMMAND:
+        current_time = str(datetime.now().strftime(TIME_FORMAT))
+        future = request(client, command, group, answer['message'], current_time)
+        future.add_done_callback(report_failed_send)
+        return
+
+    # Print what happened, by command and whether the server answered 'success'
+    outcomes = {
+        CREATE_GROUP_COMMAND: (f"Created {group}.", f"The group {group} already exists."),
+        JOIN_GROUP_COMMAND: (f"Joined {group}.", f"There is no group {group}, or it is full."),
+        LEAVE_GROUP_COMMAND: (f"Left {group}.", f"You are not a member of {group}."),
+    }
+    succeeded = request(client, command, group).result(RESPONSE_TIMEOUT)[0] == 'success'
+    print(outcomes[command][0 if succeeded else 1] + "\n")
+
+
+def view_conversation(client, username):
+    """Prompts user for another user and shows their conversation, newest first, a page at a time"""
+
+    question = [
+        inquirer.Text(
+            'other',
+            message='Whose conversation with you would you like to view?',
+            validate=lambda _, x: validate_input(x)
+        )
+    ]
+    other = inquirer.prompt(question)['other']
+    if other == RETURN_KEYWORD:
+        return
+
+    cursor = ''
+    while True:
+        page = request(client, HISTORY_COMMAND, other, '', '', str(HISTORY_DISPLAY_SIZE), cursor).result(RESPONSE_TIMEOUT)
+        if page[0] == 'error':
+            print("The conversation could not be loaded. Please try again later.\n")
+            return
+        fields = page[1:]
+        if not cursor and not fields:
+            print(f"\nYou have no messages with {other} yet.\n")
+        for i in range(0, len(fields), 4):
+            display_message(*fields[i:i + 4])
+
+        cursor = page[0]
+        if not cursor or not inquirer.prompt([inquirer.Confirm('more', message='Load older messages?')])['more']:
+            return
+
+
+def report_failed_send(future):
+    """Tell the user if the server did not acknowledge one of their messages"""
+
+    if future.exception() is not None or future.result(RESPONSE_TIMEOUT)[0] != 'Success':
+        print("Your message could not be delivered. Please try again later.")
 
 
 def login(client):
@@ -0,0 +1,40 @@
+from config import *
+import client
+from client import process_response
+from protocol import Frame
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+
+class TestClientMethods(unittest.TestCase):
+    mock_socket = MagicMock()
+
+    def setUp(self):
+        while not client.server_message_queue.empty():
+            client.server_message_queue.get()
+
+    def test_Process_response_Queued_response_Returns_args(self):
+        client.server_message_queue.put(Frame(LOGIN_COMMAND, ['exists']))
+        self.assertEqual(process_response(self.__class__.mock_socket, LOGIN_COMMAND), ['exists'])
+
+    def test_Process_response_Waits_for_response_from_reception_thread(self):
+        threading.Timer(0.1, client.server_message_queue.put, [Frame(LOGIN_COMMAND, ['success'])]).start()
+        self.assertEqual(process_response(self.__class__.mock_socket, LOGIN_COMMAND, timeout=5), ['success'])
+
+    def test_Process_response_No_response_Raises_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            process_response(self.__class__.mock_socket, LOGIN_COMMAND, timeout=0.1)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_Process_response_Disconnected_Raises_for_every_waiter(self):
+        client.server_message_queue.put(None)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                process_response(self.__class__.mock_socket, LOGIN_COMMAND, timeout=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
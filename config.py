@@ -1,6 +1,53 @@
 BUFSIZE = 1024 # Buffer size for messages
 PORT_NUMBER = 8000 # Port number to listen on
 
+WIRE_FORMAT = 'framed' # Frame format used by server and client: 'framed' (length-prefixed) or 'padded' (legacy, fixed BUFSIZE frames)
+MAX_FRAME_SIZE = 1 << 20 # Largest frame payload, in bytes, accepted by the framed codec
+RECV_SIZE = 65536 # Number of bytes requested from the socket per read
+
+SERVER_ENGINE = 'asyncio' # How the server serves connections: 'asyncio' (one event loop thread) or 'threaded' (one thread per connection)
+LISTEN_BACKLOG = 1024 # Maximum number of pending connections queued by the listening socket
+LOCK_STRIPES = 256 # Number of locks that users and conversations are hashed onto to guard the server's shared state
+
+OUTBOX_LIMIT = 1 << 20 # Bytes of frames that may wait in one connection's outbound queue
+OUTBOX_OVERFLOW_POLICY = 'spill' # What to do when an outbound queue is full: 'drop', 'disconnect', or 'spill' messages to the offline queue, sent on once the outbox drains (later messages can overtake them)
+
+RESPONSE_TIMEOUT = 10 # Seconds a client waits for the server to answer a request
+
+PATTERN_CACHE_SIZE = 256 # Number of compiled VIEW_USERS wildcard patterns kept for reuse
+GROUP_MAX_MEMBERS = 1000 # Most members one group may have
+PRESENCE_WINDOW = 0.25 # Seconds presence changes are collected for before going out to subscribers as one batch
+VIEW_USERS_PAGE_SIZE = 1000 # Most usernames sent in one VIEW_USERS page or streamed frame
+HISTORY_PAGE_SIZE = 100 # Most messages sent in one HISTORY page
+HISTORY_DISPLAY_SIZE = 10 # Messages the client shows per page when viewing a conversation
+
+OFFLINE_FLUSH_CHUNK = 128 # Maximum number of queued messages delivered in one RECEIVE_MESSAGES frame at login
+OFFLINE_QUEUE_LIMIT = None # Most messages queued for one offline recipient (None for no limit)
+OFFLINE_QUEUE_OVERFLOW = 'drop_oldest' # When a recipient's offline queue is full: 'drop_oldest' evicts the oldest queued message, 'reject' refuses the new one
+OFFLINE_MEMORY_MESSAGES = 256 # Newest messages of an offline queue kept in memory; beyond that they spill to disk in batches this size
+OFFLINE_SEGMENT_BYTES = 16 * 1024 * 1024 # Size at which an offline queue starts a new spill file
+OFFLINE_SPILL_DIRECTORY = None # Directory offline queues spill to (None for 'offline' inside the data directory, or a temporary directory when persistence is disabled)
+
+HISTORY_MAX_MESSAGES = None # Most messages kept per conversation; older ones expire (None keeps every message)
+HISTORY_MAX_AGE_DAYS = None # Days a message is kept, judged by the time it was sent (None keeps messages forever)
+HISTORY_MEMORY_BUDGET = None # Bytes the message history may use; over it, the largest conversations lose their oldest messages (None for no budget)
+RETENTION_INTERVAL = 60 # Seconds between passes that expire messages past the retention limits
+
+DATA_DIRECTORY = 'chat_data' # Directory holding the write-ahead log of account and message changes and its snapshots (None disables persistence)
+WAL_FSYNC_POLICY = 'always' # When logged changes are fsynced: 'always' (before acknowledging; concurrent writers share fsyncs), 'interval', or 'os'
+WAL_FSYNC_INTERVAL = 0.05 # Seconds between fsyncs under the 'interval' policy
+SNAPSHOT_INTERVAL = 30 # Seconds between checks for whether the log has grown enough to snapshot
+SNAPSHOT_MIN_RECORDS = 100000 # Log records written since the last snapshot that trigger a new one
+
+ADMIN_HOST = '127.0.0.1' # Address the admin HTTP server (metrics at /metrics) listens on; keep it local
+ADMIN_PORT = 9108 # Port of the admin HTTP server (0 disables it)
+METRICS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Upper bounds, in seconds, of the request latency histogram buckets
+PROFILE_DIRECTORY = 'profiles' # Directory that on-demand profiles and allocation reports are written to
+PROFILE_SECONDS = 30 # Default length of an on-demand profile or allocation trace, in seconds
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds between stack samples while profiling
+TRACEMALLOC_FRAMES = 1 # Frames of traceback kept for each allocation while tracing (more frames cost more memory)
+TRACEMALLOC_TOP = 25 # Source lines listed in an allocation report
+
 LOGIN_COMMAND = 0 # Command number that signals to clients that they are being asked to login
 VIEW_USERS_COMMAND = 1 # Command number that signals to server that they are being asked to view users
 SEND_MESSAGE_COMMAND = 2 # Command number that signals to server that they are being asked to deliver a message
@@ -9,9 +56,17 @@ MULTIPLE_LOGIN_COMMAND = 4 # Command number that signals to server that they are
 LOGOUT_COMMAND = 5 # Command number that signals to server that they are being asked to log out all instances of an username except the one using socket `client`
 
 RECEIVE_MESSAGE_COMMAND = 6  # Command number that signals to clients that a message is being delivered
+RECEIVE_MESSAGES_COMMAND = 8 # Command number that signals to clients that a batch of queued messages is being delivered
 
 DELETE_ACCOUNT_COMMAND = 7 # Command number that signals to server that the client wants to delete their account
 QUIT_COMMAND = 9 # Command number that signals to server that the client wants to disconnect
+HISTORY_COMMAND = 10 # Command number that signals to server that the client wants a page of a conversation's history
+SUBSCRIBE_PRESENCE_COMMAND = 11 # Command number that signals to server that the client wants to be told when users come online or go offline
+PRESENCE_COMMAND = 12 # Command number that signals to clients that a batch of presence changes is being pushed
+CREATE_GROUP_COMMAND = 13 # Command number that signals to server that the client wants to create a group, joining it
+JOIN_GROUP_COMMAND = 14 # Command number that signals to server that the client wants to join a group
+LEAVE_GROUP_COMMAND = 15 # Command number that signals to server that the client wants to leave a group
+SEND_GROUP_MESSAGE_COMMAND = 16 # Command number that signals to server that the client wants to send a message to every member of a group
 
 TIME_FORMAT = '%Y-%m-%d %H:%M'
 BUFSIZE = 1024
@@ -0,0 +1,100 @@
+"""Group conversations.
+
+A group is a named set of members, kept on the server. Any member can send to
+the group, and the message goes to every other member: live to each of their
+connected devices, or onto their offline queue. The delivery frame names the
+group as the message's recipient and is the same for every member, so it is
+encoded once and the same bytes are queued on every member's connection.
+
+A group is created with its creator as the only member and deleted when its
+last member leaves. Membership changes are guarded by the group's lock
+(`group_locks` in server.py); a send takes a copy of the members under the lock
+and delivers to them after releasing it.
+"""
+from collections import defaultdict
+from config import *
+
+
+class GroupMessage:
+    """A message sent to a group, as delivered to `member`: queued for them, shown as sent to the group"""
+
+    __slots__ = ('member', 'message')
+
+    def __init__(self, member, message):
+        self.member = member
+        self.message = message
+
+
+class Groups:
+    """Maps group name to the set of its members, and each user to the groups they belong to"""
+
+    def __init__(self):
+        self.members = {}                    # Maps group name to the set of its members
+        self.memberships = defaultdict(set)  # Maps username to the names of the groups they belong to
+
+    def __contains__(self, group):
+        return group in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def create(self, group, creator):
+        """Create `group` with `creator` as its only member, returning False if it already exists"""
+
+        if group in self.members:
+            return False
+        self.members[group] = {creator}
+        self.memberships[creator].add(group)
+        return True
+
+    def join(self, group, username, limit=GROUP_MAX_MEMBERS):
+        """Add `username` to `group`, returning False if there is no such group or it is full"""
+
+        members = self.members.get(group)
+        if members is None or (username not in members and len(members) >= limit):
+            return False
+        members.add(username)
+        self.memberships[username].add(group)
+        return True
+
+    def leave(self, group, username):
+        """Remove `username` from `group`, deleting the group once it is empty; returns False if they weren't a member"""
+
+        members = self.members.get(group)
+        if members is None or username not in members:
+            return False
+        members.discard(username)
+        if not members:
+            del self.members[group]
+        groups = self.memberships.get(username)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                self.memberships.pop(username, None)
+        return True
+
+    def members_of(self, group):
+        """Return a list of the members of `group`, or None if there is no such group"""
+
+        members = self.members.get(group)
+        return None if members is None else list(members)
+
+    def groups_of(self, username):
+        """Return a list of the groups `username` belongs to"""
+
+        return list(self.memberships.get(username, ()))
+
+    def export(self):
+        """Return the groups as a plain dict of group name to sorted member list, for a snapshot"""
+
+        return {group: sorted(members) for group, members in self.members.items()}
+
+    def load(self, exported):
+        """Replace the groups with those from `export`"""
+
+        self.members.clear()
+        self.memberships.clear()
+        for group, members in exported.items():
+            self.members[group] = set(members)
+            for member in members:
+                self.memberships[member].add(group)
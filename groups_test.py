@@ -0,0 +1,134 @@
+from config import *
+import server
+from groups import Groups
+from history import UserMessage
+from offline_queue import OfflineQueues
+from outbox import Outbox
+from user_directory import UserDirectory
+import unittest
+from unittest.mock import MagicMock, patch
+from threading import Lock
+
+
+class FullOutbox(Outbox):
+    """An outbox that never has room, so every frame put on it overflows"""
+
+    def put(self, frame, message=None):
+        return self.overflow(message)
+
+
+class TestGroups(unittest.TestCase):
+    def setUp(self):
+        self.groups = Groups()
+
+    def test_Create_Existing_group_Fails(self):
+        self.assertTrue(self.groups.create('team', 'a'))
+        self.assertFalse(self.groups.create('team', 'b'))
+        self.assertEqual(self.groups.members_of('team'), ['a'])
+
+    def test_Join_Missing_or_full_group_Fails(self):
+        self.assertFalse(self.groups.join('team', 'a'))
+        self.groups.create('team', 'a')
+        self.assertTrue(self.groups.join('team', 'b', limit=2))
+        self.assertFalse(self.groups.join('team', 'c', limit=2))
+        self.assertTrue(self.groups.join('team', 'b', limit=2))
+        self.assertEqual(self.groups.groups_of('b'), ['team'])
+
+    def test_Leave_Last_member_Deletes_group(self):
+        self.groups.create('team', 'a')
+        self.groups.join('team', 'b')
+        self.assertTrue(self.groups.leave('team', 'a'))
+        self.assertFalse(self.groups.leave('team', 'a'))
+        self.assertEqual(self.groups.groups_of('a'), [])
+        self.assertTrue(self.groups.leave('team', 'b'))
+        self.assertNotIn('team', self.groups)
+
+    def test_Load_Export_Round_trips(self):
+        self.groups.create('team', 'a')
+        self.groups.join('team', 'b')
+        self.groups.create('other', 'b')
+        loaded = Groups()
+        loaded.load(self.groups.export())
+        self.assertEqual(loaded.export(), {'team': ['a', 'b'], 'other': ['b']})
+        self.assertEqual(sorted(loaded.groups_of('b')), ['other', 'team'])
+
+
+class TestServerGroups(unittest.TestCase):
+    def setUp(self):
+        self.saved = (server.groups, server.connected_clients, server.unsent_message_queue)
+        server.groups = Groups()
+        server.connected_clients = UserDirectory(set)
+        server.unsent_message_queue = OfflineQueues()
+
+    def tearDown(self):
+        server.groups, server.connected_clients, server.unsent_message_queue = self.saved
+
+    def new_client(self, username=None):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        if username is not None:
+            server.connected_clients[username].add(client)
+        return client
+
+    def reply(self, client):
+        frame, = server.codec.decoder().feed(client.sendall.call_args[0][0])
+        return frame.args
+
+    def test_Change_group_membership_Replies_success_or_error(self):
+        client = self.new_client('a')
+        for command, group, expected in [
+            (CREATE_GROUP_COMMAND, 'team', 'success'),
+            (CREATE_GROUP_COMMAND, 'team', 'error'),
+            (CREATE_GROUP_COMMAND, '', 'error'),
+            (JOIN_GROUP_COMMAND, 'missing', 'error'),
+            (LEAVE_GROUP_COMMAND, 'team', 'success'),
+            (LEAVE_GROUP_COMMAND, 'team', 'error'),
+        ]:
+            server.dispatch_command(client, 'a', command, [group])
+            self.assertEqual(self.reply(client), [expected])
+
+    def test_Send_group_message_Shares_one_frame_and_queues_offline_members(self):
+        sender = self.new_client('sender')
+        devices = [self.new_client(f'member{i // 2}') for i in range(6)]
+        server.change_group_membership(sender, 'sender', CREATE_GROUP_COMMAND, 'team')
+        for member in ['member0', 'member1', 'member2', 'offline']:
+            server.change_group_membership(sender, member, JOIN_GROUP_COMMAND, 'team')
+        sender.reset_mock()
+
+        server.dispatch_command(sender, 'sender', SEND_GROUP_MESSAGE_COMMAND, ['team', 'hello', 'now'])
+        self.assertEqual(self.reply(sender), ['Success'])
+
+        frames = [device.sendall.call_args[0][0] for device in devices]
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+        frame, = server.codec.decoder().feed(frames[0])
+        self.assertEqual((frame.command, frame.args), (RECEIVE_MESSAGE_COMMAND, ['sender', 'team', 'hello', 'now']))
+        self.assertEqual(list(server.unsent_message_queue['offline']), [UserMessage('sender', 'team', 'hello', 'now')])
+        self.assertFalse(server.unsent_message_queue['sender'])
+
+    def test_Send_group_message_Not_a_member_Replies_error(self):
+        client = self.new_client('a')
+        server.change_group_membership(client, 'b', CREATE_GROUP_COMMAND, 'team')
+        self.assertIsNone(server.send_group_message(client, 'a', 'team', 'hi', 'now'))
+        self.assertEqual(self.reply(client), ['error'])
+
+    def test_Send_group_message_Full_outbox_Spills_to_member_queue(self):
+        stalled = self.new_client('slow')
+        sender = self.new_client('sender')
+        server.change_group_membership(sender, 'sender', CREATE_GROUP_COMMAND, 'team')
+        server.change_group_membership(sender, 'slow', JOIN_GROUP_COMMAND, 'team')
+        with patch.dict(server.client_outboxes, {stalled: FullOutbox(policy='spill', spill=server.spill_to_offline_queue)}):
+            for i in range(3):
+                server.send_group_message(sender, 'sender', 'team', str(i), 'now')
+        self.assertEqual(list(server.unsent_message_queue['slow']), [UserMessage('sender', 'team', str(i), 'now') for i in range(3)])
+
+    def test_Delete_account_Leaves_every_group(self):
+        client = self.new_client('a')
+        server.accounts['grouped'] = 'hash'
+        server.change_group_membership(client, 'grouped', CREATE_GROUP_COMMAND, 'team')
+        server.change_group_membership(client, 'a', JOIN_GROUP_COMMAND, 'team')
+        server.delete_account(client, 'grouped', 'hash')
+        self.assertEqual(server.groups.members_of('team'), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
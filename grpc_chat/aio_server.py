@@ -0,0 +1,320 @@
+import grpc
+import asyncio
+import argparse
+import chat_pb2_grpc as pb2_grpc
+import chat_pb2 as pb2
+import re
+import socket
+from mailboxes import Mailbox
+
+# The same service as server.py, run on one asyncio event loop with grpc.aio.
+# A ListenMessages stream is a coroutine waiting on a condition rather than a
+# worker thread, so the number of open streams is bounded by memory, not by a
+# thread pool, and unary calls are never stuck behind them.
+
+# Associates a unique username with a password
+accounts = {}
+
+# Associates a username with a logged-in status
+accounts_status = {}
+
+# Associates a user with the Mailbox of messages sent to them and not yet acknowledged
+accounts_queue = {}
+
+# Associates a user with an asyncio condition guarding their mailbox, notified when
+# a message arrives for them or they log out, so their listeners can sleep until then
+accounts_wakeup = {}
+
+
+async def wake(username):
+    '''Wakes the user's listening streams to check their mailbox and logged-in status'''
+
+    wakeup = accounts_wakeup.get(username)
+    if wakeup is not None:
+        async with wakeup:
+            wakeup.notify_all()
+
+
+def check_send(source, destination):
+    '''Returns None if source may send to destination, or an error message saying why not'''
+
+    # If the source is not logged in, return an error
+    if source not in accounts or accounts_status[source] == False:
+        return "Error: username not valid or not logged in"
+
+    # If the destination is not a valid account, return an error
+    if destination not in accounts:
+        return "Error: destination not valid"
+    return None
+
+
+async def deliver(source, destination, text):
+    '''Puts a message into the destination user's mailbox, returning None, or an error message if it can't be sent'''
+
+    error = check_send(source, destination)
+    if error is not None:
+        return error
+
+    accounts_queue[destination].append(source, text)
+    await wake(destination)
+    return None
+
+
+class AsyncChatService(pb2_grpc.ChatServicer):
+
+    async def CreateAccount(self, request, context):
+        '''
+        Creates a new account with the given username and password.
+        If the username already exists, an error is returned.
+        '''
+        username = request.username
+        password = request.password
+        if username not in accounts:
+            accounts[username] = password
+            accounts_status[username] = False
+            accounts_queue[username] = Mailbox()
+            accounts_wakeup[username] = asyncio.Condition()
+            result = f'{username} added'
+            response = {'message': result, 'error': False}
+        else:
+            result = "Error: Username already in use"
+            response = {'message': result, 'error': True}
+
+        return pb2.ServerResponse(**response)
+
+
+    async def DeleteAccount(self, request, context):
+        '''
+        Deletes the account with the given username and password.
+        If the username or password is incorrect, an error is returned.
+        '''
+        username = request.username
+        password = request.password
+        if username not in accounts:
+            result = f'{username} is not an existing username'
+            response = {'message': result, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        if password != accounts[username]:
+            result = f'Wrong password for {username}'
+            response = {'message': result, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        del(accounts[username])
+        # End the deleted account's listening streams
+        accounts_status[username] = False
+        await wake(username)
+        result = f'{username} deleted'
+        response = {'message': result, 'error': False}
+        return pb2.ServerResponse(**response)
+
+
+    async def Login(self, request, context):
+        username = request.username
+        password = request.password
+
+        if username not in accounts:
+            result = f'{username} is not a registered account.'
+            response = {'message': result, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        if password != accounts[username]:
+            result = f"Incorrect password for {username}'s account."
+            response = {'message': result, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        accounts_status[username] = True
+        result = f'{username}, you are logged in'
+        response = {'message': result, 'error': False}
+        return pb2.ServerResponse(**response)
+
+
+    async def Logout(self, request, context):
+        '''Logout the client'''
+
+        username = request.username
+        accounts_status[username] = False
+        await wake(username)
+        result = f'{username}, you are logged out'
+        response = {'message': result, 'error': False}
+        return pb2.ServerResponse(**response)
+
+
+    async def ListAccounts(self, request, context):
+        '''Lists the available accounts'''
+
+        pattern = re.compile(request.searchterm)
+        accounts_str = " ".join(account for account in accounts if pattern.search(account) != None)
+        response = {'usernames': accounts_str}
+        return pb2.Accounts(**response)
+
+
+    async def SendMessage(self, request, context):
+        '''Puts message into the destination user's mailbox'''
+
+        error = await deliver(request.source, request.destination, request.text)
+        if error is not None:
+            response = {'message': error, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        result = "Message Sent"
+        response = {'message': result, 'error': False}
+        return pb2.ServerResponse(**response)
+
+
+    async def ListenMessages(self, request, context):
+        '''
+        Streams the user's messages to them, starting after the last one they
+        acknowledged, until they log out or the call ends. Between messages the
+        stream waits on the user's condition; a cancelled call cancels the
+        waiting coroutine, which ends the stream.
+        '''
+        username = request.username
+        wakeup = accounts_wakeup.get(username)
+        if wakeup is None:
+            return
+        mailbox = accounts_queue[username]
+
+        mailbox.ack(request.acked)
+        sent = min(request.acked, mailbox.last_seq)
+        while True:
+            async with wakeup:
+                await wakeup.wait_for(lambda: mailbox.last_seq > sent or accounts_status.get(username) != True)
+                if accounts_status.get(username) != True:
+                    return
+                mail = mailbox.after(sent)
+            for message in mail:
+                response = {'destination': username, 'source': message.source, 'text': message.text, 'seq': message.seq}
+                yield pb2.MessageInfo(**response)
+                sent = message.seq
+
+
+    async def AckMessages(self, request, context):
+        '''Drops the user's messages up to and including the acknowledged one'''
+
+        username = request.username
+        if username not in accounts:
+            result = f'{username} is not an existing username'
+            response = {'message': result, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        accounts_queue[username].ack(request.seq)
+        result = f'Acknowledged up to {request.seq}'
+        response = {'message': result, 'error': False}
+        return pb2.ServerResponse(**response)
+
+
+    async def Chat(self, request_iterator, context):
+        '''
+        A two-way session on one stream, as in server.py: the client's requests
+        are handled by a task of their own while the stream waits on the user's
+        condition for messages to deliver and sends to report.
+        '''
+        first = await anext(request_iterator, None)
+        if first is None or first.WhichOneof('request') != 'listen':
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'A chat session must start with a listen request')
+        username = first.listen.username
+        wakeup = accounts_wakeup.get(username)
+        if wakeup is None or accounts_status.get(username) != True:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, f'{username} is not logged in')
+        mailbox = accounts_queue[username]
+
+        handled = 0       # Messages the session has sent so far
+        failures = []     # SendResults for failed sends not reported yet
+        finished = False  # Whether the client has stopped sending
+
+        async def read():
+            '''Handles the client's requests as they arrive'''
+
+            nonlocal handled, finished
+            try:
+                async for request in request_iterator:
+                    kind = request.WhichOneof('request')
+                    if kind == 'message':
+                        error = await deliver(username, request.message.destination, request.message.text)
+                        handled += 1
+                        if error is not None:
+                            failures.append(pb2.SendResult(id=handled, error=error))
+                    elif kind == 'ack':
+                        mailbox.ack(request.ack)
+                        continue
+                    async with wakeup:
+                        wakeup.notify_all()
+            finally:
+                finished = True
+                async with wakeup:
+                    wakeup.notify_all()
+
+        mailbox.ack(first.listen.acked)
+        sent = min(first.listen.acked, mailbox.last_seq)
+        reported = 0  # Messages the session has been told the outcome of
+        reader = asyncio.ensure_future(read())
+        try:
+            while True:
+                async with wakeup:
+                    await wakeup.wait_for(lambda: mailbox.last_seq > sent or handled > reported or finished
+                                          or accounts_status.get(username) != True)
+                    if accounts_status.get(username) != True:
+                        return
+                    mail = mailbox.after(sent)
+                    failed = failures[:]
+                    failures.clear()
+                    done, ended = handled, finished
+                for message in mail:
+                    response = {'destination': username, 'source': message.source, 'text': message.text, 'seq': message.seq}
+                    yield pb2.ChatEvent(message=pb2.MessageInfo(**response))
+                    sent = message.seq
+                for result in failed:
+                    # Report the sends that went through before this one first
+                    if result.id - 1 > reported:
+                        yield pb2.ChatEvent(sent=pb2.SendResult(id=result.id - 1))
+                    yield pb2.ChatEvent(sent=result)
+                    reported = result.id
+                if done > reported:
+                    yield pb2.ChatEvent(sent=pb2.SendResult(id=done))
+                    reported = done
+                if ended:
+                    # Raise anything that stopped the reader, rather than ending the stream as if the client had
+                    await reader
+                    return
+        finally:
+            reader.cancel()
+
+
+    async def SendMessages(self, request_iterator, context):
+        '''
+        Puts a stream of messages into their destinations' mailboxes, as in
+        server.py, answering once with a SendSummary.
+        '''
+        batches = {}  # Maps destination to the (source, text) pairs for it, in order
+        errors = []
+        index = 0
+        async for request in request_iterator:
+            error = check_send(request.source, request.destination)
+            if error is not None:
+                errors.append(pb2.SendError(index=index, error=error))
+            else:
+                batches.setdefault(request.destination, []).append((request.source, request.text))
+            index += 1
+
+        for destination, messages in batches.items():
+            accounts_queue[destination].extend(messages)
+            await wake(destination)
+        delivered = sum(len(messages) for messages in batches.values())
+        return pb2.SendSummary(delivered=delivered, errors=errors)
+
+
+async def serve(address='[::]:50051'):
+    server = grpc.aio.server()
+    pb2_grpc.add_ChatServicer_to_server(AsyncChatService(), server) # Add service to server
+    server.add_insecure_port(address)
+    await server.start()
+    host = socket.gethostbyname(socket.gethostname())
+    print(f'Server started on {host}')
+    await server.wait_for_termination()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the chat service on a grpc.aio event loop")
+    parser.add_argument('--address', default='[::]:50051', help="address to listen on")
+    asyncio.run(serve(parser.parse_args().address))
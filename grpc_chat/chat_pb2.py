@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\"\t\n\x07NoParam\"-\n\x07\x41\x63\x63ount\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"\x1d\n\x08\x41\x63\x63ounts\x12\x11\n\tusernames\x18\x01 \x01(\t\"0\n\x0eServerResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\"@\n\x0bMessageInfo\x12\x13\n\x0b\x64\x65stination\x18\x01 \x01(\t\x12\x0e\n\x06source\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\" \n\nSearchTerm\x12\x12\n\nsearchterm\x18\x01 \x01(\t2\xb7\x02\n\x04\x43hat\x12,\n\rCreateAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12,\n\rDeleteAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12$\n\x05Login\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12%\n\x06Logout\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12(\n\x0cListAccounts\x12\x0b.SearchTerm\x1a\t.Accounts\"\x00\x12.\n\x0bSendMessage\x12\x0c.MessageInfo\x1a\x0f.ServerResponse\"\x00\x12,\n\x0eListenMessages\x12\x08.Account\x1a\x0c.MessageInfo\"\x00\x30\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\"\t\n\x07NoParam\"-\n\x07\x41\x63\x63ount\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"\x1d\n\x08\x41\x63\x63ounts\x12\x11\n\tusernames\x18\x01 \x01(\t\"0\n\x0eServerResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\"M\n\x0bMessageInfo\x12\x13\n\x0b\x64\x65stination\x18\x01 \x01(\t\x12\x0e\n\x06source\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\x12\x0b\n\x03seq\x18\x04 \x01(\x04\" \n\nSearchTerm\x12\x12\n\nsearchterm\x18\x01 \x01(\t\"0\n\rListenRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\r\n\x05\x61\x63ked\x18\x03 \x01(\x04\"$\n\x03\x41\x63k\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0b\n\x03seq\x18\x02 \x01(\x04\"j\n\x0b\x43hatRequest\x12 \n\x06listen\x18\x01 \x01(\x0b\x32\x0e.ListenRequestH\x00\x12\x1f\n\x07message\x18\x02 \x01(\x0b\x32\x0c.MessageInfoH\x00\x12\r\n\x03\x61\x63k\x18\x03 \x01(\x04H\x00\x42\t\n\x07request\"R\n\tChatEvent\x12\x1f\n\x07message\x18\x01 \x01(\x0b\x32\x0c.MessageInfoH\x00\x12\x1b\n\x04sent\x18\x02 \x01(\x0b\x32\x0b.SendResultH\x00\x42\x07\n\x05\x65vent\"\'\n\nSendResult\x12\n\n\x02id\x18\x01 \x01(\x04\x12\r\n\x05\x65rror\x18\x02 \x01(\t\"<\n\x0bSendSummary\x12\x11\n\tdelivered\x18\x01 \x01(\x04\x12\x1a\n\x06\x65rrors\x18\x02 \x03(\x0b\x32\n.SendError\")\n\tSendError\x12\r\n\x05index\x18\x01 \x01(\x04\x12\r\n\x05\x65rror\x18\x02 \x01(\t2\xbd\x03\n\x04\x43hat\x12,\n\rCreateAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12,\n\rDeleteAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12$\n\x05Login\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12%\n\x06Logout\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12(\n\x0cListAccounts\x12\x0b.SearchTerm\x1a\t.Accounts\"\x00\x12.\n\x0bSendMessage\x12\x0c.MessageInfo\x1a\x0f.ServerResponse\"\x00\x12\x32\n\x0eListenMessages\x12\x0e.ListenRequest\x1a\x0c.MessageInfo\"\x00\x30\x01\x12&\n\x0b\x41\x63kMessages\x12\x04.Ack\x1a\x0f.ServerResponse\"\x00\x12&\n\x04\x43hat\x12\x0c.ChatRequest\x1a\n.ChatEvent\"\x00(\x01\x30\x01\x12.\n\x0cSendMessages\x12\x0c.MessageInfo\x1a\x0c.SendSummary\"\x00(\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', globals())
@@ -29,9 +29,23 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _SERVERRESPONSE._serialized_start=103
   _SERVERRESPONSE._serialized_end=151
   _MESSAGEINFO._serialized_start=153
-  _MESSAGEINFO._serialized_end=217
-  _SEARCHTERM._serialized_start=219
-  _SEARCHTERM._serialized_end=251
-  _CHAT._serialized_start=254
-  _CHAT._serialized_end=565
+  _MESSAGEINFO._serialized_end=230
+  _SEARCHTERM._serialized_start=232
+  _SEARCHTERM._serialized_end=264
+  _LISTENREQUEST._serialized_start=266
+  _LISTENREQUEST._serialized_end=314
+  _ACK._serialized_start=316
+  _ACK._serialized_end=352
+  _CHATREQUEST._serialized_start=354
+  _CHATREQUEST._serialized_end=460
+  _CHATEVENT._serialized_start=462
+  _CHATEVENT._serialized_end=544
+  _SENDRESULT._serialized_start=546
+  _SENDRESULT._serialized_end=585
+  _SENDSUMMARY._serialized_start=587
+  _SENDSUMMARY._serialized_end=647
+  _SENDERROR._serialized_start=649
+  _SENDERROR._serialized_end=690
+  _CHAT._serialized_start=693
+  _CHAT._serialized_end=1138
 # @@protoc_insertion_point(module_scope)
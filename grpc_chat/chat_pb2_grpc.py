@@ -46,9 +46,24 @@ class ChatStub(object):
                 )
         self.ListenMessages = channel.unary_stream(
                 '/Chat/ListenMessages',
-                request_serializer=chat__pb2.Account.SerializeToString,
+                request_serializer=chat__pb2.ListenRequest.SerializeToString,
                 response_deserializer=chat__pb2.MessageInfo.FromString,
                 )
+        self.AckMessages = channel.unary_unary(
+                '/Chat/AckMessages',
+                request_serializer=chat__pb2.Ack.SerializeToString,
+                response_deserializer=chat__pb2.ServerResponse.FromString,
+                )
+        self.Chat = channel.stream_stream(
+                '/Chat/Chat',
+                request_serializer=chat__pb2.ChatRequest.SerializeToString,
+                response_deserializer=chat__pb2.ChatEvent.FromString,
+                )
+        self.SendMessages = channel.stream_unary(
+                '/Chat/SendMessages',
+                request_serializer=chat__pb2.MessageInfo.SerializeToString,
+                response_deserializer=chat__pb2.SendSummary.FromString,
+                )
 
 
 class ChatServicer(object):
@@ -96,6 +111,24 @@ class ChatServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AckMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Chat(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendMessages(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -131,9 +164,24 @@ def add_ChatServicer_to_server(servicer, server):
             ),
             'ListenMessages': grpc.unary_stream_rpc_method_handler(
                     servicer.ListenMessages,
-                    request_deserializer=chat__pb2.Account.FromString,
+                    request_deserializer=chat__pb2.ListenRequest.FromString,
                     response_serializer=chat__pb2.MessageInfo.SerializeToString,
             ),
+            'AckMessages': grpc.unary_unary_rpc_method_handler(
+                    servicer.AckMessages,
+                    request_deserializer=chat__pb2.Ack.FromString,
+                    response_serializer=chat__pb2.ServerResponse.SerializeToString,
+            ),
+            'Chat': grpc.stream_stream_rpc_method_handler(
+                    servicer.Chat,
+                    request_deserializer=chat__pb2.ChatRequest.FromString,
+                    response_serializer=chat__pb2.ChatEvent.SerializeToString,
+            ),
+            'SendMessages': grpc.stream_unary_rpc_method_handler(
+                    servicer.SendMessages,
+                    request_deserializer=chat__pb2.MessageInfo.FromString,
+                    response_serializer=chat__pb2.SendSummary.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'Chat', rpc_method_handlers)
@@ -258,7 +306,58 @@ class Chat(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_stream(request, target, '/Chat/ListenMessages',
-            chat__pb2.Account.SerializeToString,
+            chat__pb2.ListenRequest.SerializeToString,
             chat__pb2.MessageInfo.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def AckMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/AckMessages',
+            chat__pb2.Ack.SerializeToString,
+            chat__pb2.ServerResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Chat(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/Chat/Chat',
+            chat__pb2.ChatRequest.SerializeToString,
+            chat__pb2.ChatEvent.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendMessages(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/Chat/SendMessages',
+            chat__pb2.MessageInfo.SerializeToString,
+            chat__pb2.SendSummary.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
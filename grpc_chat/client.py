@@ -22,6 +22,9 @@ class ChatClient:
 
         self.stub = pb2_grpc.ChatStub(self.channel)
 
+        # Maps each username to the sequence number of the last message acknowledged for them
+        self.acked = {}
+
     def create_account(self, username, password):
         """
         Create a new account with the specified username and password.
@@ -105,15 +108,67 @@ class ChatClient:
         message_info = pb2.MessageInfo(destination=destination, source=source, text=text)
         return self.stub.SendMessage(message_info)
 
+    def send_messages(self, messages):
+        """
+        Send many messages in one call, streaming them to the server.
+
+        Args:
+        - messages: An iterable of (destination, source, text) tuples, as passed to send_message.
+
+        Returns:
+        - A pb2.SendSummary object: the number of messages delivered, and a pb2.SendError
+          for each of the others, giving its index in messages and the reason.
+        """
+        requests = (pb2.MessageInfo(destination=destination, source=source, text=text)
+                    for destination, source, text in messages)
+        return self.stub.SendMessages(requests)
+
+    def chat(self, username, messages):
+        """
+        Open a chat session for the specified user on one stream, sending the
+        messages without waiting for a reply to each.
+
+        Args:
+        - username (str): The logged-in user to send and receive as.
+        - messages: An iterable of (destination, text) pairs to send.
+
+        Returns:
+        - An iterator of pb2.ChatEvent objects: messages sent to the user, and
+          pb2.SendResult objects reporting how the sends went.
+        """
+        def requests():
+            yield pb2.ChatRequest(listen=pb2.ListenRequest(username=username, acked=self.acked.get(username, 0)))
+            for destination, text in messages:
+                yield pb2.ChatRequest(message=pb2.MessageInfo(destination=destination, source=username, text=text))
+
+        return self.stub.Chat(requests())
+
+    def ack_messages(self, username, seq):
+        """
+        Acknowledge the messages sent to the specified user, up to and including seq,
+        so the server stops keeping them.
+
+        Args:
+        - username (str): The username the messages were sent to.
+        - seq (int): The sequence number of the last message received.
+
+        Returns:
+        - A pb2.ServerResponse object representing the result of the operation.
+        """
+        self.acked[username] = seq
+        return self.stub.AckMessages(pb2.Ack(username=username, seq=seq))
+
     def listen_messages(self, username):
         """
-        Listen for messages sent to the specified user and print them to the console.
+        Listen for messages sent to the specified user and print them to the console,
+        acknowledging each one once it is printed. Listening again after a dropped
+        stream picks up after the last message acknowledged.
 
         Args:
         - username (str): The username of the account to listen for messages on.
         """
-        account = pb2.Account(username=username)
-        messages = self.stub.ListenMessages(account)
+        request = pb2.ListenRequest(username=username, acked=self.acked.get(username, 0))
+        messages = self.stub.ListenMessages(request)
         for msg in messages:
             format = f'''
             ______________________________________________________________
@@ -122,6 +177,7 @@ class ChatClient:
             ______________________________________________________________
             '''
             print(format)
+            self.ack_messages(username, msg.seq)
 
 
 def login_ui(client):
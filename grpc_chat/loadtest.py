@@ -0,0 +1,249 @@
+"""Load tests for the gRPC chat servers.
+
+    python loadtest.py streams [--server aio|threaded] [--streams N ...] [--calls C]
+    python loadtest.py send [--server aio|threaded] [--messages M] [--size B]
+
+A fresh server (`aio_server.py` or `server.py`) is started in a subprocess on a
+free loopback port, and the results are printed as JSON.
+
+`streams` opens more and more ListenMessages streams and, at each step, times a
+run of unary SendMessage calls, to show whether unary latency holds up as
+streams are added. Each stream belongs to its own logged-in user, and every
+timed message is sent to one of them, so the calls also exercise delivery. For
+each number of open streams it gives the p50/p99 latency of the calls that
+completed, and whether one timed out, which ends the test. The threaded server
+runs every stream on one of its 10 worker threads, so once 10 streams are open
+unary calls time out.
+
+`send` sends the same messages from one user to another three times: as unary
+SendMessage calls, each awaited before the next, pipelined on one Chat session,
+which reports them in SendResults, and as one SendMessages batch. It gives the
+messages per second of each.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import grpc
+import chat_pb2_grpc as pb2_grpc
+import chat_pb2 as pb2
+
+SERVER_START_TIMEOUT = 10  # Seconds to wait for a spawned server to accept calls
+CHANNEL_STREAMS = 100      # Listener streams opened on each channel (and so each HTTP/2 connection)
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank `fraction` percentile of the sorted list `values`"""
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def free_port():
+    """Return a loopback port that nothing is listening on"""
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def spawned_server(kind):
+    """Run the chosen server in a subprocess on a free loopback port and yield its address"""
+
+    address = f'127.0.0.1:{free_port()}'
+    script = 'aio_server.py' if kind == 'aio' else 'server.py'
+    process = subprocess.Popen([sys.executable, script, '--address', address],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+    try:
+        yield address
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class Listener:
+    """A logged-in user holding a ListenMessages stream open and counting what it receives"""
+
+    def __init__(self, stub, username):
+        self.stub = stub
+        self.username = username
+        self.received = 0
+        self.call = None
+        self.receiving = None
+
+    async def open(self):
+        account = pb2.Account(username=self.username, password='password')
+        await self.stub.CreateAccount(account)
+        await self.stub.Login(account)
+        self.call = self.stub.ListenMessages(pb2.ListenRequest(username=self.username))
+        self.receiving = asyncio.ensure_future(self.receive())
+
+    async def receive(self):
+        try:
+            async for _ in self.call:
+                self.received += 1
+        except (grpc.RpcError, asyncio.CancelledError):
+            # The stream ended or was cancelled at the end of the test
+            pass
+
+
+async def time_calls(stub, listeners, calls, timeout):
+    """Send `calls` messages one after another, returning the sorted latencies of those answered and
+    whether one timed out (which ends the run: the server is not answering unary calls)"""
+
+    latencies = []
+    for n in range(calls):
+        destination = random.choice(listeners).username if listeners else 'loadtest'
+        start = time.perf_counter()
+        try:
+            await stub.SendMessage(pb2.MessageInfo(destination=destination, source='loadtest', text=f'message {n}'),
+                                   timeout=timeout)
+            latencies.append(time.perf_counter() - start)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.DEADLINE_EXCEEDED:
+                raise
+            return sorted(latencies), True
+    return sorted(latencies), False
+
+
+async def start(stub, username):
+    """Wait for the server to answer, then create and log in `username`"""
+
+    account = pb2.Account(username=username, password='password')
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            await stub.CreateAccount(account, timeout=1)
+            break
+        except grpc.RpcError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("The server did not start.")
+            await asyncio.sleep(0.05)
+    await stub.Login(account)
+
+
+async def open_streams(arguments, address):
+    channels = []
+
+    def stub():
+        """Return a stub on a channel with room for another stream, opening channels as needed"""
+
+        if not channels or channels[-1][1] >= CHANNEL_STREAMS:
+            channels.append([grpc.aio.insecure_channel(address, options=[('grpc.use_local_subchannel_pool', 1)]), 0])
+        channels[-1][1] += 1
+        return pb2_grpc.ChatStub(channels[-1][0])
+
+    sender = stub()
+    await start(sender, 'loadtest')
+
+    results, listeners = [], []
+    for streams in sorted(arguments.streams):
+        added = [Listener(stub(), f'listener{i}') for i in range(len(listeners), streams)]
+        for i in range(0, len(added), 100):
+            await asyncio.gather(*(listener.open() for listener in added[i:i + 100]))
+        listeners += added
+        await asyncio.sleep(0.5)
+
+        latencies, timed_out = await time_calls(sender, listeners, arguments.calls, arguments.timeout)
+        results.append({
+            'streams': streams,
+            'calls': len(latencies),
+            'timed_out': timed_out,
+            'p50_ms': None if not latencies else round(percentile(latencies, 0.5) * 1000, 3),
+            'p99_ms': None if not latencies else round(percentile(latencies, 0.99) * 1000, 3),
+        })
+        if timed_out:
+            break
+
+    for listener in listeners:
+        listener.call.cancel()
+    await asyncio.gather(*(listener.receiving for listener in listeners))
+    for channel, _ in channels:
+        await channel.close()
+    return results
+
+
+async def send_throughput(arguments, address):
+    channel = grpc.aio.insecure_channel(address)
+    stub = pb2_grpc.ChatStub(channel)
+    await start(stub, 'sender')
+    await start(stub, 'receiver')
+    texts = ['x' * arguments.size] * arguments.messages
+
+    start_time = time.perf_counter()
+    for text in texts:
+        response = await stub.SendMessage(pb2.MessageInfo(destination='receiver', source='sender', text=text))
+        if response.error:
+            raise RuntimeError(response.message)
+    unary = time.perf_counter() - start_time
+
+    async def requests():
+        yield pb2.ChatRequest(listen=pb2.ListenRequest(username='sender'))
+        for text in texts:
+            yield pb2.ChatRequest(message=pb2.MessageInfo(destination='receiver', text=text))
+
+    start_time = time.perf_counter()
+    results = 0
+    async for event in stub.Chat(requests()):
+        if event.WhichOneof('event') == 'sent':
+            if event.sent.error:
+                raise RuntimeError(event.sent.error)
+            results += 1
+            if event.sent.id == arguments.messages:
+                break
+    chat = time.perf_counter() - start_time
+
+    async def batch():
+        for text in texts:
+            yield pb2.MessageInfo(destination='receiver', source='sender', text=text)
+
+    start_time = time.perf_counter()
+    summary = await stub.SendMessages(batch())
+    if summary.delivered != arguments.messages:
+        raise RuntimeError(summary.errors[0].error)
+    batched = time.perf_counter() - start_time
+    await channel.close()
+
+    return {
+        'unary': {'seconds': round(unary, 3), 'per_second': round(arguments.messages / unary)},
+        'chat': {'seconds': round(chat, 3), 'per_second': round(arguments.messages / chat), 'send_results': results},
+        'batch': {'seconds': round(batched, 3), 'per_second': round(arguments.messages / batched)},
+    }
+
+
+def parse_arguments(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--server', choices=['aio', 'threaded'], default='aio', help="server to spawn")
+
+    parser = argparse.ArgumentParser(description="Run a load test against a gRPC chat server.")
+    workloads = parser.add_subparsers(dest='workload', required=True)
+
+    streams_parser = workloads.add_parser('streams', parents=[common], help="unary latency as listener streams are opened")
+    streams_parser.add_argument('--streams', type=int, nargs='+', default=[0, 10, 100, 1000, 5000],
+                                help="numbers of open listener streams to measure at")
+    streams_parser.add_argument('--calls', type=int, default=500, help="SendMessage calls timed at each step")
+    streams_parser.add_argument('--timeout', type=float, default=2, help="seconds before a call counts as timed out")
+    streams_parser.set_defaults(run=open_streams)
+
+    send_parser = workloads.add_parser('send', parents=[common], help="messages per second: unary calls, a Chat session and a SendMessages batch")
+    send_parser.add_argument('--messages', type=int, default=10000, help="messages sent each way")
+    send_parser.add_argument('--size', type=int, default=100, help="characters in each message")
+    send_parser.set_defaults(run=send_throughput)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    parameters = {name: value for name, value in vars(arguments).items() if name != 'run'}
+    with spawned_server(arguments.server) as address:
+        results = asyncio.run(arguments.run(arguments, address))
+    print(json.dumps({'parameters': parameters, 'results': results}, indent=2))
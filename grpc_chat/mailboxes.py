@@ -0,0 +1,56 @@
+from collections import deque, namedtuple
+
+# A message in a mailbox: its sequence number, sender and text
+Mail = namedtuple('Mail', ['seq', 'source', 'text'])
+
+
+class Mailbox:
+    '''
+    The messages sent to one user, numbered 1, 2, 3... in the order they arrived
+    and kept until the user acknowledges them. A listener streams the messages
+    after the last one it has sent; one that reconnects starts again after the
+    last acknowledged message, so a message is delivered at least once even if
+    the stream broke before the client got it.
+
+    Appending and trimming acknowledged messages are O(1) per message, and
+    reading the k messages after a listener's position is O(k). Not thread
+    safe: the servers guard each mailbox with the user's condition.
+    '''
+
+    def __init__(self):
+        self.messages = deque()  # Unacknowledged messages, oldest first, with consecutive sequence numbers
+        self.last_seq = 0        # Sequence number of the newest message, or 0 if none has arrived
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, source, text):
+        '''Adds a message at the end, returning its sequence number'''
+
+        self.last_seq += 1
+        self.messages.append(Mail(self.last_seq, source, text))
+        return self.last_seq
+
+    def extend(self, messages):
+        '''Adds (source, text) pairs at the end, in order'''
+
+        for source, text in messages:
+            self.last_seq += 1
+            self.messages.append(Mail(self.last_seq, source, text))
+
+    def ack(self, seq):
+        '''Drops every message up to and including seq'''
+
+        while self.messages and self.messages[0].seq <= seq:
+            self.messages.popleft()
+
+    def after(self, seq):
+        '''Returns the messages after seq, oldest first'''
+
+        mail = []
+        for message in reversed(self.messages):
+            if message.seq <= seq:
+                break
+            mail.append(message)
+        mail.reverse()
+        return mail
@@ -1,4 +1,5 @@
 import grpc
+import argparse
 from concurrent import futures
 import time
 import chat_pb2_grpc as pb2_grpc
@@ -6,6 +7,7 @@ import chat_pb2 as pb2
 import threading
 import re
 import socket
+from mailboxes import Mailbox
 
 # Associates a unique username with a password
 accounts = {}
@@ -13,9 +15,49 @@ accounts = {}
 # Associates a username with a logged-in status
 accounts_status = {}
 
-# Associates a user with a dictionary storing senders : list of messages
+# Associates a user with the Mailbox of messages sent to them and not yet acknowledged
 accounts_queue = {}
 
+# Associates a user with a condition variable guarding their mailbox, notified when
+# a message arrives for them or they log out, so their listener can sleep until then
+accounts_wakeup = {}
+
+
+def wake(username):
+    '''Wakes the user's listening streams to check their mailbox and logged-in status'''
+
+    wakeup = accounts_wakeup.get(username)
+    if wakeup is not None:
+        with wakeup:
+            wakeup.notify_all()
+
+
+def check_send(source, destination):
+    '''Returns None if source may send to destination, or an error message saying why not'''
+
+    # If the source is not logged in, return an error
+    if source not in accounts or accounts_status[source] == False:
+        return "Error: username not valid or not logged in"
+
+    # If the destination is not a valid account, return an error
+    if destination not in accounts:
+        return "Error: destination not valid"
+    return None
+
+
+def deliver(source, destination, text):
+    '''Puts a message into the destination user's mailbox, returning None, or an error message if it can't be sent'''
+
+    error = check_send(source, destination)
+    if error is not None:
+        return error
+
+    with accounts_wakeup[destination]:
+        accounts_queue[destination].append(source, text)
+        accounts_wakeup[destination].notify_all()
+    return None
+
+
 class ChatService(pb2_grpc.ChatServicer):
     def __init__(self, *args, **kwargs):
         pass
@@ -31,7 +73,8 @@ class ChatService(pb2_grpc.ChatServicer):
         if username not in accounts:
             accounts[username] = password
             accounts_status[username] = False
-            accounts_queue[username] = {}
+            accounts_queue[username] = Mailbox()
+            accounts_wakeup[username] = threading.Condition()
             result = f'{username} added'
             response = {'message': result, 'error': False}
         else:
@@ -59,6 +102,9 @@ class ChatService(pb2_grpc.ChatServicer):
             return pb2.ServerResponse(**response)
 
         del(accounts[username])
+        # End the deleted account's listening streams
+        accounts_status[username] = False
+        wake(username)
         result = f'{username} deleted'
         response = {'message': result, 'error': False}
         return pb2.ServerResponse(**response)
@@ -92,6 +138,7 @@ class ChatService(pb2_grpc.ChatServicer):
         
         username = request.username
         accounts_status[username] = False
+        wake(username)
         result = f'{username}, you are logged out'
         response = {'message': result, 'error': False}
         return pb2.ServerResponse(**response)
@@ -112,49 +159,192 @@ class ChatService(pb2_grpc.ChatServicer):
 
 
     def SendMessage(self, request, context):
-        '''Puts message into the destination user's queue'''
-
-        destination = request.destination
-        source = request.source
-        text = request.text
+        '''Puts message into the destination user's mailbox'''
 
-        # If the source is not logged in, return an error
-        if source not in accounts or accounts_status[source] == False:
-            result = "Error: username not valid or not logged in"
-            response = {'message': result, 'error': True}
+        error = deliver(request.source, request.destination, request.text)
+        if error is not None:
+            response = {'message': error, 'error': True}
             return pb2.ServerResponse(**response)
 
-        # If the destination is not a valid account, return an error
-        if destination not in accounts:
-            result = "Error: destination not valid"
-            response = {'message': result, 'error': True}
-            return pb2.ServerResponse(**response)
-            
-        if source not in accounts_queue[destination]:
-            accounts_queue[destination][source] = [text]
-        else:
-            accounts_queue[destination][source].append(text)
         result = "Message Sent"
         response = {'message': result, 'error': False}
         return pb2.ServerResponse(**response)
 
 
     def ListenMessages(self, request, context):
+        '''
+        Streams the user's messages to them, starting after the last one they
+        acknowledged, until they log out or the call ends. Between messages the
+        stream sleeps on the user's condition variable, which SendMessage and
+        Logout notify, so an idle listener costs no CPU. Messages stay in the
+        mailbox until acknowledged, so a stream that breaks before the client
+        received them sends them again when it reconnects.
+        '''
         username = request.username
-        
-        while accounts_status[username] == True:
-            myDict = accounts_queue[username]
-            for sender in list(myDict):
-                for msg in myDict[sender]:
-                    response = {'destination': username, 'source': sender, 'text': msg}
-                    yield pb2.MessageInfo(**response)
-                    myDict[sender].remove(msg)
+        wakeup = accounts_wakeup.get(username)
+        if wakeup is None:
+            return
+        mailbox = accounts_queue[username]
+
+        def listening():
+            return accounts_status.get(username) == True and context.is_active()
+
+        def cancelled():
+            with wakeup:
+                wakeup.notify_all()
+
+        # Wake the stream when the client cancels it or the server shuts it down
+        context.add_callback(cancelled)
+        with wakeup:
+            mailbox.ack(request.acked)
+            sent = min(request.acked, mailbox.last_seq)
+        while True:
+            with wakeup:
+                wakeup.wait_for(lambda: mailbox.last_seq > sent or not listening())
+                if not listening():
+                    return
+                mail = mailbox.after(sent)
+            for message in mail:
+                response = {'destination': username, 'source': message.source, 'text': message.text, 'seq': message.seq}
+                yield pb2.MessageInfo(**response)
+                sent = message.seq
+
+
+    def AckMessages(self, request, context):
+        '''Drops the user's messages up to and including the acknowledged one'''
+
+        username = request.username
+        if username not in accounts:
+            result = f'{username} is not an existing username'
+            response = {'message': result, 'error': True}
+            return pb2.ServerResponse(**response)
+
+        with accounts_wakeup[username]:
+            accounts_queue[username].ack(request.seq)
+        result = f'Acknowledged up to {request.seq}'
+        response = {'message': result, 'error': False}
+        return pb2.ServerResponse(**response)
+
+
+    def Chat(self, request_iterator, context):
+        '''
+        A two-way session on one stream. The client first sends a ListenRequest,
+        then messages to send as its user and acks of its user's messages, without
+        waiting for replies; the server streams back the user's messages as
+        ListenMessages would, and SendResults for the messages the session sent.
+        Sends that go through are reported together, as one SendResult covering
+        every message handled since the last, so a session sending quickly gets
+        few of them; a failed send is reported on its own, after a SendResult
+        covering the sends before it. The session ends when the user logs out, the call is
+        cancelled, or the client stops sending and every send has been reported.
+        '''
+        first = next(request_iterator, None)
+        if first is None or first.WhichOneof('request') != 'listen':
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'A chat session must start with a listen request')
+        username = first.listen.username
+        wakeup = accounts_wakeup.get(username)
+        if wakeup is None or accounts_status.get(username) != True:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, f'{username} is not logged in')
+        mailbox = accounts_queue[username]
+
+        # Guarded by the user's condition, which is notified when they change
+        handled = 0       # Messages the session has sent so far
+        failures = []     # SendResults for failed sends not reported yet
+        finished = False  # Whether the client has stopped sending
+
+        def read():
+            '''Handles the client's requests as they arrive'''
+
+            nonlocal handled, finished
+            try:
+                for request in request_iterator:
+                    kind = request.WhichOneof('request')
+                    if kind == 'message':
+                        error = deliver(username, request.message.destination, request.message.text)
+                        with wakeup:
+                            handled += 1
+                            if error is not None:
+                                failures.append(pb2.SendResult(id=handled, error=error))
+                            wakeup.notify_all()
+                    elif kind == 'ack':
+                        with wakeup:
+                            mailbox.ack(request.ack)
+            except grpc.RpcError:
+                # The call was cancelled
+                pass
+            finally:
+                with wakeup:
+                    finished = True
+                    wakeup.notify_all()
+
+        def listening():
+            return accounts_status.get(username) == True and context.is_active()
+
+        def cancelled():
+            with wakeup:
+                wakeup.notify_all()
+
+        context.add_callback(cancelled)
+        with wakeup:
+            mailbox.ack(first.listen.acked)
+            sent = min(first.listen.acked, mailbox.last_seq)
+        reported = 0  # Messages the session has been told the outcome of
+        threading.Thread(target=read, daemon=True).start()
+        while True:
+            with wakeup:
+                wakeup.wait_for(lambda: mailbox.last_seq > sent or handled > reported or finished or not listening())
+                if not listening():
+                    return
+                mail = mailbox.after(sent)
+                failed = failures[:]
+                failures.clear()
+                done, ended = handled, finished
+            for message in mail:
+                response = {'destination': username, 'source': message.source, 'text': message.text, 'seq': message.seq}
+                yield pb2.ChatEvent(message=pb2.MessageInfo(**response))
+                sent = message.seq
+            for result in failed:
+                # Report the sends that went through before this one first
+                if result.id - 1 > reported:
+                    yield pb2.ChatEvent(sent=pb2.SendResult(id=result.id - 1))
+                yield pb2.ChatEvent(sent=result)
+                reported = result.id
+            if done > reported:
+                yield pb2.ChatEvent(sent=pb2.SendResult(id=done))
+                reported = done
+            if ended:
+                return
+
+
+    def SendMessages(self, request_iterator, context):
+        '''
+        Puts a stream of messages into their destinations' mailboxes, answering
+        once with a SendSummary: how many were delivered, and an error for each
+        of the others by its index in the stream. The messages are grouped by
+        destination as they arrive, and each destination's are then appended
+        to its mailbox together, waking its listeners once.
+        '''
+        batches = {}  # Maps destination to the (source, text) pairs for it, in order
+        errors = []
+        for index, request in enumerate(request_iterator):
+            error = check_send(request.source, request.destination)
+            if error is not None:
+                errors.append(pb2.SendError(index=index, error=error))
+            else:
+                batches.setdefault(request.destination, []).append((request.source, request.text))
+
+        for destination, messages in batches.items():
+            with accounts_wakeup[destination]:
+                accounts_queue[destination].extend(messages)
+                accounts_wakeup[destination].notify_all()
+        delivered = sum(len(messages) for messages in batches.values())
+        return pb2.SendSummary(delivered=delivered, errors=errors)
 
 
-def serve():
+def serve(address='[::]:50051'):
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10)) # 10 threads
     pb2_grpc.add_ChatServicer_to_server(ChatService(), server) # Add service to server
-    server.add_insecure_port('[::]:50051')
+    server.add_insecure_port(address)
     server.start()
     host = socket.gethostbyname(socket.gethostname())
     print(f'Server started on {host}')
@@ -162,4 +352,6 @@ def serve():
 
 
 if __name__ == '__main__':
-    serve()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the chat service on a pool of worker threads")
+    parser.add_argument('--address', default='[::]:50051', help="address to listen on")
+    serve(parser.parse_args().address)
\ No newline at end of file
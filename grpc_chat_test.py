@@ -0,0 +1,313 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+from concurrent import futures
+from queue import Queue
+from threading import Event, Thread
+
+import grpc
+
+# The gRPC implementation imports its generated modules by their bare names
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grpc_chat'))
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from grpc_chat import aio_server, server as chat_server
+from grpc_chat.client import ChatClient
+from grpc_chat.mailboxes import Mailbox, Mail
+
+
+class TestMailbox(unittest.TestCase):
+    def test_After_and_ack_Keep_unacknowledged_messages_in_order(self):
+        mailbox = Mailbox()
+        self.assertEqual([mailbox.append('a', str(i)) for i in range(5)], [1, 2, 3, 4, 5])
+        self.assertEqual(mailbox.after(3), [Mail(4, 'a', '3'), Mail(5, 'a', '4')])
+        self.assertEqual(mailbox.after(5), [])
+        mailbox.ack(2)
+        self.assertEqual(mailbox.after(0), [Mail(3, 'a', '2'), Mail(4, 'a', '3'), Mail(5, 'a', '4')])
+        mailbox.ack(9)
+        self.assertEqual((len(mailbox), mailbox.append('b', 'x')), (0, 6))
+
+
+class TestListenMessages(unittest.TestCase):
+    def setUp(self):
+        for state in (chat_server.accounts, chat_server.accounts_status, chat_server.accounts_queue,
+                      chat_server.accounts_wakeup):
+            state.clear()
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        pb2_grpc.add_ChatServicer_to_server(chat_server.ChatService(), self.server)
+        port = self.server.add_insecure_port('127.0.0.1:0')
+        self.server.start()
+        self.channel = grpc.insecure_channel(f'127.0.0.1:{port}')
+        self.stub = pb2_grpc.ChatStub(self.channel)
+        for name in ('alice', 'bob'):
+            self.stub.CreateAccount(pb2.Account(username=name, password='pw'))
+            self.stub.Login(pb2.Account(username=name, password='pw'))
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(None)
+
+    def listen(self, username):
+        """Open a listening stream, returning the call and a queue its messages (then None) are put on"""
+
+        call = self.stub.ListenMessages(pb2.ListenRequest(username=username))
+        received = Queue()
+
+        def receive():
+            try:
+                for message in call:
+                    received.put(message)
+            except grpc.RpcError:
+                pass
+            received.put(None)
+
+        Thread(target=receive, daemon=True).start()
+        return call, received
+
+    def send(self, text):
+        return self.stub.SendMessage(pb2.MessageInfo(destination='bob', source='alice', text=text))
+
+    def test_Listen_Idle_stream_Sleeps_until_message_arrives(self):
+        call, received = self.listen('bob')
+        self.send('queued before')
+        self.assertEqual(received.get(timeout=5).text, 'queued before')
+
+        start = time.process_time()
+        time.sleep(0.5)
+        self.assertLess(time.process_time() - start, 0.1)
+
+        sent = time.perf_counter()
+        self.send('hello')
+        message = received.get(timeout=5)
+        self.assertLess(time.perf_counter() - sent, 0.5)
+        self.assertEqual((message.source, message.destination, message.text), ('alice', 'bob', 'hello'))
+        call.cancel()
+
+    def test_Listen_Logout_Ends_stream_leaving_later_messages_queued(self):
+        call, received = self.listen('bob')
+        self.stub.Logout(pb2.Account(username='bob'))
+        self.assertIsNone(received.get(timeout=5))
+        self.send('while away')
+        self.assertEqual(chat_server.accounts_queue['bob'].after(0), [Mail(1, 'alice', 'while away')])
+
+    def test_Listen_Reconnecting_Resumes_after_last_ack_without_loss_or_reordering(self):
+        senders = [f'sender{i}' for i in range(4)]
+        for name in senders:
+            self.stub.CreateAccount(pb2.Account(username=name, password='pw'))
+            self.stub.Login(pb2.Account(username=name, password='pw'))
+
+        def send(source):
+            for n in range(200):
+                self.stub.SendMessage(pb2.MessageInfo(destination='bob', source=source, text=str(n)))
+
+        threads = [Thread(target=send, args=(name,)) for name in senders]
+        for thread in threads:
+            thread.start()
+
+        # Read a few messages per stream, acknowledging only some, then drop the stream and reconnect
+        received, acked, texts = [], 0, {}
+        while len(received) < 800:
+            call = self.stub.ListenMessages(pb2.ListenRequest(username='bob', acked=acked), timeout=10)
+            for i, message in enumerate(call):
+                # A message is sent again after a reconnect unless it was acknowledged, always with the same number
+                self.assertEqual(texts.setdefault(message.seq, (message.source, message.text)),
+                                 (message.source, message.text))
+                if message.seq > len(received):
+                    self.assertEqual(message.seq, len(received) + 1)
+                    received.append((message.source, int(message.text)))
+                if i % 10 == 9:
+                    self.stub.AckMessages(pb2.Ack(username='bob', seq=message.seq))
+                    acked = message.seq
+                if i == 36 or len(received) == 800:
+                    break
+            call.cancel()
+        for thread in threads:
+            thread.join()
+
+        for name in senders:
+            self.assertEqual([n for source, n in received if source == name], list(range(200)))
+        self.assertLessEqual(len(chat_server.accounts_queue['bob']), 800 - acked)
+
+    def test_Chat_Session_Delivers_sends_reports_results_and_takes_acks(self):
+        self.stub.SendMessage(pb2.MessageInfo(destination='bob', source='alice', text='queued'))
+
+        def requests():
+            yield pb2.ChatRequest(listen=pb2.ListenRequest(username='bob'))
+            for n in range(100):
+                yield pb2.ChatRequest(message=pb2.MessageInfo(destination='nobody' if n == 41 else 'alice', text=str(n)))
+            yield pb2.ChatRequest(ack=1)
+
+        events = list(self.stub.Chat(requests(), timeout=10))
+        self.assertEqual(events[0].message, pb2.MessageInfo(destination='bob', source='alice', text='queued', seq=1))
+        results = [event.sent for event in events[1:]]
+        self.assertEqual([r.id for r in results if r.error], [42])
+        self.assertEqual([r.id for r in results], sorted(r.id for r in results))
+        self.assertEqual(results[-1], pb2.SendResult(id=100))
+        self.assertEqual([m.text for m in chat_server.accounts_queue['alice'].after(0)],
+                         [str(n) for n in range(100) if n != 41])
+        self.assertEqual(len(chat_server.accounts_queue['bob']), 0)
+
+    def test_Chat_Last_send_of_batch_fails_Earlier_sends_still_reported(self):
+        # Enough queued mail that the stream is held up by flow control while the sends are handled, so they are grouped
+        for n in range(1000):
+            chat_server.accounts_queue['bob'].append('alice', 'x' * 1000)
+        receiving = Event()
+
+        def requests():
+            yield pb2.ChatRequest(listen=pb2.ListenRequest(username='bob'))
+            receiving.wait(5)
+            for n in range(100):
+                yield pb2.ChatRequest(message=pb2.MessageInfo(destination='nobody' if n == 99 else 'alice', text=str(n)))
+
+        results = []
+        for event in self.stub.Chat(requests(), timeout=10):
+            if not receiving.is_set():
+                receiving.set()
+                time.sleep(0.5)
+            if event.WhichOneof('event') == 'sent':
+                results.append(event.sent)
+        self.assertLess(len(results), 100)
+        self.assertEqual(results[-2:], [pb2.SendResult(id=99), pb2.SendResult(id=100, error='Error: destination not valid')])
+
+    def test_Chat_Not_starting_with_listen_Rejected(self):
+        requests = iter([pb2.ChatRequest(message=pb2.MessageInfo(destination='alice', text='hi'))])
+        with self.assertRaises(grpc.RpcError) as raised:
+            list(self.stub.Chat(requests, timeout=5))
+        self.assertEqual(raised.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_Send_messages_Batch_Delivers_in_order_and_reports_errors_by_index(self):
+        client = ChatClient('127.0.0.1')
+        client.stub = self.stub
+        batch = [('nobody' if n % 100 == 7 else ('bob', 'alice')[n % 2], 'alice', str(n)) for n in range(1000)]
+        batch.append(('bob', 'mallory', 'not logged in'))
+
+        summary = client.send_messages(batch)
+        self.assertEqual(summary.delivered, 990)
+        self.assertEqual([(e.index, e.error) for e in summary.errors],
+                         [(n, 'Error: destination not valid') for n in range(7, 1000, 100)]
+                         + [(1000, 'Error: username not valid or not logged in')])
+        for name in ('alice', 'bob'):
+            self.assertEqual([m.text for m in chat_server.accounts_queue[name].after(0)],
+                             [text for destination, _, text in batch if destination == name and text[0].isdigit()])
+        self.assertEqual(chat_server.accounts_queue['bob'].last_seq, 500)
+
+    def test_Listen_Cancelled_Frees_its_worker(self):
+        calls = [self.listen('bob')[0] for _ in range(4)]
+        time.sleep(0.2)
+        for call in calls:
+            call.cancel()
+        # Every worker was held by a stream; once they are freed a unary call gets through
+        response = self.stub.ListAccounts(pb2.SearchTerm(searchterm='a'), timeout=5)
+        self.assertEqual(response.usernames, 'alice')
+
+
+class TestAsyncChatService(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        for state in (aio_server.accounts, aio_server.accounts_status, aio_server.accounts_queue,
+                      aio_server.accounts_wakeup):
+            state.clear()
+        self.server = grpc.aio.server()
+        pb2_grpc.add_ChatServicer_to_server(aio_server.AsyncChatService(), self.server)
+        port = self.server.add_insecure_port('127.0.0.1:0')
+        await self.server.start()
+        self.channel = grpc.aio.insecure_channel(f'127.0.0.1:{port}')
+        self.stub = pb2_grpc.ChatStub(self.channel)
+
+    async def asyncTearDown(self):
+        await self.channel.close()
+        await self.server.stop(None)
+
+    async def login(self, username):
+        account = pb2.Account(username=username, password='pw')
+        await self.stub.CreateAccount(account)
+        await self.stub.Login(account)
+        return account
+
+    async def test_Listen_Many_streams_Unary_calls_still_answered(self):
+        await self.login('alice')
+        accounts = [await self.login(f'listener{i}') for i in range(50)]
+        calls = [self.stub.ListenMessages(pb2.ListenRequest(username=account.username)) for account in accounts]
+        replies = [asyncio.ensure_future(call.read()) for call in calls]
+
+        # More streams are open than server.py has worker threads, yet unary calls are answered
+        for account in accounts:
+            response = await self.stub.SendMessage(
+                pb2.MessageInfo(destination=account.username, source='alice', text='hi'), timeout=5)
+            self.assertFalse(response.error)
+        messages = await asyncio.wait_for(asyncio.gather(*replies), 5)
+        self.assertEqual([(m.destination, m.text) for m in messages], [(a.username, 'hi') for a in accounts])
+
+        for call in calls:
+            call.cancel()
+
+    async def test_Listen_Logout_Ends_stream(self):
+        account = await self.login('bob')
+        call = self.stub.ListenMessages(pb2.ListenRequest(username='bob'))
+        await asyncio.sleep(0.1)
+        await self.stub.Logout(account)
+        self.assertIs(await asyncio.wait_for(call.read(), 5), grpc.aio.EOF)
+        self.assertEqual(await call.code(), grpc.StatusCode.OK)
+
+    async def test_Chat_Session_Receives_while_sending(self):
+        await self.login('alice')
+        await self.login('bob')
+        received = asyncio.Event()
+
+        async def requests():
+            yield pb2.ChatRequest(listen=pb2.ListenRequest(username='bob'))
+            yield pb2.ChatRequest(message=pb2.MessageInfo(destination='alice', text='first'))
+            await received.wait()
+            yield pb2.ChatRequest(message=pb2.MessageInfo(destination='nobody', text='second'))
+
+        call = self.stub.Chat(requests())
+        self.assertEqual((await call.read()).sent, pb2.SendResult(id=1))
+        await self.stub.SendMessage(pb2.MessageInfo(destination='bob', source='alice', text='reply'))
+        self.assertEqual((await call.read()).message.text, 'reply')
+        received.set()
+        self.assertEqual((await call.read()).sent, pb2.SendResult(id=2, error='Error: destination not valid'))
+        self.assertIs(await call.read(), grpc.aio.EOF)
+
+    async def test_Chat_Last_send_of_batch_fails_Earlier_sends_still_reported(self):
+        await self.login('alice')
+        await self.login('bob')
+
+        for n in range(1000):
+            aio_server.accounts_queue['bob'].append('alice', 'x' * 1000)
+        receiving = asyncio.Event()
+
+        async def requests():
+            yield pb2.ChatRequest(listen=pb2.ListenRequest(username='bob'))
+            await receiving.wait()
+            for n in range(100):
+                yield pb2.ChatRequest(message=pb2.MessageInfo(destination='nobody' if n == 99 else 'alice', text=str(n)))
+
+        results = []
+        async for event in self.stub.Chat(requests(), timeout=10):
+            if not receiving.is_set():
+                receiving.set()
+                await asyncio.sleep(0.5)
+            if event.WhichOneof('event') == 'sent':
+                results.append(event.sent)
+        self.assertLess(len(results), 100)
+        self.assertEqual(results[-2:], [pb2.SendResult(id=99), pb2.SendResult(id=100, error='Error: destination not valid')])
+
+    async def test_Send_messages_Wakes_listener_with_whole_batch(self):
+        await self.login('alice')
+        account = await self.login('bob')
+        call = self.stub.ListenMessages(pb2.ListenRequest(username='bob'))
+
+        async def batch():
+            for n in range(3):
+                yield pb2.MessageInfo(destination='bob', source='alice', text=str(n))
+            yield pb2.MessageInfo(destination='nobody', source='alice', text='lost')
+
+        summary = await self.stub.SendMessages(batch())
+        self.assertEqual(summary, pb2.SendSummary(delivered=3, errors=[pb2.SendError(index=3, error='Error: destination not valid')]))
+        self.assertEqual([(await call.read()).seq for _ in range(3)], [1, 2, 3])
+        await self.stub.Logout(account)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,421 @@
+"""Compact, columnar storage for message history.
+
+Each conversation (one sender to one recipient) keeps its messages in three
+columns instead of one object per message:
+
+- the UTF-8 text of every message, back to back in one `bytearray`;
+- an `array` of the offsets where each message's text ends;
+- an `array` of timestamps as minutes since 0001-01-01, parsed from `TIME_FORMAT`
+  strings. A time string that isn't in that format is kept verbatim in a small
+  side table, so every message reads back exactly as it was sent.
+
+Usernames are interned to integer user ids, which key the conversations. Reading
+a message builds a `UserMessage` for it on the fly, so `history[sender][recipient]`
+still behaves like the list of `UserMessage`s it replaces.
+
+Each conversation is also indexed by time. While messages arrive in time order
+(the usual case) the timestamp column is itself sorted and serves as the index.
+The first message that arrives out of order switches the conversation to an
+explicit `order` array of message indices sorted by time. Either way a time
+range is found by binary search, so `MessageHistory.newest_first` reads the k
+newest messages of a range in O(log n + k).
+
+Retention (see retention.py) expires the oldest messages of a conversation with
+`expire`. The columns are cut from the front, and message offsets in `ends`
+are absolute (counted from the first message ever stored), so nothing left
+behind has to be renumbered. Ranks stay absolute too, so a HISTORY cursor
+still finds its place after older messages have expired.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping, Sequence
+from datetime import date
+from functools import lru_cache
+from operator import itemgetter
+import heapq
+import threading
+from config import *
+
+IRREGULAR_TIME = -1  # Timestamp column value for a time kept verbatim in `Conversation.irregular_times`
+
+
+class UserMessage:
+    """A message from `sender` to `recipient`, sent at `time`"""
+
+    __slots__ = ('sender', 'recipient', 'message', 'time')
+
+    def __init__(self, sender, recipient, message, time):
+        self.sender = sender
+        self.recipient = recipient
+        self.message = message
+        self.time = time
+
+    def __eq__(self, other):
+        return self.sender == other.sender and\
+            self.recipient == other.recipient and\
+            self.message == other.message and\
+            self.time == other.time
+
+    def __repr__(self):
+        return f"UserMessage({self.sender!r}, {self.recipient!r}, {self.message!r}, {self.time!r})"
+
+
+@lru_cache(maxsize=4096)
+def day_text(day):
+    """Format a day number (proleptic Gregorian ordinal) as YYYY-MM-DD"""
+
+    return date.fromordinal(day).isoformat()
+
+
+@lru_cache(maxsize=4096)
+def day_number(text):
+    """Parse YYYY-MM-DD into a day number, returning None for anything else"""
+
+    try:
+        day = date.fromisoformat(text).toordinal()
+    except ValueError:
+        return None
+    # fromisoformat also accepts other ISO spellings, which would not read back the same
+    return day if day_text(day) == text else None
+
+
+def encode_time(text):
+    """Return a `TIME_FORMAT` time string as minutes since 0001-01-01, or IRREGULAR_TIME if it isn't in that format"""
+
+    if len(text) != 16 or text[10] != ' ' or text[13] != ':':
+        return IRREGULAR_TIME
+    day = day_number(text[:10])
+    hour, minute = text[11:13], text[14:16]
+    if day is None or not (hour.isascii() and hour.isdigit() and minute.isascii() and minute.isdigit()):
+        return IRREGULAR_TIME
+    hour, minute = int(hour), int(minute)
+    if hour > 23 or minute > 59:
+        return IRREGULAR_TIME
+    return day * 1440 + hour * 60 + minute
+
+
+def decode_time(minutes):
+    """Format minutes since 0001-01-01 as a `TIME_FORMAT` time string"""
+
+    day, minute = divmod(minutes, 1440)
+    return f"{day_text(day)} {minute // 60:02d}:{minute % 60:02d}"
+
+
+class Conversation(Sequence):
+    """Every message one user has sent another, oldest first, stored as columns"""
+
+    __slots__ = ('sender', 'recipient', 'text', 'text_start', 'ends', 'times', 'irregular_times', 'order', 'expired')
+
+    def __init__(self, sender, recipient):
+        self.sender = sender
+        self.recipient = recipient
+        self.text = bytearray()     # UTF-8 text of every message, concatenated
+        self.text_start = 0         # Offset of `text[0]` in the text of every message ever stored, including expired ones
+        self.ends = array('Q')      # Offset where each message ends, counted like `text_start`
+        self.times = array('q')     # When each message was sent, in minutes (see `encode_time`)
+        self.irregular_times = None  # Maps message index to a time string that could not be encoded
+        self.order = None           # Message indices sorted by time; None while `times` is already sorted
+        self.expired = 0            # Number of messages expired from the front of the conversation
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Conversation index out of range")
+        return UserMessage(self.sender, self.recipient, self.message_text(index), self.time_text(index))
+
+    def message_text(self, index):
+        """Return the text of message `index`"""
+
+        start = self.ends[index - 1] if index else self.text_start
+        return self.text[start - self.text_start:self.ends[index] - self.text_start].decode()
+
+    def time_text(self, index):
+        """Return the time string of message `index`"""
+
+        minutes = self.times[index]
+        if minutes == IRREGULAR_TIME:
+            return self.irregular_times[index]
+        return decode_time(minutes)
+
+    def append(self, message):
+        """Store a `UserMessage` at the end of the conversation"""
+
+        self.add(message.message, message.time)
+
+    def add(self, message, time):
+        """Store the text and time string of a new message at the end of the conversation"""
+
+        minutes = encode_time(time)
+        if minutes == IRREGULAR_TIME:
+            if self.irregular_times is None:
+                self.irregular_times = {}
+            self.irregular_times[len(self)] = time
+        index = len(self)
+        self.text += message.encode()
+        self.times.append(minutes)
+        if self.order is None and index and minutes < self.times[index - 1]:
+            self.order = array('Q', sorted(range(index), key=self.times.__getitem__))
+        if self.order is not None:
+            # After any messages with the same time, so ties stay in arrival order
+            self.order.insert(bisect_right(self.order, minutes, key=self.times.__getitem__), index)
+        # Appended last, so concurrent readers never see a message without its text and time
+        self.ends.append(self.text_start + len(self.text))
+
+    def time_rank(self, minutes, after=False):
+        """Return how many stored messages are earlier than `minutes` (or no later than it, if `after`)"""
+
+        bisect = bisect_right if after else bisect_left
+        if self.order is None:
+            return bisect(self.times, minutes, 0, len(self))
+        return bisect(self.order, minutes, key=self.times.__getitem__)
+
+    def newest_first(self, start=None, end=None, before=None):
+        """Yield (minutes, rank, index) for messages sent from `start` to `end` minutes (inclusive), newest first.
+
+        A message's rank is its position in time order, counting expired messages.
+        Only ranks below `before` are yielded, which lets a later call resume where
+        an earlier one stopped.
+        """
+
+        high = len(self) if end is None else self.time_rank(end, after=True)
+        if before is not None:
+            high = min(high, before - self.expired)
+        low = 0 if start is None else self.time_rank(start)
+        count = len(self)
+        for rank in range(high - 1, low - 1, -1):
+            index = rank if self.order is None else self.order[rank]
+            # Skip a message still being appended by another thread
+            if index < count:
+                yield self.times[index], rank + self.expired, index
+
+    def expirable(self, max_messages=None, cutoff=None, max_bytes=None):
+        """Return how many of the oldest messages are past the retention limits.
+
+        Those are the messages beyond the newest `max_messages`, those sent before
+        `cutoff` minutes, and as many as must go to fit in `max_bytes`. A message
+        with an irregular time has no age, so it and the messages after it are kept
+        whatever their age.
+        """
+
+        count = 0 if max_messages is None else max(0, len(self) - max_messages)
+        if cutoff is not None:
+            times = self.times
+            while count < len(times) and 0 <= times[count] < cutoff:
+                count += 1
+        if max_bytes is not None and self.nbytes() > max_bytes:
+            excess = self.nbytes() - max_bytes
+            per_message = self.ends.itemsize + self.times.itemsize
+            freed = lambda k: self.ends[k - 1] - self.text_start + k * per_message
+            count = max(count, bisect_left(range(1, len(self) + 1), excess, key=freed) + 1)
+        return min(count, len(self))
+
+    def expire(self, count):
+        """Drop the `count` oldest messages"""
+
+        count = min(count, len(self))
+        if count <= 0:
+            return
+        cut = self.ends[count - 1]
+        del self.text[:cut - self.text_start]
+        self.text_start = cut
+        del self.ends[:count]
+        del self.times[:count]
+        if self.irregular_times:
+            self.irregular_times = {i - count: time for i, time in self.irregular_times.items() if i >= count} or None
+        if self.order is not None:
+            self.order = array('Q', (i - count for i in self.order if i >= count))
+        self.expired += count
+
+    def nbytes(self):
+        """Return roughly how many bytes the columns occupy"""
+
+        return len(self.text) + len(self.ends) * self.ends.itemsize + len(self.times) * self.times.itemsize
+
+    def export(self):
+        """Return the columns, and the count of expired messages that cursors rank by, as plain values for a snapshot"""
+
+        order = None if self.order is None else self.order.tobytes()
+        ends = self.ends if not self.text_start else array('Q', (end - self.text_start for end in self.ends))
+        return bytes(self.text), ends.tobytes(), self.times.tobytes(), dict(self.irregular_times or {}), order, self.expired
+
+    @classmethod
+    def load(cls, sender, recipient, columns):
+        """Rebuild a conversation from `export()`'s output"""
+
+        conversation = cls(sender, recipient)
+        text, ends, times, irregular_times, order, expired = columns
+        conversation.text[:] = text
+        conversation.ends.frombytes(ends)
+        conversation.times.frombytes(times)
+        conversation.irregular_times = irregular_times or None
+        if order is not None:
+            conversation.order = array('Q', order)
+        conversation.expired = expired
+        return conversation
+
+
+class UserIds:
+    """Interns usernames as small integer ids"""
+
+    def __init__(self):
+        self.ids = {}    # Maps username to id
+        self.names = []  # Maps id to username
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        """Return the id for `name`, assigning the next one if it has none yet"""
+
+        user_id = self.ids.get(name)
+        if user_id is None:
+            with self.lock:
+                user_id = self.ids.get(name)
+                if user_id is None:
+                    user_id = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = user_id
+        return user_id
+
+    def get(self, name):
+        """Return the id for `name`, or None if it has never been interned"""
+
+        return self.ids.get(name)
+
+
+class SenderHistory(Mapping):
+    """The conversations one user has started, keyed by recipient; a missing recipient gets an empty conversation"""
+
+    def __init__(self, history, sender):
+        self.history = history
+        self.sender = sender
+
+    def __getitem__(self, recipient):
+        return self.history.conversation(self.sender, recipient)
+
+    def __iter__(self):
+        names = self.history.user_ids.names
+        sender_id = self.history.user_ids.get(self.sender)
+        return (names[recipient_id] for recipient_id in list(self.history.senders.get(sender_id, ())))
+
+    def __len__(self):
+        return len(self.history.senders.get(self.history.user_ids.get(self.sender), ()))
+
+    def __contains__(self, recipient):
+        recipients = self.history.senders.get(self.history.user_ids.get(self.sender), {})
+        return self.history.user_ids.get(recipient) in recipients
+
+
+class MessageHistory(Mapping):
+    """Every message sent, as `history[sender][recipient]` -> `Conversation`, keyed internally by interned user ids"""
+
+    def __init__(self):
+        self.user_ids = UserIds()
+        self.senders = {}  # Maps sender id to {recipient id: Conversation}
+
+    def __getitem__(self, sender):
+        return SenderHistory(self, sender)
+
+    def __iter__(self):
+        names = self.user_ids.names
+        return (names[sender_id] for sender_id in list(self.senders))
+
+    def __len__(self):
+        return len(self.senders)
+
+    def __contains__(self, sender):
+        return self.user_ids.get(sender) in self.senders
+
+    def conversation(self, sender, recipient):
+        """Return the conversation from `sender` to `recipient`, creating it if needed"""
+
+        sender_id, recipient_id = self.user_ids.intern(sender), self.user_ids.intern(recipient)
+        recipients = self.senders.get(sender_id)
+        if recipients is None:
+            recipients = self.senders.setdefault(sender_id, {})
+        conversation = recipients.get(recipient_id)
+        if conversation is None:
+            names = self.user_ids.names
+            conversation = recipients.setdefault(recipient_id, Conversation(names[sender_id], names[recipient_id]))
+        return conversation
+
+    def find(self, sender, recipient):
+        """Return the conversation from `sender` to `recipient`, or None if there is none"""
+
+        recipients = self.senders.get(self.user_ids.get(sender))
+        if recipients is None:
+            return None
+        return recipients.get(self.user_ids.get(recipient))
+
+    def newest_first(self, user, other, start=None, end=None, cursor=''):
+        """Yield (UserMessage, cursor) for the messages between `user` and `other`, newest first.
+
+        Only messages sent from `start` to `end` minutes (inclusive, None for no bound)
+        are included. Passing the cursor yielded with a message resumes right after it.
+        The cursor pins the conversation as it was when the first page was read, so
+        messages sent since then don't shift later pages.
+        """
+
+        conversations = (self.find(user, other), self.find(other, user))
+        if cursor:
+            bounds = [int(bound) for bound in cursor.split('.')]
+            if len(bounds) != 2:
+                raise ValueError(f"Invalid history cursor {cursor!r}.")
+        else:
+            bounds = [0 if c is None else len(c) + c.expired for c in conversations]
+
+        def stream(direction, before):
+            for minutes, rank, index in conversations[direction].newest_first(start, end, before):
+                yield minutes, direction, rank, index
+
+        streams = [stream(direction, bounds[direction]) for direction, c in enumerate(conversations) if c is not None]
+
+        for minutes, direction, rank, index in heapq.merge(*streams, key=itemgetter(0), reverse=True):
+            bounds[direction] = rank
+            yield conversations[direction][index], f'{bounds[0]}.{bounds[1]}'
+
+    def append(self, message):
+        """Store a `UserMessage`"""
+
+        self.conversation(message.sender, message.recipient).append(message)
+
+    def clear(self):
+        self.user_ids = UserIds()
+        self.senders = {}
+
+    def conversations(self):
+        """Return a list of every conversation"""
+
+        return [conversation for recipients in list(self.senders.values()) for conversation in list(recipients.values())]
+
+    def message_count(self):
+        """Return the number of messages stored"""
+
+        return sum(len(c) for recipients in self.senders.values() for c in recipients.values())
+
+    def nbytes(self):
+        """Return roughly how many bytes the conversation columns occupy"""
+
+        return sum(c.nbytes() for recipients in self.senders.values() for c in recipients.values())
+
+    def export(self):
+        """Return every conversation as (sender, recipient, columns) for a snapshot"""
+
+        return [
+            (conversation.sender, conversation.recipient, conversation.export())
+            for recipients in list(self.senders.values()) for conversation in list(recipients.values())
+        ]
+
+    def load(self, conversations):
+        """Replace the history with conversations from `export()`'s output"""
+
+        self.clear()
+        names = self.user_ids.names
+        for sender, recipient, columns in conversations:
+            sender_id, recipient_id = self.user_ids.intern(sender), self.user_ids.intern(recipient)
+            recipients = self.senders.setdefault(sender_id, {})
+            recipients[recipient_id] = Conversation.load(names[sender_id], names[recipient_id], columns)
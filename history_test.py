@@ -0,0 +1,134 @@
+from history import MessageHistory, UserMessage, encode_time, decode_time, IRREGULAR_TIME
+import itertools
+import random
+import pickle
+import unittest
+
+
+class TestMessageHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = MessageHistory()
+
+    def test_Append_Messages_Read_back_as_user_messages(self):
+        sent = [UserMessage('a', 'b', 'hi|there', '2023-03-01 12:05'), UserMessage('a', 'b', 'héllo ✓', '1999-12-31 23:59')]
+        for message in sent:
+            self.history['a']['b'].append(message)
+        self.assertEqual(list(self.history['a']['b']), sent)
+        self.assertEqual(self.history['a']['b'][-1], sent[-1])
+        self.assertEqual(len(self.history['a']['b']), 2)
+
+    def test_Append_Irregular_time_Reads_back_verbatim(self):
+        for time in ('now', '2023-02-30 12:00', '2023-W01-1 1:00', '2023-03-01 24:00', '２０２３-03-01 12:00'):
+            self.history.append(UserMessage('a', 'b', 'x', time))
+        self.assertEqual([m.time for m in self.history['a']['b']],
+                         ['now', '2023-02-30 12:00', '2023-W01-1 1:00', '2023-03-01 24:00', '２０２３-03-01 12:00'])
+
+    def test_Encode_time_Round_trips_and_orders(self):
+        times = ['0001-01-01 00:00', '2023-03-01 09:59', '2023-03-01 10:00', '9999-12-31 23:59']
+        encoded = [encode_time(t) for t in times]
+        self.assertEqual([decode_time(m) for m in encoded], times)
+        self.assertEqual(encoded, sorted(encoded))
+        self.assertNotIn(IRREGULAR_TIME, encoded)
+
+    def test_Mapping_Only_lists_conversations_that_exist(self):
+        self.history.append(UserMessage('a', 'b', 'x', 'now'))
+        self.history.append(UserMessage('a', 'c', 'y', 'now'))
+        self.assertEqual(list(self.history), ['a'])
+        self.assertEqual(sorted(self.history['a']), ['b', 'c'])
+        self.assertNotIn('b', self.history)
+        self.assertNotIn('d', self.history['a'])
+        self.assertEqual(list(self.history['b']['a']), [])
+
+    def test_Export_Through_pickle_Load_restores_every_conversation(self):
+        for i in range(100):
+            self.history.append(UserMessage(f'u{i % 3}', f'u{i % 5}', f'message {i}', 'now' if i % 7 == 0 else '2023-03-01 12:00'))
+        restored = MessageHistory()
+        restored.load(pickle.loads(pickle.dumps(self.history.export())))
+        for sender in self.history:
+            for recipient in self.history[sender]:
+                self.assertEqual(list(restored[sender][recipient]), list(self.history[sender][recipient]))
+        self.assertEqual(restored.message_count(), 100)
+
+    def test_Interned_ids_Are_shared_between_senders_and_recipients(self):
+        self.history.append(UserMessage('a', 'b', 'x', 'now'))
+        self.history.append(UserMessage('b', 'a', 'y', 'now'))
+        self.assertEqual(self.history.user_ids.names, ['a', 'b'])
+
+    def test_Newest_first_Out_of_order_times_Merges_both_directions_by_time(self):
+        rng = random.Random(5)
+        sent = []
+        for i in range(300):
+            sender, recipient = rng.choice([('a', 'b'), ('b', 'a')])
+            message = UserMessage(sender, recipient, str(i), f'2023-03-01 {rng.randrange(24):02d}:{rng.randrange(60):02d}')
+            self.history.append(message)
+            sent.append(message)
+        self.history.append(UserMessage('a', 'c', 'elsewhere', '2023-03-01 12:00'))
+        result = [m for m, _ in self.history.newest_first('a', 'b')]
+        self.assertEqual([encode_time(m.time) for m in result], sorted((encode_time(m.time) for m in sent), reverse=True))
+        self.assertCountEqual([m.message for m in result], [m.message for m in sent])
+
+    def test_Newest_first_Time_range_Is_inclusive(self):
+        for hour in range(10):
+            self.history.append(UserMessage('a', 'b', str(hour), f'2023-03-01 {hour:02d}:00'))
+        start, end = encode_time('2023-03-01 03:00'), encode_time('2023-03-01 06:00')
+        self.assertEqual([m.message for m, _ in self.history.newest_first('b', 'a', start, end)], ['6', '5', '4', '3'])
+
+    def test_Newest_first_Cursor_Resumes_and_ignores_newer_messages(self):
+        for i in range(10):
+            self.history.append(UserMessage('a', 'b', str(i), f'2023-03-01 10:{i:02d}'))
+        pages = self.history.newest_first('a', 'b')
+        first = [next(pages) for _ in range(4)]
+        self.history.append(UserMessage('b', 'a', 'new', '2023-03-01 11:00'))
+        rest = [m.message for m, _ in self.history.newest_first('a', 'b', cursor=first[-1][1])]
+        self.assertEqual([m.message for m, _ in first], ['9', '8', '7', '6'])
+        self.assertEqual(rest, ['5', '4', '3', '2', '1', '0'])
+
+    def test_Expire_Oldest_messages_Dropped_and_rest_read_back(self):
+        sent = [UserMessage('a', 'b', f'message {i}', 'now' if i % 3 == 0 else f'2023-03-01 10:{59 - i:02d}') for i in range(20)]
+        for message in sent:
+            self.history.append(message)
+        conversation = self.history['a']['b']
+        conversation.expire(7)
+        self.assertEqual(list(conversation), sent[7:])
+        self.history.append(UserMessage('a', 'b', 'late', '2023-03-01 11:00'))
+        self.assertEqual(conversation[-1].message, 'late')
+        restored = MessageHistory()
+        restored.load(pickle.loads(pickle.dumps(self.history.export())))
+        self.assertEqual(list(restored['a']['b']), sent[7:] + [conversation[-1]])
+        newest = [m.message for m, _ in self.history.newest_first('a', 'b')]
+        self.assertCountEqual(newest, [m.message for m in sent[7:]] + ['late'])
+
+    def test_Expirable_Each_limit_Counts_oldest_messages(self):
+        for i in range(10):
+            self.history.append(UserMessage('a', 'b', 'x' * 10, f'2023-03-0{1 + i % 9} 12:00'))
+        conversation = self.history['a']['b']
+        self.assertEqual(conversation.expirable(max_messages=4), 6)
+        self.assertEqual(conversation.expirable(cutoff=encode_time('2023-03-03 00:00')), 2)
+        self.assertEqual(conversation.expirable(max_bytes=conversation.nbytes() - 1), 1)
+        self.assertEqual(conversation.expirable(max_bytes=0), 10)
+        self.history.append(UserMessage('a', 'c', 'x', 'now'))
+        self.history.append(UserMessage('a', 'c', 'x', '2000-01-01 00:00'))
+        self.assertEqual(self.history['a']['c'].expirable(cutoff=encode_time('2023-03-03 00:00')), 0)
+
+    def test_Newest_first_Cursor_Survives_expiry(self):
+        for i in range(10):
+            self.history.append(UserMessage('a', 'b', str(i), f'2023-03-01 10:{i:02d}'))
+        first = list(itertools.islice(self.history.newest_first('a', 'b'), 4))
+        self.history['a']['b'].expire(3)
+        rest = [m.message for m, _ in self.history.newest_first('a', 'b', cursor=first[-1][1])]
+        self.assertEqual(rest, ['5', '4', '3'])
+
+    def test_Newest_first_Cursor_Survives_expiry_and_snapshot_restore(self):
+        for i in range(10):
+            self.history.append(UserMessage('a', 'b', str(i), f'2023-03-01 10:{i:02d}'))
+        first = list(itertools.islice(self.history.newest_first('a', 'b'), 4))
+        self.history['a']['b'].expire(3)
+        restored = MessageHistory()
+        restored.load(pickle.loads(pickle.dumps(self.history.export())))
+        self.assertEqual(restored['a']['b'].expired, 3)
+        rest = [m.message for m, _ in restored.newest_first('a', 'b', cursor=first[-1][1])]
+        self.assertEqual(rest, ['5', '4', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
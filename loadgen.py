@@ -0,0 +1,531 @@
+"""Load generator for the wire server.
+
+Simulates many clients over loopback, speaking the wire protocol headlessly
+(no `inquirer`), runs one scripted workload and prints the results as JSON so
+runs can be compared between commits:
+
+    python loadgen.py login [--clients N]
+    python loadgen.py chat [--clients N] [--messages M]
+    python loadgen.py fanout [--users U] [--devices D] [--senders S] [--messages M]
+    python loadgen.py drain [--clients N] [--senders S] [--messages M]
+    python loadgen.py users [--online U] [--clients N] [--scans S]
+    python loadgen.py presence [--clients N] [--users U]
+
+By default a fresh server is started in a subprocess on a free port (see
+--engine, --fsync and --no-persistence); pass --port to load a running server
+instead. For every command the results give its count, errors, throughput and
+p50/p99/p999 latency. DELIVER is the time from a message being sent until a
+recipient device receives it, and DRAIN the time from a login until every
+message queued for that user has arrived. PRESENCE is the time from the start of
+a login storm until a subscribed client has been told every user is online, and
+PRESENCE_FRAME counts the presence frames pushed to subscribers meanwhile.
+"""
+from datetime import datetime
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from config import *
+from protocol import ProtocolError, get_codec
+from server import raise_open_file_limit
+
+# Codec used to talk to the server
+codec = get_codec(WIRE_FORMAT)
+
+# Seconds to wait for a spawned server to start listening
+SERVER_START_TIMEOUT = 10
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank `fraction` percentile of the sorted list `values`"""
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+class LatencyRecorder:
+    """Collects the latency of every request, by command, and summarises them"""
+
+    def __init__(self):
+        self.latencies = {}  # Maps command name to a list of latencies in seconds
+        self.errors = {}     # Maps command name to the number of failed requests
+        self.windows = {}    # Maps command name to [first start, last finish] in `time.perf_counter` seconds
+
+    def record(self, name, start, end=None):
+        """Record a `name` request that started at `start` and finished at `end` (now by default)"""
+
+        if end is None:
+            end = time.perf_counter()
+        self.latencies.setdefault(name, []).append(end - start)
+        window = self.windows.setdefault(name, [start, end])
+        window[0], window[1] = min(window[0], start), max(window[1], end)
+
+    def error(self, name, count=1):
+        """Count `count` failed `name` requests"""
+
+        self.errors[name] = self.errors.get(name, 0) + count
+
+    def summary(self):
+        """Return the count, errors, throughput (per second, over the command's active window) and latency percentiles of each command"""
+
+        summary = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies.get(name, []))
+            start, end = self.windows.get(name, (0, 0))
+            summary[name] = {
+                'count': len(latencies),
+                'errors': self.errors.get(name, 0),
+                'throughput': round(len(latencies) / (end - start), 1) if end > start else None,
+            }
+            for label, fraction in (('p50_ms', 0.5), ('p99_ms', 0.99), ('p999_ms', 0.999), ('max_ms', 1)):
+                value = percentile(latencies, fraction)
+                summary[name][label] = None if value is None else round(value * 1000, 3)
+        return summary
+
+
+class LoadClient:
+    """One simulated client: a connection that logs in, sends tagged requests and counts the messages pushed to it"""
+
+    def __init__(self, username, recorder, password='password'):
+        self.username = username
+        self.recorder = recorder
+        self.password_hash = hashlib.sha256(password.encode()).hexdigest()
+        self.pending = {}  # Maps request id to the Future for its response
+        self.next_request_id = 1
+        self.login_responses = asyncio.Queue()
+        self.received = 0
+        self.expected = 0
+        self.all_received = asyncio.Event()
+        self.online = set()     # Users a presence subscriber has been told are online
+        self.awaited = set()    # Users a presence subscriber is waiting to hear are online
+        self.all_online = asyncio.Event()
+        self.watch_start = None # When the presence changes being counted began
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.reader_task = asyncio.create_task(self.read_frames())
+
+    async def read_frames(self):
+        """Route every frame from the server until it disconnects"""
+
+        decoder = codec.decoder()
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    self.handle(frame)
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("The server closed the connection."))
+            self.pending.clear()
+            self.login_responses.put_nowait(None)
+
+    def handle(self, frame):
+        future = self.pending.pop(frame.request_id, None)
+        if future is not None:
+            if not future.done():
+                future.set_result(frame.args)
+        elif frame.command == RECEIVE_MESSAGE_COMMAND:
+            self.deliver(frame.args[2])
+        elif frame.command == RECEIVE_MESSAGES_COMMAND:
+            for text in frame.args[2::4]:
+                self.deliver(text)
+        elif frame.command == PRESENCE_COMMAND:
+            self.presence(frame.args)
+        elif frame.command == LOGIN_COMMAND:
+            self.login_responses.put_nowait(frame.args[0] if frame.args else '')
+
+    def presence(self, changes):
+        """Track who a presence subscriber has been told is online"""
+
+        if self.watch_start is not None:
+            self.recorder.record('PRESENCE_FRAME', self.watch_start)
+        for change in changes:
+            if change.startswith('+'):
+                self.online.add(change[1:])
+            else:
+                self.online.discard(change[1:])
+        if self.awaited <= self.online:
+            self.all_online.set()
+
+    def deliver(self, text):
+        """Record the delivery latency of a message, whose text starts with the time it was sent"""
+
+        self.recorder.record('DELIVER', float(text.split(' ', 1)[0]))
+        self.received += 1
+        if self.received >= self.expected:
+            self.all_received.set()
+
+    def expect(self, count):
+        """Expect `count` more messages to be delivered to this client"""
+
+        self.expected += count
+        if self.received < self.expected:
+            self.all_received.clear()
+        else:
+            self.all_received.set()
+
+    async def wait_received(self, timeout=RESPONSE_TIMEOUT):
+        """Wait until every expected message has arrived, counting any still missing as DELIVER errors"""
+
+        try:
+            await asyncio.wait_for(self.all_received.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.recorder.error('DELIVER', self.expected - self.received)
+            return False
+        return True
+
+    async def login_response(self):
+        try:
+            return await asyncio.wait_for(self.login_responses.get(), RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+
+    async def login(self):
+        """Log in, creating the account if it doesn't exist yet, and return whether it succeeded"""
+
+        start = time.perf_counter()
+        self.writer.write(codec.encode(LOGIN_COMMAND, self.username))
+        status = await self.login_response()
+        name = 'LOGIN_NEW' if status == 'new' else 'LOGIN'
+        if status not in ('new', 'exists'):
+            self.recorder.error(name)
+            return False
+        self.writer.write(codec.encode(LOGIN_COMMAND, self.password_hash))
+        if await self.login_response() != 'success':
+            self.recorder.error(name)
+            return False
+        self.recorder.record(name, start)
+        return True
+
+    async def request(self, name, command, *args):
+        """Send a tagged request and return the arguments of its response, or None if it failed"""
+
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        start = time.perf_counter()
+        self.writer.write(codec.encode(command, *args, request_id=request_id))
+        try:
+            response = await asyncio.wait_for(future, RESPONSE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.pending.pop(request_id, None)
+            self.recorder.error(name)
+            return None
+        self.recorder.record(name, start)
+        return response
+
+    async def send(self, recipient, size):
+        """Send a chat message of about `size` bytes, stamped with the time it was sent"""
+
+        text = f'{time.perf_counter():.6f} ' + 'x' * size
+        response = await self.request('SEND_MESSAGE', SEND_MESSAGE_COMMAND,
+                                      self.username, recipient, text, datetime.now().strftime(TIME_FORMAT))
+        return response == ['Success']
+
+    async def view_users(self, query, page_size):
+        """Page through every online user matching `query`, returning how many there were"""
+
+        start = time.perf_counter()
+        cursor, count = '', 0
+        while True:
+            response = await self.request('VIEW_USERS', VIEW_USERS_COMMAND, query, str(page_size), cursor)
+            if not response:
+                self.recorder.error('VIEW_USERS_SCAN')
+                return count
+            cursor, names = response[0], response[1:]
+            count += len(names)
+            if not cursor:
+                break
+        self.recorder.record('VIEW_USERS_SCAN', start)
+        return count
+
+    async def quit(self):
+        """Tell the server we're leaving and wait for it to close the connection"""
+
+        with contextlib.suppress(OSError):
+            self.writer.write(codec.encode(QUIT_COMMAND))
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.reader_task, RESPONSE_TIMEOUT)
+        self.writer.close()
+        with contextlib.suppress(OSError):
+            await self.writer.wait_closed()
+
+
+async def connect_clients(target, usernames, recorder):
+    """Connect and log in a client for each username, all at once, and return the clients"""
+
+    clients = [LoadClient(username, recorder) for username in usernames]
+    await asyncio.gather(*(client.connect(*target) for client in clients))
+    await asyncio.gather(*(client.login() for client in clients))
+    return clients
+
+
+async def close_clients(clients):
+    await asyncio.gather(*(client.quit() for client in clients))
+
+
+def user_names(arguments, role, count):
+    return [f'{arguments.prefix}{role}{i}' for i in range(count)]
+
+
+async def login_storm(arguments, target, recorder):
+    """Every client creates its account at once, then they all log back in to the existing accounts at once"""
+
+    usernames = user_names(arguments, 'user', arguments.clients)
+    await close_clients(await connect_clients(target, usernames, recorder))
+    await close_clients(await connect_clients(target, usernames, recorder))
+
+
+async def steady_chat(arguments, target, recorder):
+    """Clients talk in pairs, each sending its partner one message after another"""
+
+    clients = await connect_clients(target, user_names(arguments, 'user', arguments.clients // 2 * 2), recorder)
+    pairs = list(zip(clients[0::2], clients[1::2]))
+    for client in clients:
+        client.expect(arguments.messages)
+
+    async def chat(client, partner):
+        for _ in range(arguments.messages):
+            await client.send(partner.username, arguments.size)
+
+    await asyncio.gather(*(chat(a, b) for a, b in pairs), *(chat(b, a) for a, b in pairs))
+    await asyncio.gather(*(client.wait_received() for client in clients))
+    await close_clients(clients)
+
+
+async def fan_out(arguments, target, recorder):
+    """Senders message random users who are each logged in on several devices"""
+
+    users = user_names(arguments, 'user', arguments.users)
+    devices = await connect_clients(target, [user for user in users for _ in range(arguments.devices)], recorder)
+    senders = await connect_clients(target, user_names(arguments, 'sender', arguments.senders), recorder)
+
+    rng = random.Random(arguments.seed)
+    plans = [[rng.choice(users) for _ in range(arguments.messages)] for _ in senders]
+    for device in devices:
+        device.expect(sum(plan.count(device.username) for plan in plans))
+
+    async def send(sender, plan):
+        for recipient in plan:
+            await sender.send(recipient, arguments.size)
+
+    await asyncio.gather(*(send(sender, plan) for sender, plan in zip(senders, plans)))
+    await asyncio.gather(*(device.wait_received() for device in devices))
+    await close_clients(devices + senders)
+
+
+async def offline_drain(arguments, target, recorder):
+    """Messages pile up for offline users, who then all log back in at once and drain their queues"""
+
+    recipients = user_names(arguments, 'user', arguments.clients)
+    await close_clients(await connect_clients(target, recipients, recorder))
+    senders = await connect_clients(target, user_names(arguments, 'sender', arguments.senders), recorder)
+
+    async def send(sender):
+        for recipient in recipients:
+            for _ in range(arguments.messages):
+                await sender.send(recipient, arguments.size)
+
+    await asyncio.gather(*(send(sender) for sender in senders))
+    await close_clients(senders)
+
+    async def drain(client):
+        client.expect(arguments.senders * arguments.messages)
+        start = time.perf_counter()
+        await client.connect(*target)
+        if await client.login() and await client.wait_received():
+            recorder.record('DRAIN', start)
+        else:
+            recorder.error('DRAIN')
+
+    clients = [LoadClient(username, recorder) for username in recipients]
+    await asyncio.gather(*(drain(client) for client in clients))
+    await close_clients(clients)
+
+
+async def view_users_scans(arguments, target, recorder):
+    """With many users online, clients page through everyone and through a narrower prefix"""
+
+    online = await connect_clients(target, user_names(arguments, 'user', arguments.online), recorder)
+    queries = ['*', f'{arguments.prefix}user1*']
+
+    async def scan(client):
+        for i in range(arguments.scans):
+            await client.view_users(queries[i % len(queries)], arguments.page_size)
+
+    await asyncio.gather(*(scan(client) for client in online[:arguments.clients]))
+    await close_clients(online)
+
+
+async def presence_storm(arguments, target, recorder):
+    """Clients subscribe to presence, then many users log in at once, and the subscribers wait to hear of them all"""
+
+    watchers = await connect_clients(target, user_names(arguments, 'watcher', arguments.clients), recorder)
+    await asyncio.gather(*(watcher.request('SUBSCRIBE_PRESENCE', SUBSCRIBE_PRESENCE_COMMAND) for watcher in watchers))
+
+    usernames = user_names(arguments, 'user', arguments.users)
+    start = time.perf_counter()
+    for watcher in watchers:
+        watcher.awaited = set(usernames)
+        watcher.watch_start = start
+        watcher.all_online.clear()
+
+    async def watch(watcher):
+        try:
+            await asyncio.wait_for(watcher.all_online.wait(), RESPONSE_TIMEOUT)
+            recorder.record('PRESENCE', start)
+        except asyncio.TimeoutError:
+            recorder.error('PRESENCE')
+
+    users, _ = await asyncio.gather(connect_clients(target, usernames, recorder),
+                                    asyncio.gather(*(watch(watcher) for watcher in watchers)))
+    await close_clients(watchers + users)
+
+
+def free_port():
+    """Return a loopback port that nothing is listening on"""
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def spawned_server(engine, fsync_policy, persistence):
+    """Run `server.py` in a subprocess on a free loopback port and yield its address"""
+
+    host, port = '127.0.0.1', free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        process = subprocess.Popen(
+            [sys.executable, 'server.py', '--engine', engine, '--host', host, '--port', str(port),
+             '--data', directory if persistence else '', '--fsync', fsync_policy, '--admin-port', '0'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + SERVER_START_TIMEOUT
+            while True:
+                try:
+                    socket.create_connection((host, port), timeout=1).close()
+                    break
+                except OSError:
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError("The server did not start.")
+                    time.sleep(0.05)
+            yield host, port
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def current_commit():
+    """Return the git commit being measured, if this is a git checkout"""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_workload(arguments):
+    """Run the workload chosen by `arguments` and return its results"""
+
+    raise_open_file_limit()
+    recorder = LatencyRecorder()
+    parameters = {name: value for name, value in vars(arguments).items() if name not in ('run', 'output')}
+
+    with contextlib.ExitStack() as stack:
+        if arguments.port is None:
+            target = stack.enter_context(spawned_server(arguments.engine, arguments.fsync, arguments.persistence))
+        else:
+            target = (arguments.host, arguments.port)
+        start = time.perf_counter()
+        asyncio.run(arguments.run(arguments, target, recorder))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'workload': arguments.workload,
+        'commit': current_commit(),
+        'parameters': parameters,
+        'elapsed_seconds': round(elapsed, 3),
+        'commands': recorder.summary(),
+    }
+
+
+def parse_arguments(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--host', default='127.0.0.1', help="address of a running server to load")
+    common.add_argument('--port', type=int, help="port of a running server to load (default: spawn a fresh server)")
+    common.add_argument('--engine', choices=['asyncio', 'threaded'], default=SERVER_ENGINE, help="engine of a spawned server")
+    common.add_argument('--fsync', choices=['always', 'interval', 'os'], default=WAL_FSYNC_POLICY, help="fsync policy of a spawned server")
+    common.add_argument('--no-persistence', dest='persistence', action='store_false', help="run a spawned server without a write-ahead log")
+    common.add_argument('--size', type=int, default=100, help="bytes of padding in each chat message")
+    common.add_argument('--prefix', default=f'lg{uuid.uuid4().hex[:6]}', help="prefix for simulated usernames")
+    common.add_argument('--seed', type=int, default=0, help="seed for random choices")
+    common.add_argument('--output', help="file to write the JSON results to (default: stdout)")
+
+    parser = argparse.ArgumentParser(description="Run a load test against the chat server.")
+    workloads = parser.add_subparsers(dest='workload', required=True)
+
+    login_parser = workloads.add_parser('login', parents=[common], help="login storm: many clients log in at once")
+    login_parser.add_argument('--clients', type=int, default=1000, help="clients logging in")
+    login_parser.set_defaults(run=login_storm)
+
+    chat_parser = workloads.add_parser('chat', parents=[common], help="steady 1:1 chat between pairs of clients")
+    chat_parser.add_argument('--clients', type=int, default=100, help="clients, paired up")
+    chat_parser.add_argument('--messages', type=int, default=200, help="messages each client sends")
+    chat_parser.set_defaults(run=steady_chat)
+
+    fanout_parser = workloads.add_parser('fanout', parents=[common], help="messages to users logged in on several devices")
+    fanout_parser.add_argument('--users', type=int, default=50, help="recipient users")
+    fanout_parser.add_argument('--devices', type=int, default=4, help="devices each recipient is logged in on")
+    fanout_parser.add_argument('--senders', type=int, default=20, help="sending clients")
+    fanout_parser.add_argument('--messages', type=int, default=200, help="messages each sender sends")
+    fanout_parser.set_defaults(run=fan_out)
+
+    drain_parser = workloads.add_parser('drain', parents=[common], help="offline queues drained as users reconnect")
+    drain_parser.add_argument('--clients', type=int, default=100, help="offline users who reconnect")
+    drain_parser.add_argument('--senders', type=int, default=10, help="sending clients")
+    drain_parser.add_argument('--messages', type=int, default=50, help="messages each sender queues for each user")
+    drain_parser.set_defaults(run=offline_drain)
+
+    users_parser = workloads.add_parser('users', parents=[common], help="VIEW_USERS scans with many users online")
+    users_parser.add_argument('--online', type=int, default=2000, help="users logged in")
+    users_parser.add_argument('--clients', type=int, default=20, help="clients running scans")
+    users_parser.add_argument('--scans', type=int, default=20, help="scans each client runs")
+    users_parser.add_argument('--page-size', type=int, default=VIEW_USERS_PAGE_SIZE, help="users per VIEW_USERS page")
+    users_parser.set_defaults(run=view_users_scans)
+
+    presence_parser = workloads.add_parser('presence', parents=[common], help="login storm watched by presence subscribers")
+    presence_parser.add_argument('--clients', type=int, default=200, help="clients subscribed to presence")
+    presence_parser.add_argument('--users', type=int, default=1000, help="users logging in at once")
+    presence_parser.set_defaults(run=presence_storm)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    results = json.dumps(run_workload(arguments), indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print(results)
@@ -0,0 +1,46 @@
+from loadgen import LatencyRecorder, percentile, parse_arguments, run_workload
+import unittest
+
+
+class TestLatencyRecorder(unittest.TestCase):
+    def test_Percentile_Nearest_rank(self):
+        values = list(range(1, 1001))
+        self.assertEqual(percentile(values, 0.5), 500)
+        self.assertEqual(percentile(values, 0.99), 990)
+        self.assertEqual(percentile(values, 0.999), 999)
+        self.assertEqual(percentile([7], 0.999), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_Summary_Counts_errors_and_throughput_over_active_window(self):
+        recorder = LatencyRecorder()
+        for i in range(10):
+            recorder.record('SEND_MESSAGE', i, i + 0.5)
+        recorder.error('SEND_MESSAGE')
+        summary = recorder.summary()['SEND_MESSAGE']
+        self.assertEqual((summary['count'], summary['errors']), (10, 1))
+        self.assertEqual(summary['throughput'], round(10 / 9.5, 1))
+        self.assertEqual(summary['p50_ms'], 500)
+
+
+class TestWorkloads(unittest.TestCase):
+    def run_workload(self, *argv):
+        return run_workload(parse_arguments([*argv, '--no-persistence']))
+
+    def test_Chat_Every_message_acknowledged_and_delivered(self):
+        commands = self.run_workload('chat', '--clients', '4', '--messages', '10')['commands']
+        self.assertEqual((commands['SEND_MESSAGE']['count'], commands['SEND_MESSAGE']['errors']), (40, 0))
+        self.assertEqual((commands['DELIVER']['count'], commands['DELIVER']['errors']), (40, 0))
+
+    def test_Drain_Queued_messages_Arrive_on_reconnect(self):
+        commands = self.run_workload('drain', '--clients', '3', '--senders', '2', '--messages', '5')['commands']
+        self.assertEqual((commands['DRAIN']['count'], commands['DRAIN']['errors']), (3, 0))
+        self.assertEqual(commands['DELIVER']['count'], 30)
+
+    def test_Presence_Subscribers_Hear_of_every_login(self):
+        commands = self.run_workload('presence', '--clients', '3', '--users', '20')['commands']
+        self.assertEqual((commands['PRESENCE']['count'], commands['PRESENCE']['errors']), (3, 0))
+        self.assertLess(commands['PRESENCE_FRAME']['count'], 3 * 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
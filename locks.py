@@ -0,0 +1,39 @@
+"""Lock striping for the server's shared state.
+
+Rather than one lock per user (created on the fly, racily) or one global lock
+(which serialises everything), keys are hashed onto a fixed array of locks.
+Operations on unrelated users or conversations almost always take different
+stripes and run in parallel, and no lock object is ever created or removed
+while the server runs.
+
+Stripes are re-entrant, so a thread holding a user's stripe can call code that
+takes the same stripe again, e.g. an outbox that spills a message back to the
+recipient's offline queue during delivery. A thread must never wait for a second
+stripe of the same kind while holding one, as two users may share a stripe.
+To hold several keys of one kind at once, take them together with `hold`, which
+locks their stripes in a fixed order.
+"""
+from contextlib import ExitStack, contextmanager
+import threading
+from config import *
+
+
+class LockStripes:
+    """A fixed array of re-entrant locks, indexed by hashing a key"""
+
+    def __init__(self, count=LOCK_STRIPES):
+        self.locks = [threading.RLock() for _ in range(count)]
+
+    def __getitem__(self, key):
+        """Return the lock that guards `key`"""
+
+        return self.locks[hash(key) % len(self.locks)]
+
+    @contextmanager
+    def hold(self, *keys):
+        """Hold the locks guarding every one of `keys`, taken in stripe order so that two holders can't deadlock"""
+
+        with ExitStack() as stack:
+            for stripe in sorted({hash(key) % len(self.locks) for key in keys}):
+                stack.enter_context(self.locks[stripe])
+            yield
@@ -0,0 +1,139 @@
+from config import *
+import server
+from history import MessageHistory
+from locks import LockStripes
+from offline_queue import OfflineQueues
+from user_directory import UserDirectory
+from threading import Lock
+import random
+import sys
+import threading
+import time
+import unittest
+
+
+class RecordingClient:
+    """Stands in for a client socket and keeps every chat message the server sends it until it is closed"""
+
+    def __init__(self):
+        self.decoder = server.codec.decoder()
+        self.received = []
+        self.closed = False
+
+    def sendall(self, data):
+        # Give other threads a chance to close the socket while the frame is on its way
+        time.sleep(0)
+        if self.closed:
+            return
+        for frame in self.decoder.feed(data):
+            if frame.command == RECEIVE_MESSAGE_COMMAND:
+                self.received.append(frame.args[2])
+
+
+def run_threads(targets):
+    """Run each target in its own thread, re-raising the first exception any of them hit"""
+
+    errors = []
+
+    def run(target):
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+class TestConcurrentServerState(unittest.TestCase):
+    def setUp(self):
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        server.accounts = UserDirectory()
+        server.messages = MessageHistory()
+        server.unsent_message_queue = OfflineQueues()
+        server.connected_clients = UserDirectory(set)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def new_client(self):
+        client = RecordingClient()
+        server.client_locks[client] = Lock()
+        return client
+
+    def test_Lock_stripes_Same_key_Same_lock(self):
+        stripes = LockStripes(8)
+        self.assertIs(stripes['alice'], stripes['alice'])
+        self.assertIs(stripes['a', 'b'], stripes['a', 'b'])
+        self.assertEqual(len({id(stripes[f'user{i}']) for i in range(100)}), 8)
+
+    def test_Create_account_Racing_clients_Exactly_one_wins(self):
+        results = []
+        run_threads([lambda: results.append(server.create_account('race', 'hash', self.new_client())[0]) for _ in range(16)])
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(len(server.connected_clients['race']), 1)
+
+    def test_Delete_account_Racing_logins_Never_connects_to_deleted_account(self):
+        client = self.new_client()
+        for round in range(200):
+            server.accounts['victim'] = 'hash'
+            connected = []
+            run_threads([
+                lambda: server.delete_account(client, 'victim', 'hash'),
+                lambda: connected.append(server.connect_client('victim', self.new_client(), 'hash')),
+            ])
+            if connected[0]:
+                server.disconnect_client('victim', next(iter(server.connected_clients['victim'])))
+            self.assertNotIn('victim', server.accounts)
+            self.assertFalse(server.connect_client('victim', self.new_client(), 'hash'))
+            self.assertNotIn('victim', server.connected_clients)
+
+    def test_Send_while_logging_in_and_out_No_message_lost_or_duplicated(self):
+        users = [f'user{i}' for i in range(8)]
+        for user in users:
+            server.accounts[user] = 'hash'
+        devices = []
+        sent = {user: [] for user in users}
+        senders_done = threading.Event()
+
+        def send(n):
+            rng = random.Random(n)
+            for i in range(300):
+                sender, recipient = rng.sample(users, 2)
+                text = f'{n}:{i}'
+                server.deliver_new_message(self.new_client(), sender, recipient, text, 'now')
+                sent[recipient].append(text)
+
+        def device(user):
+            while not senders_done.is_set():
+                client = self.new_client()
+                devices.append((user, client))
+                self.assertTrue(server.connect_client(user, client, 'hash'))
+                time.sleep(0)
+                server.disconnect_client(user, client)
+                client.closed = True
+
+        def send_all():
+            try:
+                run_threads([lambda n=n: send(n) for n in range(8)])
+            finally:
+                senders_done.set()
+
+        run_threads([send_all] + [lambda user=user: device(user) for user in users])
+
+        self.assertEqual(dict(server.connected_clients), {})
+        for user in users:
+            received = [text for owner, client in devices if owner == user for text in client.received]
+            queued = [message.message for message in server.unsent_message_queue[user]]
+            self.assertCountEqual(received + queued, sent[user])
+            self.assertEqual(sum(len(server.messages[other][user]) for other in users), len(sent[user]))
+
+
+if __name__ == '__main__':
+    unittest.main()
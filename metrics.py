@@ -0,0 +1,156 @@
+"""Request metrics for the server, rendered in the Prometheus text format.
+
+Every thread that handles requests counts into its own shard, so recording a
+request takes no lock: the hot path is a few list updates on data no other
+thread writes. A scrape sums the shards. It may miss a request that is being
+counted at that moment, which the next scrape picks up. Threads that stop
+handling requests fold their shard into a retired total, so a server that runs
+a thread per connection doesn't accumulate shards.
+
+Named counters are sharded the same way. Gauges and their counterparts for
+counts that some object already keeps are callables evaluated at scrape time,
+so they cost nothing in between.
+"""
+from bisect import bisect_left
+import threading
+import config
+from config import *
+
+# Names of the command codes, used to label metrics
+COMMAND_NAMES = {
+    value: name[:-len('_COMMAND')].lower()
+    for name, value in vars(config).items() if name.endswith('_COMMAND')
+}
+
+# Offsets into a command's row of counts
+REQUESTS, ERRORS, SECONDS, BUCKETS = range(4)
+
+
+class Metrics:
+    """Per-command request counts, errors and latency histograms, plus scrape-time gauges"""
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS, prefix='chat'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.local = threading.local()
+        self.shards = []   # The shard of each live thread, mapping command code to its row of counts
+        self.retired = {}  # Counts folded in from threads that have retired their shards
+        self.counters = {} # Maps counter name to its help text
+        self.gauges = {}   # Maps gauge name to (help text, callable returning its value)
+        self.lock = threading.Lock()  # Guards `shards` and `retired`, never taken to record a request
+
+    def new_row(self):
+        return [0, 0, 0.0] + [0] * (len(self.buckets) + 1)
+
+    def shard(self):
+        """Return this thread's shard, registering it on first use"""
+
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def observe(self, command, seconds, error=False):
+        """Record a `command` request that took `seconds` to handle"""
+
+        shard = self.shard()
+        row = shard.get(command)
+        if row is None:
+            row = shard[command] = self.new_row()
+        row[REQUESTS] += 1
+        if error:
+            row[ERRORS] += 1
+        row[SECONDS] += seconds
+        row[BUCKETS + bisect_left(self.buckets, seconds)] += 1
+
+    def error(self, command):
+        """Count a `command` request that failed without raising (e.g. it was answered 'error')"""
+
+        shard = self.shard()
+        row = shard.get(command)
+        if row is None:
+            row = shard[command] = self.new_row()
+        row[ERRORS] += 1
+
+    def count(self, name, n=1):
+        """Add `n` to the counter `name`"""
+
+        shard = self.shard()
+        row = shard.get(name)
+        if row is None:
+            row = shard[name] = [0]
+        row[0] += n
+
+    def retire(self):
+        """Fold this thread's shard into the retired total, as the thread won't record any more requests"""
+
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            return
+        del self.local.shard
+        with self.lock:
+            self.shards = [s for s in self.shards if s is not shard]
+            self.add_rows(self.retired, shard)
+
+    def add_rows(self, total, shard):
+        for command, row in list(shard.items()):
+            into = total.get(command)
+            if into is None:
+                into = total[command] = [0] * len(row)
+            for i, value in enumerate(row):
+                into[i] += value
+
+    def counter(self, name, help, value=None):
+        """Report counter `name`, counted with `count` or, if given, read from `value()` on every scrape"""
+
+        self.counters[name] = (help, value)
+
+    def gauge(self, name, help, value):
+        """Report `value()` as gauge `name` on every scrape"""
+
+        self.gauges[name] = (help, value)
+
+    def totals(self):
+        """Return each command's summed row of counts"""
+
+        with self.lock:
+            total = {}
+            self.add_rows(total, self.retired)
+            for shard in self.shards:
+                self.add_rows(total, shard)
+        return total
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+
+        prefix = self.prefix
+        totals = self.totals()
+        total = sorted((command, row) for command, row in totals.items() if isinstance(command, int))
+        labels = {command: f'command="{COMMAND_NAMES.get(command, command)}"' for command, _ in total}
+        lines = [
+            f'# HELP {prefix}_requests_total Requests handled, by command.',
+            f'# TYPE {prefix}_requests_total counter',
+            *(f'{prefix}_requests_total{{{labels[c]}}} {row[REQUESTS]}' for c, row in total),
+            f'# HELP {prefix}_request_errors_total Requests that failed or were answered with an error, by command.',
+            f'# TYPE {prefix}_request_errors_total counter',
+            *(f'{prefix}_request_errors_total{{{labels[c]}}} {row[ERRORS]}' for c, row in total),
+            f'# HELP {prefix}_request_duration_seconds Time taken to handle a request, by command.',
+            f'# TYPE {prefix}_request_duration_seconds histogram',
+        ]
+        for command, row in total:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), row[BUCKETS:]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels[command]},le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_request_duration_seconds_sum{{{labels[command]}}} {row[SECONDS]!r}')
+            lines.append(f'{prefix}_request_duration_seconds_count{{{labels[command]}}} {row[REQUESTS]}')
+        for name, (help, value) in self.counters.items():
+            count = value() if value is not None else totals.get(name, [0])[0]
+            lines += [f'# HELP {prefix}_{name} {help}', f'# TYPE {prefix}_{name} counter', f'{prefix}_{name} {count}']
+        for name, (help, value) in self.gauges.items():
+            lines += [f'# HELP {prefix}_{name} {help}', f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value()}']
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,77 @@
+from config import *
+from metrics import Metrics
+from admin import start_admin_server
+from protocol import Frame
+from unittest.mock import MagicMock
+from threading import Lock
+from urllib.request import urlopen
+import server
+import threading
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.01, 0.1))
+
+    def test_Render_Histogram_buckets_Are_cumulative(self):
+        for seconds in (0.005, 0.05, 0.05, 3):
+            self.metrics.observe(SEND_MESSAGE_COMMAND, seconds)
+        self.metrics.observe(SEND_MESSAGE_COMMAND, 0.001, error=True)
+        text = self.metrics.render()
+        self.assertIn('chat_requests_total{command="send_message"} 5', text)
+        self.assertIn('chat_request_errors_total{command="send_message"} 1', text)
+        self.assertIn('chat_request_duration_seconds_bucket{command="send_message",le="0.01"} 2', text)
+        self.assertIn('chat_request_duration_seconds_bucket{command="send_message",le="0.1"} 4', text)
+        self.assertIn('chat_request_duration_seconds_bucket{command="send_message",le="+Inf"} 5', text)
+        self.assertIn('chat_request_duration_seconds_count{command="send_message"} 5', text)
+
+    def test_Observe_Many_threads_Counts_every_request_including_retired(self):
+        def handle(retire):
+            for _ in range(10000):
+                self.metrics.observe(VIEW_USERS_COMMAND, 0.001)
+            if retire:
+                self.metrics.retire()
+
+        threads = [threading.Thread(target=handle, args=(i % 2 == 0,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.metrics.totals()[VIEW_USERS_COMMAND][0], 80000)
+        self.assertEqual(len(self.metrics.shards), 4)
+
+    def test_Gauge_Evaluated_on_each_render(self):
+        depth = [3]
+        self.metrics.gauge('unsent_messages', "Queued messages.", lambda: depth[0])
+        self.assertIn('chat_unsent_messages 3\n', self.metrics.render())
+        depth[0] = 7
+        self.assertIn('chat_unsent_messages 7\n', self.metrics.render())
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_Dispatch_frame_Error_reply_Counted_and_scraped_over_admin_port(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        previous, server.metrics = server.metrics, Metrics()
+        server.metrics.gauge('connected_sockets', "Open client connections.", lambda: len(server.client_locks))
+        server.dispatch_frame(client, 'a', Frame(HISTORY_COMMAND, ['b', 'yesterday'], 1))
+        server.dispatch_frame(client, 'a', Frame(CHECK_ACCOUNT_COMMAND, ['b'], 2))
+
+        admin = start_admin_server(server.admin_routes(), port=0)
+        try:
+            with urlopen(f'http://{ADMIN_HOST}:{admin.server_address[1]}/metrics') as response:
+                text = response.read().decode()
+        finally:
+            admin.shutdown()
+            admin.server_close()
+            del server.client_locks[client]
+            server.metrics = previous
+        self.assertIn('chat_requests_total{command="history"} 1', text)
+        self.assertIn('chat_request_errors_total{command="history"} 1', text)
+        self.assertIn('chat_request_errors_total{command="check_account"} 0', text)
+        self.assertRegex(text, r'chat_connected_sockets [1-9]')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""Offline queues that spill to disk.
+
+A user who stays offline for weeks can have any amount of mail waiting, so each
+`OfflineQueue` keeps only a bounded part of its messages in memory:
+
+- the tail: the newest messages, up to `OFFLINE_MEMORY_MESSAGES`. When it fills
+  up, it is written in one go to the end of the queue's newest segment file and
+  emptied;
+- the head: the oldest messages, read back from the segments one
+  `OFFLINE_FLUSH_CHUNK` at a time as the queue is drained at login (plus any
+  messages put back at the front).
+
+Everything in between lives in the queue's append-only segment files, in the
+write-ahead log's record format. A segment is read back by mapping it with mmap
+and decoding records from the queue's read offset, so draining streams the
+messages out in order without loading more than a chunk, and a segment is
+deleted once it has been read to the end. A new segment is started when the
+newest one reaches `OFFLINE_SEGMENT_BYTES`.
+
+Spill files are a cache, not a record: the write-ahead log holds every queued
+message, so the queues are rebuilt at startup and spill files left over from an
+earlier run are deleted. Queues created without a spill directory stay in memory.
+
+Like the deques they replace, queues are not thread safe: callers hold the
+recipient's user lock.
+"""
+from collections import deque
+import itertools
+import mmap
+import os
+from config import *
+from history import UserMessage
+from wal import MESSAGE_QUEUED, decode_record, encode_record
+
+SPILL_SUFFIX = '.spill'
+
+# Numbers that name each queue's segment files, unique within the process
+_queue_ids = itertools.count(1)
+
+
+class OfflineQueue:
+    """The messages queued for one recipient, oldest first, spilling to segment files in `directory` if given"""
+
+    def __init__(self, directory=None, memory_limit=OFFLINE_MEMORY_MESSAGES, segment_bytes=OFFLINE_SEGMENT_BYTES,
+                 chunk=OFFLINE_FLUSH_CHUNK):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_bytes = segment_bytes
+        self.chunk = chunk
+        self.id = next(_queue_ids)
+        self.head = deque()      # Oldest messages, read back from the segments or put back at the front
+        self.tail = deque()      # Newest messages, not spilled yet
+        self.segments = deque()  # Numbers of the segment files holding spilled messages, oldest first
+        self.segment_size = 0    # Bytes written to the newest segment
+        self.offset = 0          # Where the next unread record starts in the oldest segment
+        self.spilled = 0         # Messages in the segments that haven't been read back
+
+    def __len__(self):
+        return len(self.head) + self.spilled + len(self.tail)
+
+    def __iter__(self):
+        """Yield every queued message in order, reading the spilled ones without removing them"""
+
+        yield from self.head
+        offset = self.offset
+        for segment in list(self.segments):
+            while True:
+                messages, offset = self.read_records(segment, offset, self.chunk)
+                yield from messages
+                if len(messages) < self.chunk:
+                    break
+            offset = 0
+        yield from self.tail
+
+    def path(self, segment):
+        return os.path.join(self.directory, f'{self.id:010d}-{segment:06d}{SPILL_SUFFIX}')
+
+    def append(self, message):
+        self.tail.append(message)
+        if self.directory is not None and len(self.tail) >= self.memory_limit:
+            self.spill()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def popleft(self):
+        """Remove and return the oldest message"""
+
+        if not self.head and self.spilled:
+            self.read_back()
+        if self.head:
+            return self.head.popleft()
+        return self.tail.popleft()
+
+    def extendleft(self, messages):
+        """Put messages back at the front, each ahead of the one before (as `deque.extendleft` does)"""
+
+        self.head.extendleft(messages)
+
+    def clear(self):
+        """Remove every message, deleting the segment files"""
+
+        for segment in self.segments:
+            os.remove(self.path(segment))
+        self.head.clear()
+        self.tail.clear()
+        self.segments.clear()
+        self.segment_size = self.offset = self.spilled = 0
+
+    def spill(self):
+        """Append the tail to the newest segment (starting a new one if it is full) and empty it"""
+
+        data = b''.join(encode_record(MESSAGE_QUEUED, m.sender, m.recipient, m.message, m.time) for m in self.tail)
+        if not self.segments or self.segment_size >= self.segment_bytes:
+            self.segments.append(self.segments[-1] + 1 if self.segments else 1)
+            self.segment_size = 0
+        with open(self.path(self.segments[-1]), 'ab') as f:
+            f.write(data)
+        self.segment_size += len(data)
+        self.spilled += len(self.tail)
+        self.tail.clear()
+
+    def read_back(self):
+        """Move the next chunk of spilled messages into the head, deleting segments that have been read to the end"""
+
+        while not self.head and self.segments:
+            messages, self.offset = self.read_records(self.segments[0], self.offset, self.chunk)
+            self.head.extend(messages)
+            self.spilled -= len(messages)
+            if len(messages) < self.chunk or not self.spilled:
+                os.remove(self.path(self.segments.popleft()))
+                self.offset = 0
+        if not self.segments:
+            self.spilled = 0
+
+    def read_records(self, segment, offset, limit):
+        """Decode up to `limit` messages from `segment` starting at `offset`, returning them and the offset after them"""
+
+        messages = []
+        with open(self.path(segment), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while len(messages) < limit:
+                record = decode_record(data, offset)
+                if record is None:
+                    break
+                _, fields, offset = record
+                messages.append(UserMessage(*fields))
+        return messages, offset
+
+
+class OfflineQueues(dict):
+    """Maps recipient to their `OfflineQueue`, creating queues on first use as a defaultdict would"""
+
+    def __init__(self, directory=None, memory_limit=OFFLINE_MEMORY_MESSAGES):
+        super().__init__()
+        self.directory = directory
+        self.memory_limit = memory_limit
+
+    def __missing__(self, recipient):
+        queue = self[recipient] = OfflineQueue(self.directory, self.memory_limit)
+        return queue
+
+    def pop(self, recipient, *default):
+        """Remove `recipient`'s queue, deleting its segment files"""
+
+        queue = super().pop(recipient, *default)
+        if isinstance(queue, OfflineQueue):
+            queue.clear()
+        return queue
+
+    def clear(self):
+        for queue in self.values():
+            queue.clear()
+        super().clear()
+
+    def spill_to(self, directory):
+        """Spill the queues created from now on to `directory`, deleting any spill files an earlier run left there"""
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(SPILL_SUFFIX):
+                os.remove(os.path.join(directory, name))
+        self.directory = directory
+
+    def spilled(self):
+        """Return the number of queued messages held on disk"""
+
+        return sum(queue.spilled for queue in list(self.values()))
@@ -0,0 +1,100 @@
+from config import *
+import server
+from history import UserMessage
+from offline_queue import OfflineQueue, OfflineQueues, SPILL_SUFFIX
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from threading import Lock
+
+
+def spill_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SPILL_SUFFIX))
+
+
+class TestOfflineQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.queue = OfflineQueue(self.directory.name, memory_limit=10, segment_bytes=500, chunk=4)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fill(self, count):
+        messages = [UserMessage('a', 'b', f'message {i}', '2023-03-01 12:00') for i in range(count)]
+        self.queue.extend(messages)
+        return messages
+
+    def test_Append_Past_memory_limit_Spills_and_keeps_memory_bounded(self):
+        messages = self.fill(1000)
+        self.assertEqual(len(self.queue), 1000)
+        self.assertLess(len(self.queue.tail), 10)
+        self.assertFalse(self.queue.head)
+        self.assertGreater(len(spill_files(self.directory.name)), 1)
+        self.assertEqual(list(self.queue), messages)
+
+    def test_Popleft_Spilled_queue_Streams_in_order_and_deletes_segments(self):
+        messages = self.fill(1000)
+        drained = []
+        while self.queue:
+            drained.append(self.queue.popleft())
+            self.assertLessEqual(len(self.queue.head) + len(self.queue.tail), 4 + 10)
+        self.assertEqual(drained, messages)
+        self.assertEqual(spill_files(self.directory.name), [])
+        with self.assertRaises(IndexError):
+            self.queue.popleft()
+
+    def test_Append_While_draining_Keeps_order(self):
+        messages = self.fill(25)
+        taken = [self.queue.popleft() for _ in range(15)]
+        messages += self.fill(30)
+        self.queue.extendleft(reversed(taken[-5:]))
+        self.assertEqual(list(self.queue), messages[10:])
+        self.assertEqual([self.queue.popleft() for _ in range(len(self.queue))], messages[10:])
+
+    def test_Clear_Removes_spill_files(self):
+        self.fill(100)
+        self.queue.clear()
+        self.assertEqual((len(self.queue), spill_files(self.directory.name)), (0, []))
+
+    def test_Queues_Spill_to_Deletes_leftover_files_and_pop_deletes_queue_files(self):
+        open(os.path.join(self.directory.name, f'1{SPILL_SUFFIX}'), 'w').close()
+        queues = OfflineQueues(memory_limit=10)
+        queues.spill_to(self.directory.name)
+        self.assertEqual(spill_files(self.directory.name), [])
+        queues['b'].extend(UserMessage('a', 'b', str(i), 'now') for i in range(50))
+        self.assertEqual(queues.spilled(), 50)
+        queues.pop('b')
+        self.assertEqual(spill_files(self.directory.name), [])
+
+
+class TestServerSpilling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = server.unsent_message_queue
+        server.unsent_message_queue = OfflineQueues(memory_limit=16)
+        server.unsent_message_queue.spill_to(self.directory.name)
+
+    def tearDown(self):
+        server.unsent_message_queue.clear()
+        server.unsent_message_queue = self.saved
+        self.directory.cleanup()
+
+    def test_Flush_unsent_messages_Spilled_queue_Delivers_everything_in_order(self):
+        sender, recipient = MagicMock(), MagicMock()
+        server.client_locks[sender] = Lock()
+        server.client_locks[recipient] = Lock()
+        for i in range(OFFLINE_FLUSH_CHUNK * 3):
+            server.deliver_new_message(sender, 'spill_sender', 'spill_recipient', str(i), 'now')
+        self.assertGreater(server.unsent_message_queue.spilled(), 0)
+
+        server.flush_unsent_messages(recipient, 'spill_recipient')
+        frames = server.codec.decoder().feed(b''.join(c[0][0] for c in recipient.sendall.call_args_list))
+        self.assertEqual([arg for f in frames for arg in f.args[2::4]], [str(i) for i in range(OFFLINE_FLUSH_CHUNK * 3)])
+        self.assertFalse(server.unsent_message_queue['spill_recipient'])
+        self.assertEqual(spill_files(self.directory.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
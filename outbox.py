@@ -0,0 +1,231 @@
+"""Per-connection outbound queues.
+
+Every connection owns an outbox that holds encoded frames waiting to be written,
+so a sender never blocks on a slow recipient's socket. Each outbox holds at most
+`OUTBOX_LIMIT` bytes. When a frame would push it past that, the overflow policy
+decides what happens:
+
+- 'drop': the frame is discarded.
+- 'disconnect': the connection is closed.
+- 'spill': a chat message is handed to the `spill` callback (the server puts it
+  back on the recipient's offline queue). Any other frame disconnects the client.
+  Once the outbox has drained to half its limit, the `refill` callback (set by
+  the server once the client has logged in) offers the queue back to the outbox,
+  a chunk at a time while there is room. Later messages that fit in the outbox
+  may be delivered before the spilled ones.
+"""
+from collections import deque
+import asyncio
+import socket
+import threading
+from config import *
+
+OVERFLOW_POLICIES = ('drop', 'disconnect', 'spill')
+
+
+class Outbox:
+    """Shared overflow handling for the threaded and event loop outboxes"""
+
+    def __init__(self, limit=OUTBOX_LIMIT, policy=OUTBOX_OVERFLOW_POLICY, spill=None, refill=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}; expected one of {OVERFLOW_POLICIES}.")
+        self.limit = limit
+        self.policy = policy
+        self.spill = spill
+        self.refill = refill      # Offers spilled messages back to the outbox once it has drained, without blocking
+        self.refill_due = False   # Whether a message has spilled since the last refill
+        self.dropped = 0
+
+    def overflow(self, message):
+        """Apply the overflow policy to a frame that did not fit, returning True if its message is still safe"""
+
+        if self.policy == 'spill' and message is not None and self.spill is not None:
+            self.spill(message)
+            self.schedule_refill()
+            return True
+        if self.policy == 'drop':
+            self.dropped += 1
+            return False
+        self.abort()
+        return False
+
+    def schedule_refill(self):
+        """Arrange for `refill` to run once the outbox has drained; only the subclasses know when that is"""
+
+
+class ThreadedOutbox(Outbox):
+    """Outbox drained by a dedicated writer thread that owns all writes to the socket"""
+
+    def __init__(self, client, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+        self.frames = deque()
+        self.size = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, frame, message=None):
+        """Queue `frame` for sending without blocking; `message` is the UserMessage it carries, if any"""
+
+        with self.condition:
+            if self.closing:
+                return False
+            # A single frame larger than the limit is still let through on an empty queue
+            if not self.frames or self.size + len(frame) <= self.limit:
+                self.frames.append(frame)
+                self.size += len(frame)
+                self.condition.notify_all()
+                return True
+        return self.overflow(message)
+
+    def offer(self, frame):
+        """Queue `frame` only if it fits, returning whether it did; unlike `put`, a frame that doesn't fit is left to the caller"""
+
+        with self.condition:
+            if self.closing or (self.frames and self.size + len(frame) > self.limit):
+                return False
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.condition.notify_all()
+            return True
+
+    def schedule_refill(self):
+        """Have the writer thread run `refill` once at most half the limit is queued"""
+
+        with self.condition:
+            if self.refill is not None:
+                self.refill_due = True
+                self.condition.notify_all()
+
+    def run(self):
+        """Write queued frames until the outbox is closed and drained, coalescing whatever has queued up"""
+
+        while True:
+            with self.condition:
+                while not self.frames and not self.closing and not self.refill_due:
+                    self.condition.wait()
+                refill = self.refill_due and self.size <= self.limit // 2 and not self.closing
+                if refill:
+                    self.refill_due = False
+            if refill:
+                # Called without the condition held, as the refill takes the recipient's lock and then offers frames
+                self.refill()
+            with self.condition:
+                if not self.frames:
+                    if self.closing:
+                        break
+                    continue
+                batch = b''.join(self.frames)
+                self.frames.clear()
+                self.size = 0
+            try:
+                self.client.sendall(batch)
+            except OSError:
+                with self.condition:
+                    self.closing = True
+                    self.frames.clear()
+                    self.condition.notify_all()
+                break
+            with self.condition:
+                self.condition.notify_all()
+        self.client.close()
+
+    def drain(self):
+        """Block until at most half the limit is queued, so a bulk sender paces itself to the client"""
+
+        with self.condition:
+            while self.size > self.limit // 2 and not self.closing:
+                self.condition.wait()
+
+    def close(self):
+        """Stop accepting frames and close the socket once everything queued has been written"""
+
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+
+    def abort(self):
+        """Discard queued frames and shut the connection down immediately"""
+
+        with self.condition:
+            self.closing = True
+            self.frames.clear()
+            self.size = 0
+            self.condition.notify_all()
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncOutbox(Outbox):
+    """Outbox backed by an asyncio transport's write buffer, which the event loop drains.
+
+    Must be created on the event loop thread. Frames put from any other thread are
+    handed over to the loop.
+    """
+
+    def __init__(self, writer, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+    def put(self, frame, message=None):
+        """Queue `frame` for sending without blocking; `message` is the UserMessage it carries, if any"""
+
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.put, frame, message)
+            return True
+
+        transport = self.writer.transport
+        if transport.is_closing():
+            return False
+        buffered = transport.get_write_buffer_size()
+        if not buffered or buffered + len(frame) <= self.limit:
+            self.writer.write(frame)
+            return True
+        return self.overflow(message)
+
+    def offer(self, frame):
+        """Write `frame` only if it fits, returning whether it did. Must be called on the event loop thread."""
+
+        transport = self.writer.transport
+        buffered = transport.get_write_buffer_size()
+        if transport.is_closing() or (buffered and buffered + len(frame) > self.limit):
+            return False
+        self.writer.write(frame)
+        return True
+
+    def schedule_refill(self):
+        """Start a task that runs `refill` once the transport's buffer has drained"""
+
+        if self.refill is not None and not self.refill_due:
+            self.refill_due = True
+            self.loop.create_task(self.run_refill())
+
+    async def run_refill(self):
+        await self.drain()
+        self.refill_due = False
+        if not self.writer.transport.is_closing():
+            self.refill()
+
+    async def drain(self):
+        """Wait until the transport's buffer is below its high-water mark, so a bulk sender paces itself to the client"""
+
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        """Close the transport once its buffered frames have been written"""
+
+        self.writer.close()
+
+    def abort(self):
+        """Discard buffered frames and close the connection immediately"""
+
+        self.writer.transport.abort()
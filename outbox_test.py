@@ -0,0 +1,196 @@
+from config import *
+import server
+from server import deliver_new_message
+from outbox import AsyncOutbox, Outbox, ThreadedOutbox
+from user_directory import UserDirectory
+import asyncio
+import socket
+import time
+import unittest
+from unittest.mock import MagicMock
+from threading import Lock
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class TestThreadedOutbox(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    def tearDown(self):
+        self.theirs.close()
+
+    def test_Put_Frames_are_written_in_order(self):
+        outbox = ThreadedOutbox(self.ours)
+        for i in range(100):
+            self.assertTrue(outbox.put(str(i).encode().rjust(3)))
+        outbox.close()
+        self.assertEqual(recv_exactly(self.theirs, 300), b''.join(str(i).encode().rjust(3) for i in range(100)))
+
+    def test_Put_Stalled_reader_Never_blocks_and_drops_past_limit(self):
+        outbox = ThreadedOutbox(self.ours, limit=10000, policy='drop')
+        start = time.monotonic()
+        accepted = sum(outbox.put(b'x' * 1000) for _ in range(1000))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertLess(accepted, 1000)
+        self.assertEqual(outbox.dropped, 1000 - accepted)
+        outbox.abort()
+
+    def test_Put_Overflow_with_spill_policy_Spills_messages(self):
+        spilled = []
+        outbox = ThreadedOutbox(self.ours, limit=10000, policy='spill', spill=spilled.append)
+        for i in range(1000):
+            outbox.put(b'x' * 1000, message=i)
+        self.assertTrue(spilled)
+        self.assertEqual(spilled, sorted(spilled))
+        outbox.abort()
+
+    def test_Put_Overflow_with_disconnect_policy_Closes_connection(self):
+        outbox = ThreadedOutbox(self.ours, limit=10000, policy='disconnect')
+        while outbox.put(b'x' * 1000):
+            pass
+        outbox.thread.join(1)
+        self.assertFalse(outbox.thread.is_alive())
+        self.assertFalse(outbox.put(b'x'))
+
+
+class GatedOutbox(Outbox):
+    """An outbox that overflows while `full` is set and otherwise records the messages put on it"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.full = True
+        self.sent = []
+
+    def put(self, frame, message=None):
+        if self.full:
+            return self.overflow(message)
+        self.sent.append(message.message)
+        return True
+
+
+class TestSlowRecipient(unittest.TestCase):
+    def test_Deliver_new_message_Stalled_recipient_Sender_is_acked_and_overflow_spills(self):
+        sender = MagicMock()
+        recipient, peer = socket.socketpair()
+        server.client_locks[sender] = Lock()
+        server.connected_clients = UserDirectory(None, {'slow': {recipient}})
+        server.unsent_message_queue.pop('slow', None)
+        server.client_outboxes[recipient] = ThreadedOutbox(
+            recipient, limit=10000, policy='spill', spill=server.spill_to_offline_queue)
+        try:
+            start = time.monotonic()
+            for i in range(1000):
+                deliver_new_message(sender, 'fast', 'slow', 'x' * 200, str(i))
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(sender.sendall.call_count, 1000)
+            spilled = [int(message.time) for message in server.unsent_message_queue['slow']]
+            self.assertTrue(spilled)
+            self.assertEqual(spilled, sorted(spilled))
+        finally:
+            server.client_outboxes.pop(recipient).abort()
+            peer.close()
+            del server.client_locks[sender]
+
+    def test_Deliver_new_message_Overflow_spills_Then_refills_still_connected_client(self):
+        sender = MagicMock()
+        recipient, peer = socket.socketpair()
+        server.client_locks[sender] = Lock()
+        server.connected_clients = UserDirectory(None, {'slow': {recipient}})
+        server.unsent_message_queue.pop('slow', None)
+        server.client_outboxes[recipient] = ThreadedOutbox(
+            recipient, limit=10000, policy='spill', spill=server.spill_to_offline_queue)
+        server.start_refills(recipient, 'slow')
+        try:
+            for i in range(1000):
+                deliver_new_message(sender, 'fast', 'slow', 'x' * 200, str(i))
+            self.assertTrue(server.unsent_message_queue['slow'])
+
+            # Once the client reads again, the spilled messages follow without a new login
+            decoder, received = server.codec.decoder(), []
+            peer.settimeout(5)
+            while len(received) < 1000:
+                for frame in decoder.feed(peer.recv(65536)):
+                    received += frame.args[3::4]
+            self.assertEqual(sorted(map(int, received)), list(range(1000)))
+            self.assertFalse(server.unsent_message_queue['slow'])
+        finally:
+            server.client_outboxes.pop(recipient).abort()
+            peer.close()
+            del server.client_locks[sender]
+
+    def test_Deliver_new_message_Spilled_message_Queued_behind_earlier_mail_and_overtaken_by_later(self):
+        sender, recipient = MagicMock(), MagicMock()
+        server.client_locks[sender] = Lock()
+        saved = server.connected_clients
+        server.connected_clients = UserDirectory(None)
+        server.unsent_message_queue.pop('slow', None)
+        outbox = server.client_outboxes[recipient] = GatedOutbox(policy='spill', spill=server.spill_to_offline_queue)
+        try:
+            deliver_new_message(sender, 'fast', 'slow', 'while away', 'now')
+            server.connected_clients['slow'] = {recipient}
+            deliver_new_message(sender, 'fast', 'slow', 'spilled', 'now')
+            outbox.full = False
+            deliver_new_message(sender, 'fast', 'slow', 'fits', 'now')
+            # The spilled message waits behind the mail queued before it, and reaches the client after the later one
+            self.assertEqual([m.message for m in server.unsent_message_queue['slow']], ['while away', 'spilled'])
+            self.assertEqual(outbox.sent, ['fits'])
+        finally:
+            server.client_outboxes.pop(recipient)
+            server.connected_clients = saved
+            del server.client_locks[sender]
+
+
+class TestAsyncSlowRecipient(unittest.IsolatedAsyncioTestCase):
+    async def test_Deliver_new_message_Overflow_spills_Then_refills_still_connected_client(self):
+        sender = MagicMock()
+        server.client_locks[sender] = Lock()
+        server.unsent_message_queue.pop('slow', None)
+        accepted = asyncio.Future()
+
+        async def accept(reader, writer):
+            # Small socket buffers, so the outbox fills while the client isn't reading
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            client = server.AsyncClientConnection(reader, writer)
+            server.client_outboxes[client] = AsyncOutbox(writer, limit=10000, policy='spill', spill=server.spill_to_offline_queue)
+            server.connected_clients = UserDirectory(None, {'slow': {client}})
+            server.start_refills(client, 'slow')
+            accepted.set_result(client)
+
+        listener = await asyncio.start_server(accept, '127.0.0.1', 0)
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(listener.sockets[0].getsockname())
+        reader, writer = await asyncio.open_connection(sock=sock)
+        client = await asyncio.wait_for(accepted, 5)
+        try:
+            for i in range(1000):
+                deliver_new_message(sender, 'fast', 'slow', 'x' * 200, str(i))
+            self.assertTrue(server.unsent_message_queue['slow'])
+
+            decoder, received = server.codec.decoder(), []
+            while len(received) < 1000:
+                for frame in decoder.feed(await asyncio.wait_for(reader.read(65536), 5)):
+                    received += frame.args[3::4]
+            self.assertEqual(sorted(map(int, received)), list(range(1000)))
+            self.assertFalse(server.unsent_message_queue['slow'])
+        finally:
+            server.client_outboxes.pop(client).abort()
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+            del server.client_locks[sender]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Push-based presence.
+
+Instead of polling VIEW_USERS, a client can send SUBSCRIBE_PRESENCE to be told
+whenever a user comes online (logs in on their first device) or goes offline
+(logs out of their last). The server records each change where it adds users to
+and removes them from `connected_clients`, and the changes are coalesced over
+`PRESENCE_WINDOW` seconds: each window's changes go out as one batch, encoded
+once and shared by every subscriber, and a user who changes more than once
+within a window appears once, with their latest state. A storm of N logins seen
+by N subscribers therefore costs each subscriber a frame per window, not N.
+
+A batch is a PRESENCE frame (several, if it doesn't fit in one) whose fields are
+usernames prefixed with '+' for online or '-' for offline. Each field states a
+user's presence rather than a transition, so applying one twice is harmless. A
+new subscriber is first sent every online user as one such batch; a change
+racing with the subscription may be repeated in the next one.
+"""
+import threading
+from config import *
+
+
+class Presence:
+    """Collects presence changes and pushes them to subscribed clients in batches.
+
+    `send(client, frame)` queues an encoded frame on a client's connection, and
+    `codec` encodes the frames.
+    """
+
+    def __init__(self, send, codec, window=PRESENCE_WINDOW):
+        self.send = send
+        self.codec = codec
+        self.window = window
+        self.subscribers = set()
+        self.pending = {}     # Maps username to whether they are online, for changes not sent yet
+        self.batches = 0      # Batches sent so far
+        self.condition = threading.Condition()  # Guards `subscribers` and `pending`; notified when a change arrives
+        self.closed = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Send a batch `window` seconds after the first change since the last one, until closed"""
+
+        while not self.closed.is_set():
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed.is_set())
+            if not self.closed.wait(self.window):
+                self.flush()
+
+    def changed(self, username, online):
+        """Record that `username` came online or went offline (call with the user's lock held)"""
+
+        with self.condition:
+            # With nobody subscribed there is no one to tell; a later subscriber starts from the current state
+            if not self.subscribers:
+                return
+            self.pending[username] = online
+            self.condition.notify()
+
+    def subscribe(self, client, online):
+        """Send `client` the usernames in `online` and then every later change"""
+
+        with self.condition:
+            for frame in self.frames({username: True for username in online}):
+                self.send(client, frame)
+            self.subscribers.add(client)
+
+    def unsubscribe(self, client):
+        with self.condition:
+            self.subscribers.discard(client)
+
+    def flush(self):
+        """Send the changes collected since the last batch to every subscriber"""
+
+        with self.condition:
+            changes, self.pending = self.pending, {}
+            subscribers = list(self.subscribers)
+        if not changes or not subscribers:
+            return
+        frames = self.frames(changes)
+        for client in subscribers:
+            try:
+                for frame in frames:
+                    self.send(client, frame)
+            except (KeyError, OSError):
+                # The client disconnected after the batch was put together
+                self.unsubscribe(client)
+        self.batches += 1
+
+    def frames(self, changes):
+        """Encode changes (username -> online) as PRESENCE frames, as few as fit them"""
+
+        frames, fields, size = [], [], 0
+        for username, online in changes.items():
+            field = ('+' if online else '-') + username
+            cost = len(field.encode()) + self.codec.field_overhead
+            if fields and size + cost > self.codec.frame_budget:
+                frames.append(self.codec.encode(PRESENCE_COMMAND, *fields))
+                fields, size = [], 0
+            fields.append(field)
+            size += cost
+        if fields or not frames:
+            frames.append(self.codec.encode(PRESENCE_COMMAND, *fields))
+        return frames
+
+    def close(self):
+        self.closed.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,117 @@
+from config import *
+import server
+from presence import Presence
+from protocol import get_codec
+from user_directory import UserDirectory
+import unittest
+from unittest.mock import MagicMock
+from threading import Lock
+
+
+class RecordingSender:
+    """Stands in for `send_frame`, keeping every frame sent to each client"""
+
+    def __init__(self):
+        self.sent = {}
+
+    def __call__(self, client, frame):
+        self.sent.setdefault(client, []).append(frame)
+
+    def fields(self, client, codec):
+        """Return the fields of each PRESENCE frame sent to `client`"""
+
+        frames = codec.decoder().feed(b''.join(self.sent.get(client, [])))
+        return [frame.args for frame in frames if frame.command == PRESENCE_COMMAND]
+
+
+class TestPresence(unittest.TestCase):
+    def setUp(self):
+        self.codec = get_codec('framed')
+        self.send = RecordingSender()
+        self.presence = Presence(self.send, self.codec)
+
+    def test_Changed_No_subscribers_Records_nothing(self):
+        self.presence.changed('a', True)
+        self.assertEqual(self.presence.pending, {})
+
+    def test_Subscribe_Sends_online_users_first(self):
+        self.presence.subscribe('watcher', ['a', 'b'])
+        self.assertEqual(self.send.fields('watcher', self.codec), [['+a', '+b']])
+
+    def test_Flush_Login_storm_Coalesces_into_one_shared_batch(self):
+        watchers = [f'watcher{i}' for i in range(50)]
+        for watcher in watchers:
+            self.presence.subscribe(watcher, [])
+        self.send.sent.clear()
+
+        for i in range(50):
+            self.presence.changed(f'user{i}', True)
+        self.presence.changed('user3', False)
+        self.presence.flush()
+
+        expected = [[f'-user{i}' if i == 3 else f'+user{i}' for i in range(50)]]
+        for watcher in watchers:
+            self.assertEqual(self.send.fields(watcher, self.codec), expected)
+        # Every subscriber is sent the same encoded bytes
+        self.assertEqual(len({id(frame) for frames in self.send.sent.values() for frame in frames}), 1)
+        self.assertEqual(self.presence.batches, 1)
+
+        self.presence.flush()
+        self.assertEqual(self.presence.batches, 1)
+
+    def test_Frames_Batch_larger_than_a_frame_Splits_in_order(self):
+        codec = get_codec('padded')
+        presence = Presence(self.send, codec)
+        presence.subscribe('watcher', [])
+        self.send.sent.clear()
+        names = [f'someone_with_a_long_name_{i}' for i in range(200)]
+        for name in names:
+            presence.changed(name, True)
+        presence.flush()
+        batches = self.send.fields('watcher', codec)
+        self.assertGreater(len(batches), 1)
+        self.assertEqual([field for batch in batches for field in batch], ['+' + name for name in names])
+
+
+class TestServerPresence(unittest.TestCase):
+    def setUp(self):
+        self.send = RecordingSender()
+        self.saved = (server.presence, server.connected_clients, server.accounts)
+        server.presence = Presence(self.send, server.codec)
+        server.connected_clients = UserDirectory(set)
+        server.accounts = UserDirectory()
+        for name in ('watcher', 'p1', 'p2'):
+            server.accounts[name] = 'hash'
+
+    def tearDown(self):
+        server.presence, server.connected_clients, server.accounts = self.saved
+
+    def new_client(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        return client
+
+    def test_Subscribe_presence_Pushes_joins_and_leaves_until_quit(self):
+        watcher = self.new_client()
+        server.connect_client('watcher', watcher, 'hash')
+        server.dispatch_command(watcher, 'watcher', SUBSCRIBE_PRESENCE_COMMAND, [])
+        reply, = server.codec.decoder().feed(watcher.sendall.call_args[0][0])
+        self.assertEqual(reply.args, ['success'])
+
+        p1, p1_again, p2 = self.new_client(), self.new_client(), self.new_client()
+        server.connect_client('p1', p1, 'hash')
+        server.connect_client('p1', p1_again, 'hash')
+        server.connect_client('p2', p2, 'hash')
+        server.disconnect_client('p1', p1)
+        server.presence.flush()
+        server.disconnect_client('p2', p2)
+        server.presence.flush()
+
+        self.assertEqual(self.send.fields(watcher, server.codec), [['+watcher'], ['+p1', '+p2'], ['-p2']])
+
+        server.quit(watcher, 'watcher', None)
+        self.assertNotIn(watcher, server.presence.subscribers)
+
+
+if __name__ == '__main__':
+    unittest.main()
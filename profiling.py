@@ -0,0 +1,214 @@
+"""On-demand profiling and allocation tracing for a running server.
+
+Nothing here runs until it is triggered, so it costs nothing while off:
+
+- A profile samples the stack of every other thread every
+  `PROFILE_SAMPLE_INTERVAL` seconds for a while, then writes the samples as
+  collapsed stacks (one `thread;outer;...;inner count` line per stack, the input
+  to flame graph tools) or as a pstats file (for `python -m pstats` or snakeviz).
+- An allocation trace starts `tracemalloc`, takes a snapshot, and later takes a
+  second one and writes the source lines whose allocations grew the most,
+  headed by the size of the server's main structures. Tracing stops again
+  once the report is written.
+
+Both are triggered from the admin port (`/profile`, `/tracemalloc`) or by
+signal: SIGUSR1 profiles for `PROFILE_SECONDS`, and SIGUSR2 starts an
+allocation trace and, sent again, writes its report.
+"""
+from collections import Counter
+import itertools
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from config import *
+
+PROFILE_FORMATS = ('collapsed', 'pstats')
+
+
+def sample_stacks(seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """Sample the stack of every thread but this one for `seconds`.
+
+    Returns a Counter mapping (thread name, stack) to the number of samples it
+    was seen in, where a stack is a tuple of (filename, line, function) from the
+    outermost frame in.
+    """
+
+    samples = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            samples[names.get(ident, str(ident)), tuple(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def collapsed_stacks(samples):
+    """Render samples as collapsed stacks, heaviest first"""
+
+    lines = []
+    for (thread, stack), count in samples.most_common():
+        frames = [thread.replace(';', ':')] + [f'{function} ({os.path.basename(filename)}:{line})' for filename, line, function in stack]
+        lines.append(f"{';'.join(frames)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+class SampledStats:
+    """Samples in the shape `pstats.Stats` loads from a profiler: each sample counts as one call taking `interval` seconds"""
+
+    def __init__(self, samples, interval):
+        self.samples = samples
+        self.interval = interval
+
+    def create_stats(self):
+        # Maps function to [calls, calls, own time, cumulative time, {caller: [calls, calls, own time, cumulative time]}]
+        stats = {}
+        for (_, stack), count in self.samples.items():
+            seconds = count * self.interval
+            seen = set()
+            for depth, function in enumerate(stack):
+                entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+                if depth == len(stack) - 1:
+                    entry[0] += count
+                    entry[1] += count
+                    entry[2] += seconds
+                if function not in seen:
+                    seen.add(function)
+                    entry[3] += seconds
+                if depth:
+                    caller = entry[4].setdefault(stack[depth - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[3] += seconds
+        self.stats = {
+            function: (calls, primitive, own, cumulative, {caller: tuple(c) for caller, c in callers.items()})
+            for function, (calls, primitive, own, cumulative, callers) in stats.items()
+        }
+
+
+class Diagnostics:
+    """Runs profiles and allocation traces on demand, one of each at a time, writing the results to `directory`.
+
+    `describe`, if given, returns lines describing the server's state, which head
+    each allocation report.
+    """
+
+    def __init__(self, directory=PROFILE_DIRECTORY, describe=None):
+        self.directory = directory
+        self.describe = describe
+        self.profiling = threading.Lock()
+        self.tracing = threading.Lock()
+        self.baseline = None
+        self.sequence = itertools.count(1)
+
+    def output_path(self, kind, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, f'{kind}-{stamp}-{os.getpid()}-{next(self.sequence)}.{extension}')
+
+    def profile(self, seconds=PROFILE_SECONDS, format='collapsed', interval=PROFILE_SAMPLE_INTERVAL):
+        """Sample every thread for `seconds` and write the profile, returning its path"""
+
+        if format not in PROFILE_FORMATS:
+            raise ValueError(f"Unknown profile format {format!r}; expected one of {PROFILE_FORMATS}.")
+        if not self.profiling.acquire(blocking=False):
+            raise ValueError("A profile is already running.")
+        try:
+            print(f"Profiling for {seconds} s...")
+            samples = sample_stacks(seconds, interval)
+        finally:
+            self.profiling.release()
+
+        path = self.output_path('profile', 'collapsed' if format == 'collapsed' else 'pstats')
+        if format == 'collapsed':
+            with open(path, 'w') as f:
+                f.write(collapsed_stacks(samples))
+        else:
+            pstats.Stats(SampledStats(samples, interval)).dump_stats(path)
+        print(f"Wrote profile to {path}.")
+        return path
+
+    def start_tracing(self):
+        """Start tracing allocations from a baseline snapshot"""
+
+        with self.tracing:
+            if self.baseline is not None:
+                raise ValueError("Allocations are already being traced.")
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.baseline = self.snapshot()
+        print("Tracing allocations.")
+
+    def finish_tracing(self):
+        """Stop tracing and write the growth in allocations since the baseline, returning the report's path"""
+
+        with self.tracing:
+            if self.baseline is None:
+                raise ValueError("Allocations are not being traced.")
+            snapshot = self.snapshot()
+            baseline, self.baseline = self.baseline, None
+            tracemalloc.stop()
+
+        lines = list(self.describe()) if self.describe else []
+        lines.append(f"Top {TRACEMALLOC_TOP} source lines by allocation growth:")
+        lines += [str(stat) for stat in snapshot.compare_to(baseline, 'lineno')[:TRACEMALLOC_TOP]]
+        path = self.output_path('tracemalloc', 'txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        print(f"Wrote allocation report to {path}.")
+        return path
+
+    def trace_allocations(self, seconds=PROFILE_SECONDS):
+        """Trace allocations for `seconds`, returning the report's path"""
+
+        self.start_tracing()
+        try:
+            time.sleep(seconds)
+        finally:
+            path = self.finish_tracing()
+        return path
+
+    def toggle_tracing(self):
+        """Start tracing allocations, or write the report and return its path if already tracing"""
+
+        if self.baseline is None:
+            self.start_tracing()
+            return None
+        return self.finish_tracing()
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def install_signal_handlers(self):
+        """Profile on SIGUSR1 and toggle allocation tracing on SIGUSR2, where the platform has them"""
+
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+
+        def run(target):
+            def handler(signum, frame):
+                threading.Thread(target=self.run_quietly, args=(target,), daemon=True).start()
+            return handler
+
+        signal.signal(signal.SIGUSR1, run(self.profile))
+        signal.signal(signal.SIGUSR2, run(self.toggle_tracing))
+
+    def run_quietly(self, target):
+        try:
+            target()
+        except ValueError as e:
+            print(e)
@@ -0,0 +1,61 @@
+from profiling import Diagnostics, collapsed_stacks, sample_stacks
+import pstats
+import tempfile
+import threading
+import tracemalloc
+import unittest
+
+
+def busy_handler(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.diagnostics = Diagnostics(self.directory.name, describe=lambda: ['messages: 0 messages'])
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=busy_handler, args=(self.stop,), name='handler')
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+        self.directory.cleanup()
+
+    def test_Sample_stacks_Busy_thread_Appears_under_its_name(self):
+        samples = sample_stacks(0.2, 0.001)
+        stacks = collapsed_stacks(samples).splitlines()
+        self.assertTrue(any(line.startswith('handler;') and 'busy_handler (profiling_test.py:' in line for line in stacks))
+        self.assertFalse(any(line.startswith(f'{threading.current_thread().name};') for line in stacks))
+
+    def test_Profile_Pstats_format_Loads_with_pstats(self):
+        path = self.diagnostics.profile(0.2, 'pstats', 0.001)
+        stats = pstats.Stats(path)
+        self.assertIn('busy_handler', {function for _, _, function in stats.stats})
+        self.assertGreater(stats.total_tt, 0)
+
+    def test_Profile_Already_running_Raises(self):
+        self.diagnostics.profiling.acquire()
+        try:
+            with self.assertRaises(ValueError):
+                self.diagnostics.profile(0.1)
+        finally:
+            self.diagnostics.profiling.release()
+
+    def test_Toggle_tracing_Reports_growth_and_stops_tracing(self):
+        self.assertIsNone(self.diagnostics.toggle_tracing())
+        self.assertTrue(tracemalloc.is_tracing())
+        grown = [bytearray(1000) for _ in range(1000)]
+        path = self.diagnostics.toggle_tracing()
+        self.assertFalse(tracemalloc.is_tracing())
+        with open(path) as f:
+            report = f.read()
+        self.assertTrue(report.startswith('messages: 0 messages\n'))
+        self.assertIn('profiling_test.py', report.split('growth:')[1].splitlines()[1])
+        del grown
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+"""Framing for the chat wire protocol.
+
+Two codecs are available, selected by `WIRE_FORMAT` in `config.py`:
+
+- `FramedCodec` ('framed'): every frame is a 4-byte big-endian payload length
+  followed by the payload. The payload is one command byte and then zero or more
+  string fields, each encoded as a varint byte length followed by UTF-8 bytes.
+  When the high bit of the command byte is set, a varint request id follows it.
+- `PaddedCodec` ('padded'): the original format, `command|arg|...|` padded with
+  spaces to exactly `BUFSIZE` bytes. A request id is written as `command:id`.
+
+Request ids are optional. A client that tags a request with one gets the same id
+back on the response, so it can keep many requests in flight over one connection
+and match each response to its caller with a `ResponseDispatcher`.
+
+Both codecs hand out streaming decoders that accept arbitrary chunks of bytes, so
+a frame split across several reads, or many frames arriving in one read, are
+decoded the same way.
+"""
+from collections import deque, namedtuple
+from concurrent.futures import Future
+import itertools
+import queue
+import struct
+import threading
+from config import *
+
+_LENGTH = struct.Struct('>I')
+_REQUEST_ID_FLAG = 0x80
+
+# A decoded frame; `request_id` is None when the sender did not tag it
+Frame = namedtuple('Frame', ['command', 'args', 'request_id'], defaults=[None])
+
+
+class ProtocolError(ValueError):
+    """Raised when bytes on the wire cannot be decoded into a frame"""
+
+
+def encode_varint(value):
+    """Encode a non-negative integer as an unsigned LEB128 varint"""
+
+    if value < 0:
+        raise ProtocolError("Varints cannot be negative.")
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, offset=0):
+    """Decode a varint starting at `offset`, returning the value and the offset just past it"""
+
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ProtocolError("Truncated varint.")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ProtocolError("Varint is too long.")
+
+
+class FramedCodec:
+    """Length-prefixed frames with a command byte and varint-length string fields"""
+
+    name = 'framed'
+    frame_budget = MAX_FRAME_SIZE - 11                    # Bytes left for fields after the command byte and largest request id
+    field_overhead = len(encode_varint(MAX_FRAME_SIZE))   # Bytes each field takes beyond its UTF-8 text
+
+    def encode(self, command, *args, request_id=None):
+        """Serialize a command and its string arguments into one frame"""
+
+        if not 0 <= command < _REQUEST_ID_FLAG:
+            raise ProtocolError(f"Command {command} does not fit in seven bits.")
+        if request_id is None:
+            payload = bytearray((command,))
+        else:
+            payload = bytearray((command | _REQUEST_ID_FLAG,))
+            payload += encode_varint(request_id)
+        for arg in args:
+            data = arg.encode()
+            payload += encode_varint(len(data))
+            payload += data
+        if len(payload) > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {len(payload)} bytes exceeds MAX_FRAME_SIZE.")
+        return _LENGTH.pack(len(payload)) + payload
+
+    def decode_payload(self, payload):
+        """Split a frame payload (without its length header) into the command and its arguments"""
+
+        if not payload:
+            raise ProtocolError("Empty frame.")
+        command = payload[0]
+        request_id = None
+        offset = 1
+        if command & _REQUEST_ID_FLAG:
+            command &= ~_REQUEST_ID_FLAG
+            request_id, offset = decode_varint(payload, offset)
+        args = []
+        while offset < len(payload):
+            length, offset = decode_varint(payload, offset)
+            end = offset + length
+            if end > len(payload):
+                raise ProtocolError("Field runs past the end of the frame.")
+            try:
+                args.append(payload[offset:end].decode())
+            except UnicodeDecodeError as e:
+                raise ProtocolError("Field is not valid UTF-8.") from e
+            offset = end
+        return Frame(command, args, request_id)
+
+    def decoder(self):
+        return FrameDecoder(self)
+
+
+class FrameDecoder:
+    """Incrementally decodes length-prefixed frames from a byte stream"""
+
+    def __init__(self, codec=None):
+        self.codec = codec or FramedCodec()
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every Frame that is now complete"""
+
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes exceeds MAX_FRAME_SIZE.")
+            start = offset + _LENGTH.size
+            if len(self.buffer) - start < length:
+                break
+            frames.append(self.codec.decode_payload(bytes(self.buffer[start:start + length])))
+            offset = start + length
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class PaddedCodec:
+    """The original `command|arg|...|` format, space padded to exactly `BUFSIZE` bytes"""
+
+    name = 'padded'
+    frame_budget = BUFSIZE - 26  # Bytes left for fields after the largest `command:id|` header and the final '|'
+    field_overhead = 1           # Bytes each field takes beyond its UTF-8 text (its '|')
+
+    def encode(self, command, *args, request_id=None):
+        """Serialize a command and its arguments into one padded frame"""
+
+        header = str(command) if request_id is None else f"{command}:{request_id}"
+        message = (f"{header}|" + "|".join(args) + '|').encode()
+        if len(message) > BUFSIZE:
+            raise ProtocolError(f"Frame of {len(message)} bytes exceeds BUFSIZE.")
+        return message + b' ' * (BUFSIZE - len(message))
+
+    def decode_payload(self, payload):
+        """Strip the padding and trailing '|' from a frame and split it into the command and arguments"""
+
+        try:
+            message = payload.decode().rstrip(' ')
+        except UnicodeDecodeError as e:
+            raise ProtocolError("Frame is not valid UTF-8.") from e
+        if message.endswith('|'):
+            message = message[:-1]
+        header, *args = message.split("|")
+        command, _, request_id = header.partition(':')
+        try:
+            return Frame(int(command), args, int(request_id) if request_id else None)
+        except ValueError as e:
+            raise ProtocolError(f"Invalid command {header!r}.") from e
+
+    def decoder(self):
+        return PaddedDecoder(self)
+
+
+class PaddedDecoder:
+    """Incrementally decodes fixed `BUFSIZE` frames from a byte stream"""
+
+    def __init__(self, codec=None):
+        self.codec = codec or PaddedCodec()
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every Frame that is now complete"""
+
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= BUFSIZE:
+            frames.append(self.codec.decode_payload(bytes(self.buffer[offset:offset + BUFSIZE])))
+            offset += BUFSIZE
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+CODECS = {codec.name: codec for codec in (FramedCodec(), PaddedCodec())}
+
+
+def get_codec(name=WIRE_FORMAT):
+    """Return the codec registered under `name`"""
+
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown wire format {name!r}; expected one of {sorted(CODECS)}.")
+
+
+class FrameReader:
+    """Reads whole frames from a socket, buffering any extra frames that arrive in the same read"""
+
+    def __init__(self, sock, codec=None):
+        self.sock = sock
+        self.decoder = (codec or get_codec()).decoder()
+        self.frames = deque()
+
+    def read(self):
+        """Block until a full frame arrives and return it, or None once the peer disconnects"""
+
+        while not self.frames:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.frames.extend(self.decoder.feed(data))
+        return self.frames.popleft()
+
+
+class ResponseDispatcher:
+    """Hands out request ids and routes each tagged response to whoever is waiting on it.
+
+    A request answered by one frame gets a Future for that frame's arguments. A
+    streamed request, answered by several frames, gets a queue that receives the
+    arguments of each frame in turn (or the exception that ended the stream).
+    """
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.pending = {}  # Maps request id to (command, Future or queue, predicate for a stream's last frame)
+        self.lock = threading.Lock()
+
+    def register(self, command):
+        """Reserve a request id for a `command` request and return it with the Future for its response"""
+
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = (command, future, None)
+        return request_id, future
+
+    def register_stream(self, command, is_last):
+        """Reserve a request id for a streamed `command` request and return it with the queue its responses arrive on.
+
+        The stream ends with the first response whose arguments satisfy `is_last`.
+        """
+
+        responses = queue.Queue()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = (command, responses, is_last)
+        return request_id, responses
+
+    def resolve(self, frame):
+        """Hand `frame` to whoever is waiting on it, returning False if nobody is"""
+
+        if frame.request_id is None:
+            return False
+        with self.lock:
+            entry = self.pending.get(frame.request_id)
+            if entry is None:
+                return False
+            command, waiter, is_last = entry
+            if is_last is None or frame.command != command or is_last(frame.args):
+                del self.pending[frame.request_id]
+
+        if frame.command != command:
+            error = ProtocolError(f"Expected a response to command {command}, got {frame.command}.")
+            if is_last is None:
+                waiter.set_exception(error)
+            else:
+                waiter.put(error)
+        elif is_last is None:
+            waiter.set_result(frame.args)
+        else:
+            waiter.put(frame.args)
+        return True
+
+    def fail_all(self, error):
+        """Fail every outstanding request, e.g. once the connection is gone"""
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for _, waiter, is_last in pending.values():
+            if is_last is None:
+                waiter.set_exception(error)
+            else:
+                waiter.put(error)
@@ -0,0 +1,110 @@
+from config import *
+from protocol import FramedCodec, PaddedCodec, ProtocolError, Frame, FrameReader, ResponseDispatcher, encode_varint, decode_varint
+import unittest
+from unittest.mock import MagicMock
+
+
+class TestFramedCodec(unittest.TestCase):
+    codec = FramedCodec()
+
+    def test_Varint_Round_trips(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1):
+            self.assertEqual(decode_varint(encode_varint(value)), (value, len(encode_varint(value))))
+
+    def test_Encode_Short_message_Is_not_padded(self):
+        frame = self.codec.encode(SEND_MESSAGE_COMMAND, 'a', 'b', 'hi', '2023-01-01 00:00')
+        self.assertLess(len(frame), 40)
+
+    def test_Decode_Round_trips_pipes_and_unicode(self):
+        args = ('a|b', 'ünïcødé', '', 'x' * 5000)
+        frames = self.codec.decoder().feed(self.codec.encode(RECEIVE_MESSAGE_COMMAND, *args))
+        self.assertEqual(frames, [Frame(RECEIVE_MESSAGE_COMMAND, list(args))])
+
+    def test_Decode_Partial_reads_Waits_for_whole_frame(self):
+        frame = self.codec.encode(VIEW_USERS_COMMAND, 'user1', 'user2')
+        decoder = self.codec.decoder()
+        for byte in frame[:-1]:
+            self.assertEqual(decoder.feed(bytes([byte])), [])
+        self.assertEqual(decoder.feed(frame[-1:]), [Frame(VIEW_USERS_COMMAND, ['user1', 'user2'])])
+
+    def test_Decode_Many_frames_in_one_read_Returns_all_in_order(self):
+        data = b''.join(self.codec.encode(CHECK_ACCOUNT_COMMAND, str(i)) for i in range(100))
+        frames = self.codec.decoder().feed(data + self.codec.encode(QUIT_COMMAND)[:3])
+        self.assertEqual(frames, [Frame(CHECK_ACCOUNT_COMMAND, [str(i)]) for i in range(100)])
+
+    def test_Decode_Request_id_Round_trips(self):
+        frame = self.codec.encode(CHECK_ACCOUNT_COMMAND, 'bob', request_id=300)
+        self.assertEqual(self.codec.decoder().feed(frame), [Frame(CHECK_ACCOUNT_COMMAND, ['bob'], 300)])
+
+    def test_Decode_Oversized_length_Raises(self):
+        with self.assertRaises(ProtocolError):
+            self.codec.decoder().feed((MAX_FRAME_SIZE + 1).to_bytes(4, 'big'))
+
+    def test_Decode_Field_past_end_of_frame_Raises(self):
+        with self.assertRaises(ProtocolError):
+            self.codec.decoder().feed(b'\x00\x00\x00\x02\x01\x05')
+
+
+class TestPaddedCodec(unittest.TestCase):
+    codec = PaddedCodec()
+
+    def test_Encode_Pads_to_bufsize(self):
+        self.assertEqual(len(self.codec.encode(LOGIN_COMMAND, 'success')), BUFSIZE)
+
+    def test_Decode_Split_frames_Round_trip(self):
+        data = self.codec.encode(LOGIN_COMMAND, 'exists') + self.codec.encode(SEND_MESSAGE_COMMAND, 'Success')
+        decoder = self.codec.decoder()
+        self.assertEqual(decoder.feed(data[:1500]), [Frame(LOGIN_COMMAND, ['exists'])])
+        self.assertEqual(decoder.feed(data[1500:]), [Frame(SEND_MESSAGE_COMMAND, ['Success'])])
+
+    def test_Decode_Request_id_Round_trips(self):
+        frame = self.codec.encode(CHECK_ACCOUNT_COMMAND, 'bob', request_id=7)
+        self.assertEqual(self.codec.decoder().feed(frame), [Frame(CHECK_ACCOUNT_COMMAND, ['bob'], 7)])
+
+    def test_Encode_Oversized_message_Raises(self):
+        with self.assertRaises(ProtocolError):
+            self.codec.encode(VIEW_USERS_COMMAND, 'x' * BUFSIZE)
+
+
+class TestFrameReader(unittest.TestCase):
+    def test_Read_Coalesced_frames_Returns_one_at_a_time_then_none(self):
+        codec = FramedCodec()
+        sock = MagicMock()
+        sock.recv.side_effect = [codec.encode(LOGIN_COMMAND, 'a') + codec.encode(QUIT_COMMAND), b'']
+        reader = FrameReader(sock, codec)
+        self.assertEqual(reader.read(), Frame(LOGIN_COMMAND, ['a']))
+        self.assertEqual(reader.read(), Frame(QUIT_COMMAND, []))
+        self.assertIsNone(reader.read())
+
+
+class TestResponseDispatcher(unittest.TestCase):
+    def test_Resolve_Out_of_order_responses_Reach_their_own_requests(self):
+        dispatcher = ResponseDispatcher()
+        requests = [dispatcher.register(CHECK_ACCOUNT_COMMAND) for _ in range(10)]
+        for request_id, _ in reversed(requests):
+            self.assertTrue(dispatcher.resolve(Frame(CHECK_ACCOUNT_COMMAND, [str(request_id)], request_id)))
+        self.assertEqual([future.result(0) for _, future in requests], [[str(i)] for i, _ in requests])
+
+    def test_Resolve_Untagged_or_unknown_response_Returns_false(self):
+        dispatcher = ResponseDispatcher()
+        self.assertFalse(dispatcher.resolve(Frame(LOGIN_COMMAND, ['exists'])))
+        self.assertFalse(dispatcher.resolve(Frame(LOGIN_COMMAND, ['exists'], 42)))
+
+    def test_Resolve_Wrong_command_Fails_request(self):
+        dispatcher = ResponseDispatcher()
+        request_id, future = dispatcher.register(CHECK_ACCOUNT_COMMAND)
+        dispatcher.resolve(Frame(VIEW_USERS_COMMAND, [], request_id))
+        with self.assertRaises(ProtocolError):
+            future.result(0)
+
+    def test_Resolve_Streamed_responses_Queue_until_last(self):
+        dispatcher = ResponseDispatcher()
+        request_id, responses = dispatcher.register_stream(VIEW_USERS_COMMAND, lambda args: not args[0])
+        for page in (['b', 'a', 'b'], ['', 'c']):
+            self.assertTrue(dispatcher.resolve(Frame(VIEW_USERS_COMMAND, page, request_id)))
+        self.assertFalse(dispatcher.resolve(Frame(VIEW_USERS_COMMAND, ['', 'd'], request_id)))
+        self.assertEqual([responses.get_nowait(), responses.get_nowait()], [['b', 'a', 'b'], ['', 'c']])
+
+
+if __name__ == '__main__':
+    unittest.main()
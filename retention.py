@@ -0,0 +1,97 @@
+"""Retention limits for message history.
+
+Three limits bound the history, each optional:
+
+- `HISTORY_MAX_MESSAGES`: the most messages kept per conversation;
+- `HISTORY_MAX_AGE_DAYS`: how long a message is kept, judged by its sent time;
+- `HISTORY_MEMORY_BUDGET`: the bytes every conversation's columns may use in
+  total. When the history goes over it, conversations are capped at the size
+  that brings the total back to `BUDGET_TARGET` of the budget, so the largest
+  conversations lose their oldest messages first and small ones are untouched.
+
+Messages always expire oldest first. A background thread applies the limits one
+conversation at a time, every `RETENTION_INTERVAL` seconds, holding only that
+conversation's lock while it is trimmed, so expiry never pauses the server.
+Trimming many messages at once is cheap, as the columns are cut from the front.
+"""
+from datetime import datetime
+import threading
+from config import *
+from history import encode_time
+
+# Fraction of the memory budget the history is trimmed down to, so it isn't over again straight away
+BUDGET_TARGET = 0.9
+
+
+def water_level(sizes, budget):
+    """Return the largest cap on each size that brings their total within `budget`"""
+
+    sizes = sorted(sizes)
+    remaining = budget
+    for i, size in enumerate(sizes):
+        share = remaining // (len(sizes) - i)
+        if size > share:
+            return share
+        remaining -= size
+    return None
+
+
+class Retention:
+    """Expires messages past the retention limits from `history`, whose conversations are guarded by `locks`"""
+
+    def __init__(self, history, locks, max_messages=HISTORY_MAX_MESSAGES, max_age_days=HISTORY_MAX_AGE_DAYS,
+                 memory_budget=HISTORY_MEMORY_BUDGET, interval=RETENTION_INTERVAL):
+        self.history = history
+        self.locks = locks
+        self.max_messages = max_messages
+        self.max_age_days = max_age_days
+        self.memory_budget = memory_budget
+        self.interval = interval
+        self.level = None   # Bytes each conversation is capped at while the history is over its memory budget
+        self.expired = 0    # Messages expired so far
+        self.usage = None   # Messages, bytes and conversations counted by the last pass
+        self.closed = threading.Event()
+        self.thread = None
+
+    def enabled(self):
+        return any(limit is not None for limit in (self.max_messages, self.max_age_days, self.memory_budget))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Apply the limits every `interval` seconds until closed"""
+
+        while not self.closed.wait(self.interval):
+            # A pass that finds the history over budget has set the cap the next one trims to
+            if self.expire_pass() and not self.closed.is_set():
+                self.expire_pass()
+
+    def expire_pass(self):
+        """Apply the limits to every conversation once, returning whether the history was over its memory budget"""
+
+        cutoff = None
+        if self.max_age_days is not None:
+            cutoff = encode_time(datetime.now().strftime(TIME_FORMAT)) - int(self.max_age_days * 1440)
+
+        sizes, messages, expired = [], 0, 0
+        for conversation in self.history.conversations():
+            with self.locks[conversation.sender, conversation.recipient]:
+                count = conversation.expirable(self.max_messages, cutoff, self.level)
+                conversation.expire(count)
+                sizes.append(conversation.nbytes())
+                messages += len(conversation)
+            expired += count
+        self.expired += expired
+
+        total = sum(sizes)
+        self.usage = {'messages': messages, 'bytes': total, 'conversations': len(sizes)}
+        over = self.memory_budget is not None and total > self.memory_budget
+        self.level = water_level(sizes, int(self.memory_budget * BUDGET_TARGET)) if over else None
+        return over
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
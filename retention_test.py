@@ -0,0 +1,78 @@
+from history import MessageHistory, UserMessage
+from locks import LockStripes
+from retention import Retention, water_level
+import threading
+import unittest
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.history = MessageHistory()
+        self.locks = LockStripes()
+
+    def fill(self, sender, recipient, count, size=100):
+        for i in range(count):
+            self.history.append(UserMessage(sender, recipient, 'x' * size, '2023-03-01 12:00'))
+
+    def test_Water_level_Caps_only_the_largest(self):
+        self.assertEqual(water_level([10, 20, 1000], 130), 100)
+        self.assertEqual(water_level([50, 50], 40), 20)
+        self.assertIsNone(water_level([10, 20], 100))
+
+    def test_Expire_pass_Max_messages_Keeps_newest(self):
+        self.fill('a', 'b', 50)
+        self.fill('b', 'a', 5)
+        retention = Retention(self.history, self.locks, max_messages=10)
+        self.assertFalse(retention.expire_pass())
+        self.assertEqual((len(self.history['a']['b']), len(self.history['b']['a'])), (10, 5))
+        self.assertEqual(retention.expired, 40)
+        self.assertEqual(retention.usage['messages'], 15)
+
+    def test_Expire_pass_Max_age_Drops_old_messages(self):
+        self.history.append(UserMessage('a', 'b', 'old', '2000-01-01 00:00'))
+        self.history.append(UserMessage('a', 'b', 'new', '9999-01-01 00:00'))
+        Retention(self.history, self.locks, max_age_days=30).expire_pass()
+        self.assertEqual([m.message for m in self.history['a']['b']], ['new'])
+
+    def test_Expire_pass_Over_budget_Trims_largest_conversations_first(self):
+        self.fill('chatty', 'b', 2000)
+        self.fill('quiet', 'b', 10)
+        small = self.history['quiet']['b'].nbytes()
+        budget = 50000
+        retention = Retention(self.history, self.locks, memory_budget=budget)
+        self.assertTrue(retention.expire_pass())
+        self.assertFalse(retention.expire_pass())
+        self.assertLessEqual(self.history.nbytes(), budget)
+        self.assertEqual(self.history['quiet']['b'].nbytes(), small)
+        self.assertGreater(len(self.history['chatty']['b']), 0)
+
+    def test_Expire_pass_Concurrent_appends_Lose_nothing_unexpired(self):
+        retention = Retention(self.history, self.locks, max_messages=100)
+        stop = threading.Event()
+
+        def send(sender):
+            for i in range(3000):
+                with self.locks[sender, 'r']:
+                    self.history.append(UserMessage(sender, 'r', str(i), '2023-03-01 12:00'))
+
+        def expire():
+            while not stop.is_set():
+                retention.expire_pass()
+
+        expirer = threading.Thread(target=expire)
+        senders = [threading.Thread(target=send, args=(f's{i}',)) for i in range(4)]
+        expirer.start()
+        for t in senders:
+            t.start()
+        for t in senders:
+            t.join()
+        stop.set()
+        expirer.join()
+        retention.expire_pass()
+        for i in range(4):
+            self.assertEqual([m.message for m in self.history[f's{i}']['r']], [str(n) for n in range(2900, 3000)])
+        self.assertEqual(retention.expired, 4 * 2900)
+
+
+if __name__ == '__main__':
+    unittest.main()
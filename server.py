@@ -1,63 +1,141 @@
-from collections import defaultdict
-import fnmatch
+from collections import deque
+import argparse
+import asyncio
+import contextvars
+import os
 import socket
 import hashlib
-import re
+import tempfile
 import threading
+import time
 from threading import Lock
 from config import *
+from protocol import FrameReader, ProtocolError, get_codec
+from outbox import ThreadedOutbox, AsyncOutbox
+from admin import start_admin_server
+from metrics import Metrics
+from profiling import Diagnostics
+from retention import Retention
+from locks import LockStripes
+from offline_queue import OfflineQueues
+from groups import Groups, GroupMessage
+from presence import Presence
+from history import MessageHistory, UserMessage, encode_time, IRREGULAR_TIME
+from user_directory import UserDirectory
+from snapshot import Snapshotter, load_latest_snapshot, remove_compacted_files, write_snapshot
+from wal import WriteAheadLog, numbered_files, read_log, segment_path, SEGMENT_SUFFIX, ACCOUNT_CREATED, ACCOUNT_DELETED, MESSAGE_SENT, MESSAGE_QUEUED, QUEUE_DRAINED, \
+    GROUP_CREATED, GROUP_JOINED, GROUP_LEFT, GROUP_MESSAGE_QUEUED
+
+# Codec used to encode frames sent to clients
+codec = get_codec(WIRE_FORMAT)
 
 # Dictionary to store the users, their messages, and the unsent message queue
-accounts = {}                                      # Maps username to password hash
-messages = defaultdict(lambda: defaultdict(list))  # Organized such that [s][r] holds a list of UserMessages sent from sender `s` to recipient `r`
-unsent_message_queue = defaultdict(list)           # Organized such that [r] holds a list of unsent UserMessages to recipient `r`
+accounts = UserDirectory()                         # Maps username to password hash
+messages = MessageHistory()                        # Organized such that [s][r] holds the UserMessages sent from sender `s` to recipient `r`
+unsent_message_queue = OfflineQueues()             # Organized such that [r] holds the OfflineQueue of unsent UserMessages to recipient `r`
+groups = Groups()                                  # Group conversations and their members (see groups.py)
 
-# Thread locks
-client_locks = {}  # Maps client to lock
-user_locks = {}    # Maps username to lock
+# Thread locks (see locks.py)
+client_locks = {}                   # Maps client to the lock that serialises writes to its socket
+user_locks = LockStripes()          # Guards a user's account, connected clients and offline queue
+conversation_locks = LockStripes()  # Guards the messages sent from one user to another, keyed by (sender, recipient)
+group_locks = LockStripes()         # Guards a group's members, keyed by group name; taken before any user lock
 
-# Currently connected clients (maps from username to client socket)
-connected_clients = defaultdict(set)
+# Maps client to the FrameReader that buffers its incoming frames
+client_readers = {}
 
-# Define class to package user message information
-class UserMessage:
-    def __init__(self, sender, recipient, message, time):
-        self.sender = sender
-        self.recipient = recipient
-        self.message = message
-        self.time = time
+# Maps client to the Outbox that queues its outgoing frames
+client_outboxes = {}
 
-    def __eq__(self, other):
-        return self.sender == other.sender and\
-            self.recipient == other.recipient and\
-            self.message == other.message and\
-            self.time == other.time
+# Client and request id of the frame being handled, so that responses to it echo the id
+current_request = contextvars.ContextVar('current_request', default=(None, None))
+
+# Write-ahead log that state changes are recorded to (None while persistence is disabled)
+wal = None
+
+# Takes periodic snapshots of the write-ahead log so that it can be truncated
+snapshotter = None
+
+# Expires messages past the retention limits (None while no limit is set)
+retention = None
+
+# Temporary directory that offline queues spill to while persistence is disabled
+spill_directory = None
+
+# What to do with a message for an offline recipient whose queue is full
+OFFLINE_OVERFLOW_POLICIES = ('drop_oldest', 'reject')
+
+# Currently connected clients (maps from username to the set of its client sockets), indexed for VIEW_USERS queries
+connected_clients = UserDirectory(set)
+
+def unsent_queue_depths():
+    """Return the number of messages queued for each user with an offline queue"""
+
+    return [len(queue) for queue in list(unsent_message_queue.values())]
+
+
+# Request counts, errors and latencies by command, and gauges of the server's state, served at /metrics on the admin port
+metrics = Metrics()
+metrics.gauge('connected_sockets', "Open client connections.", lambda: len(client_locks))
+metrics.gauge('online_users', "Users logged in on at least one device.", lambda: len(connected_clients))
+metrics.gauge('unsent_messages', "Messages waiting in offline queues.", lambda: sum(unsent_queue_depths()))
+metrics.gauge('spilled_unsent_messages', "Messages waiting in offline queues that are held on disk.", lambda: unsent_message_queue.spilled())
+metrics.gauge('max_unsent_backlog', "Messages waiting in the longest offline queue.", lambda: max(unsent_queue_depths(), default=0))
+metrics.gauge('groups', "Group conversations.", lambda: len(groups))
+metrics.gauge('history_messages', "Messages kept in the message history.", lambda: messages.message_count())
+metrics.gauge('history_bytes', "Bytes used by the message history.", lambda: messages.nbytes())
+metrics.counter('history_expired_messages_total', "Messages expired from the history by the retention limits.",
+                lambda: retention.expired if retention else 0)
+metrics.gauge('presence_subscribers', "Clients subscribed to presence changes.", lambda: len(presence.subscribers))
+metrics.counter('presence_batches_total', "Batches of presence changes pushed to subscribers.", lambda: presence.batches)
+metrics.counter('offline_messages_dropped_total', "Queued messages evicted or dropped because an offline queue was full.")
+metrics.counter('offline_messages_rejected_total', "Messages refused because the recipient's offline queue was full.")
+if HISTORY_MEMORY_BUDGET is not None:
+    metrics.gauge('history_memory_budget_bytes', "Bytes the message history may use.", lambda: HISTORY_MEMORY_BUDGET)
+if OFFLINE_QUEUE_LIMIT is not None:
+    metrics.gauge('offline_queue_limit', "Most messages queued for one offline recipient.", lambda: OFFLINE_QUEUE_LIMIT)
+
+
+def describe_state():
+    """Return lines giving the size of the server's main structures, which head each allocation report"""
+
+    depths = unsent_queue_depths()
+    return [
+        f"messages: {messages.message_count():,} messages in {messages.nbytes():,} bytes",
+        f"client_locks: {len(client_locks):,} sockets",
+        f"user_locks: {len(user_locks.locks):,} stripes, conversation_locks: {len(conversation_locks.locks):,} stripes",
+        f"connected_clients: {len(connected_clients):,} users online",
+        f"unsent_message_queue: {sum(depths):,} messages queued for {len(depths):,} users, {unsent_message_queue.spilled():,} of them on disk",
+        "",
+    ]
+
+
+# Profiles and allocation traces taken on demand, from the admin port or by signal
+diagnostics = Diagnostics(describe=describe_state)
 
 
 def process_message(client):
-    """Process the message from the client and return the command and arguments"""
+    """Process the next frame from the client and return it (command, arguments and request id)"""
 
-    message = client.recv(BUFSIZE).decode()
-    command, *args = message.split("|")
     try:
-        return int(command), args
-    except:
+        return client_readers[client].read()
+    except (OSError, ProtocolError):
         return None
 
 
 def process_specific_message(client, desired_command):
     """Process the message from the client, hope to get the desired command, and return the arguments if successful"""
 
-    message = client.recv(BUFSIZE).decode()
-    if not message:
+    message = process_message(client)
+    if message is None:
         print("The client disconnected.")
         return None
 
-    command, *args = message.split("|")
-    if int(command) == QUIT_COMMAND:
+    command, args = message.command, message.args
+    if command == QUIT_COMMAND:
         return None
 
-    if int(command) != desired_command:
+    if command != desired_command:
         print("An error occurred.")
         return None
 
@@ -65,26 +143,166 @@ def process_specific_message(client, desired_command):
 
 
 def send_message(client, command, *args):
-    """Send a message to each client"""
+    """Send a message to each client, tagged with the request id if it answers that client's current request"""
+
+    send_frame(client, encode_response(client, command, *args))
+
+
+def encode_response(client, command, *args):
+    """Encode a frame for `client`, tagged with the request id if it answers that client's current request"""
+
+    request_client, request_id = current_request.get()
+    if request_client is not client:
+        request_id = None
+    elif args[:1] == ('error',):
+        metrics.error(command)
+    return codec.encode(command, *args, request_id=request_id)
+
+
+def send_message_when_durable(client, seq, command, *args):
+    """Send a message once log record `seq` is durable, without blocking the caller.
+
+    Under the 'always' fsync policy the frame is sent by the log's syncer thread
+    after the fsync that covers `seq`; otherwise it is sent right away.
+    """
+
+    frame = encode_response(client, command, *args)
+    if wal is None or seq is None or wal.fsync_policy != 'always':
+        send_frame(client, frame)
+    else:
+        wal.when_durable(seq, lambda: send_frame(client, frame))
+
+
+def log_record(record_type, *fields):
+    """Append a record to the write-ahead log and return its sequence number (None while persistence is disabled)"""
+
+    if wal is None:
+        return None
+    return wal.append(record_type, *fields)
+
+
+def send_frame(client, frame, message=None):
+    """Queue an encoded frame on the client's outbox; `message` is the UserMessage it carries, if any"""
+
+    outbox = client_outboxes.get(client)
+    if outbox is not None:
+        return outbox.put(frame, message)
+
+    # Clients without an outbox are written to directly; one that has quit has neither
+    lock = client_locks.get(client)
+    if lock is None:
+        return False
+    with lock:
+        client.sendall(frame)
+    return True
+
+
+# Pushes batches of changes to `connected_clients` to the clients subscribed with SUBSCRIBE_PRESENCE
+presence = Presence(send_frame, codec)
+
+
+def offline_queue_full(recipient):
+    """Return whether `recipient`'s offline queue holds `OFFLINE_QUEUE_LIMIT` messages"""
+
+    return OFFLINE_QUEUE_LIMIT is not None and len(unsent_message_queue.get(recipient, ())) >= OFFLINE_QUEUE_LIMIT
+
+
+def trim_offline_queue(recipient):
+    """Evict the oldest messages queued for `recipient` beyond `OFFLINE_QUEUE_LIMIT` (call with the recipient's lock held)"""
+
+    if OFFLINE_QUEUE_LIMIT is None:
+        return
+    unsent_messages = unsent_message_queue[recipient]
+    excess = len(unsent_messages) - OFFLINE_QUEUE_LIMIT
+    if excess > 0:
+        for _ in range(excess):
+            unsent_messages.popleft()
+        log_record(QUEUE_DRAINED, recipient, str(excess))
+        metrics.count('offline_messages_dropped_total', excess)
+
+
+def spill_to_offline_queue(message):
+    """Put a message that overflowed its recipient's outbox back on their offline queue"""
+
+    if isinstance(message, GroupMessage):
+        spill_group_message(message)
+        return
+
+    with user_locks[message.recipient]:
+        # The message was already accepted, so under 'reject' a full queue drops it
+        if OFFLINE_QUEUE_OVERFLOW == 'reject' and offline_queue_full(message.recipient):
+            metrics.count('offline_messages_dropped_total')
+            return
+        unsent_message_queue[message.recipient].append(message)
+        log_record(MESSAGE_QUEUED, message.sender, message.recipient, message.message, message.time)
+        trim_offline_queue(message.recipient)
+
+
+def spill_group_message(delivery):
+    """Put a group message that overflowed a member's outbox back on the member's offline queue"""
 
-    with client_locks[client]:
-        message = f"{command}|" + "|".join(args)
-        message += '|'
-        padding = ' ' * (BUFSIZE - len(message))
-        message += padding
-        client.send(message.encode())
+    member, message = delivery.member, delivery.message
+    with user_locks[member]:
+        if OFFLINE_QUEUE_OVERFLOW == 'reject' and offline_queue_full(member):
+            metrics.count('offline_messages_dropped_total')
+            return
+        unsent_message_queue[member].append(message)
+        log_record(GROUP_MESSAGE_QUEUED, member, message.sender, message.recipient, message.message, message.time)
+        trim_offline_queue(member)
 
 
-def login(lock, client):
+def create_account(username, password_hash, client):
+    """Create account `username` and log `client` in to it as one step.
+
+    Returns whether the account was created (False if another client created it
+    first) and the log sequence number of its record.
+    """
+
+    with user_locks[username]:
+        if username in accounts:
+            return False, None
+        accounts[username] = password_hash
+        connected_clients[username].add(client)
+        presence.changed(username, True)
+        return True, log_record(ACCOUNT_CREATED, username, password_hash)
+
+
+def connect_client(username, client, password_hash):
+    """Log `client` in to `username` if `password_hash` matches, returning whether it did"""
+
+    with user_locks[username]:
+        if accounts.get(username) != password_hash:
+            return False
+        clients = connected_clients[username]
+        if not clients:
+            presence.changed(username, True)
+        clients.add(client)
+        return True
+
+
+def disconnect_client(username, client):
+    """Log `client` out of `username`, dropping the user from the connected clients once no device is left"""
+
+    with user_locks[username]:
+        clients = connected_clients.get(username)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del connected_clients[username]
+                presence.changed(username, False)
+
+
+def login(client):
     """Login the user and return the username"""
     message = process_message(client)
     if message is None:
         return None
-    command, args = message
+    command, args = message.command, message.args
     if command != LOGIN_COMMAND:
         return None
 
     username = args[0]
+    seq = None
     if username in accounts:
         # If the username exists, ask for password
         send_message(client, LOGIN_COMMAND, "exists")
@@ -95,16 +313,14 @@ def login(lock, client):
             return None
         password_hash = response[0]
 
-        while accounts[username] != password_hash:
+        # Add the client to the connected clients list once the password matches
+        while not connect_client(username, client, password_hash):
             send_message(client, LOGIN_COMMAND, "error")
             response = process_specific_message(client, LOGIN_COMMAND)
             if response is None:
                 return None
             password_hash = response[0]
     else:
-        # Create new lock associated with username
-        user_locks[username] = Lock()
-
         # If the username doesn't exist
 
         send_message(client, LOGIN_COMMAND, "new")
@@ -114,45 +330,138 @@ def login(lock, client):
         if response is None:
             return None
         password_hash = response[0]
-        accounts[username] = password_hash
 
-    # Add the client to the connected clients list
-    connected_clients[username].add(client)
+        # Register the account, unless another client beat us to it with a different password
+        created, seq = create_account(username, password_hash, client)
+        if not created and not connect_client(username, client, password_hash):
+            send_message(client, LOGIN_COMMAND, "error")
+            return None
 
-    # Send a success message to the client
+    # Send a success message to the client once any new account is durable
 
-    send_message(client, LOGIN_COMMAND, "success")
+    send_message_when_durable(client, seq, LOGIN_COMMAND, "success")
     print(f"{username} has joined the chat!")
 
     return username
 
 
-def list_users(client, username, query: str = '*'):
-    """List all users matching the inputted wildcard text query"""
+def list_users(client, username, query: str = '*', limit=None, cursor=''):
+    """List all users matching the inputted wildcard text query.
+
+    Without a `limit`, the matches are sent in one frame (as many as fit). With a
+    positive `limit`, one page of at most `limit` matches after `cursor` is sent,
+    led by the cursor for the next page ('' once there are no more). A `limit` of
+    0 streams every match after `cursor` as a series of such pages, the last of
+    which has an empty cursor.
+    """
+
+    if limit == 0:
+        outbox = client_outboxes.get(client)
+        for page in user_pages(username, query, cursor, VIEW_USERS_PAGE_SIZE):
+            send_message(client, VIEW_USERS_COMMAND, *page)
+            if outbox is not None and page[0]:
+                outbox.drain()
+        return None
 
-    all_connected_users = list(filter(lambda x: x != username, connected_clients.keys()))
-    if all_connected_users:
-        # If no wildcard query provided, return all active users other than the current user
-        if query == '*':
-            send_message(client, VIEW_USERS_COMMAND, *all_connected_users)
-            return all_connected_users
+    if limit is not None:
+        page = next(user_pages(username, query, cursor, min(limit, VIEW_USERS_PAGE_SIZE)))
+        send_message(client, VIEW_USERS_COMMAND, *page)
+        return page[1:]
 
-        # Translate wildcard query to regex
-        regex = fnmatch.translate(query)
-        pattern = re.compile(regex)
-        result = list(filter(pattern.match, all_connected_users))
+    result = next(user_pages(username, query))[1:]
 
-        # If username matches exist, return those matches
-        if result:
-            send_message(client, VIEW_USERS_COMMAND, *result)
-            return result
+    # If username matches exist, return those matches
+    if result:
+        send_message(client, VIEW_USERS_COMMAND, *result)
+        return result
 
     # Else return that no users were found.
     send_message(client, VIEW_USERS_COMMAND, "No users found.")
     return None
 
 
-def deliver_new_message(lock, client, *args):
+async def list_users_async(client, username, query, cursor):
+    """Event loop version of streaming `list_users`"""
+
+    outbox = client_outboxes.get(client)
+    for page in user_pages(username, query, cursor, VIEW_USERS_PAGE_SIZE):
+        send_message(client, VIEW_USERS_COMMAND, *page)
+        if outbox is not None and page[0]:
+            await outbox.drain()
+
+
+def user_pages(username, query, cursor='', limit=None):
+    """Yield pages of the connected users matching `query` after `cursor`, other than `username`.
+
+    Each page is [next cursor, *usernames] and holds at most `limit` usernames
+    (any number if None), fewer if more would not fit in one frame. The last page
+    has an empty cursor.
+    """
+
+    budget = codec.frame_budget
+    names, size = [], 0
+    for name in connected_clients.iter_match(query, cursor or None):
+        if name == username:
+            continue
+        # Leave room for the page's cursor, which is at most as long as its longest name
+        cost = len(name.encode()) + codec.field_overhead
+        if names and (len(names) == limit or size + 2 * cost > budget):
+            yield [names[-1]] + names
+            names, size = [], 0
+        names.append(name)
+        size += cost
+    yield [''] + names
+
+
+def parse_view_users_request(args):
+    """Split VIEW_USERS arguments into (query, limit, cursor); limit is None for the original one-argument form"""
+
+    if len(args) < 3:
+        return args[0], None, ''
+    query, limit, cursor = args[:3]
+    return query, int(limit) if limit.isdigit() else VIEW_USERS_PAGE_SIZE, cursor
+
+
+def send_history(client, username, other, start='', end='', limit='', cursor=''):
+    """Send one page of the conversation between `username` and `other`, newest first.
+
+    `start` and `end` are optional `TIME_FORMAT` bounds (inclusive) and `limit` the
+    most messages wanted. The page is [next cursor, then sender, recipient, message
+    and time for each message]; pass the cursor back for the next page, which is ''
+    once there are no more. Malformed arguments are answered with ['error'].
+    """
+
+    try:
+        bounds = [None if not bound else encode_time(bound) for bound in (start, end)]
+        if IRREGULAR_TIME in bounds:
+            raise ValueError("Time bounds must be in TIME_FORMAT.")
+        limit = min(int(limit), HISTORY_PAGE_SIZE) if limit else HISTORY_PAGE_SIZE
+        if limit < 1:
+            raise ValueError("The limit must be positive.")
+        # Leave room for the page's cursor: two ranks of at most 20 digits each
+        budget = codec.frame_budget - 41 - codec.field_overhead
+        fields, size, next_cursor = [], 0, ''
+        # Hold both directions of the conversation, so retention can't expire messages from under the page
+        with conversation_locks.hold((username, other), (other, username)):
+            for message, message_cursor in messages.newest_first(username, other, *bounds, cursor):
+                values = (message.sender, message.recipient, message.message, message.time)
+                cost = sum(len(value.encode()) for value in values) + 4 * codec.field_overhead
+                if fields and (len(fields) == 4 * limit or size + cost > budget):
+                    break
+                fields += values
+                size += cost
+                next_cursor = message_cursor
+            else:
+                next_cursor = ''
+    except ValueError:
+        send_message(client, HISTORY_COMMAND, 'error')
+        return None
+
+    send_message(client, HISTORY_COMMAND, next_cursor, *fields)
+    return fields
+
+
+def deliver_new_message(client, *args):
     """Delivers new message to recipient, if the recipient is active, otherwise queues message"""
 
     sender, recipient, message, time = args
@@ -160,146 +469,778 @@ def deliver_new_message(lock, client, *args):
     # Package message into UserMessage instance for cleaner storage
     packaged_message = UserMessage(sender, recipient, message, time)
 
-    # If recipient not logged in, queue up message
-    if recipient not in connected_clients:
-        with user_locks[recipient]:
+    # Holding the recipient's lock, they can't log in or out while the message is being queued or delivered
+    with user_locks[recipient]:
+        recipient_clients = connected_clients.get(recipient)
+
+        # If recipient not logged in, queue up message (or refuse it, if their queue is full under 'reject')
+        if not recipient_clients:
+            if OFFLINE_QUEUE_OVERFLOW == 'reject' and offline_queue_full(recipient):
+                metrics.count('offline_messages_rejected_total')
+                send_message(client, SEND_MESSAGE_COMMAND, 'error')
+                return None
             unsent_message_queue[recipient].append(packaged_message)
+            seq = log_record(MESSAGE_SENT, sender, recipient, message, time, '1')
+            trim_offline_queue(recipient)
 
-    # Else deliver message to each device the recipient is logged in to
-    else:
-        for c in connected_clients[recipient]:
-            deliver_unsent_message(c, packaged_message)
+        # Else deliver message to each device the recipient is logged in to
+        else:
+            seq = log_record(MESSAGE_SENT, sender, recipient, message, time, '0')
+            for c in recipient_clients:
+                deliver_unsent_message(c, packaged_message)
 
     # Store message in message history dictionary
-    with lock:
+    with conversation_locks[sender, recipient]:
         messages[sender][recipient].append(packaged_message)
 
-    # Success
-    send_message(client, SEND_MESSAGE_COMMAND, 'Success')
+    # Success, once the message is durable
+    send_message_when_durable(client, seq, SEND_MESSAGE_COMMAND, 'Success')
+    return packaged_message
+
+
+def change_group_membership(client, username, command, group):
+    """Create, join or leave `group` (by `command`) as `username`, answering 'success' or 'error'"""
+
+    with group_locks[group], user_locks[username]:
+        if command == CREATE_GROUP_COMMAND:
+            changed, record_type = bool(group) and groups.create(group, username), GROUP_CREATED
+        elif command == JOIN_GROUP_COMMAND:
+            changed, record_type = groups.join(group, username), GROUP_JOINED
+        else:
+            changed, record_type = groups.leave(group, username), GROUP_LEFT
+        if not changed:
+            send_message(client, command, 'error')
+            return False
+        seq = log_record(record_type, group, username)
+
+    send_message_when_durable(client, seq, command, 'success')
+    return True
+
+
+def send_group_message(client, username, group, message, time):
+    """Deliver a message from `username` to every other member of `group`, queueing it for those offline.
+
+    The delivery frame is the same for every member, so it is encoded once and
+    its bytes are shared by every connected device.
+    """
+
+    with group_locks[group]:
+        members = groups.members_of(group)
+    if members is None or username not in members:
+        send_message(client, SEND_GROUP_MESSAGE_COMMAND, 'error')
+        return None
+
+    packaged_message = UserMessage(username, group, message, time)
+    frame = codec.encode(RECEIVE_MESSAGE_COMMAND, username, group, message, time)
+    seq = None
+    for member in members:
+        if member == username:
+            continue
+        # As in `deliver_new_message`, the member can't log in or out while the message is delivered or queued
+        with user_locks[member]:
+            member_clients = connected_clients.get(member)
+            if member_clients:
+                delivery = GroupMessage(member, packaged_message)
+                for c in member_clients:
+                    send_frame(c, frame, delivery)
+            elif OFFLINE_QUEUE_OVERFLOW == 'reject' and offline_queue_full(member):
+                metrics.count('offline_messages_rejected_total')
+            else:
+                unsent_message_queue[member].append(packaged_message)
+                seq = log_record(GROUP_MESSAGE_QUEUED, member, username, group, message, time)
+                trim_offline_queue(member)
+
+    # Success, once the message is durable for every member it was queued for
+    send_message_when_durable(client, seq, SEND_GROUP_MESSAGE_COMMAND, 'Success')
     return packaged_message
 
 
 def deliver_unsent_message(client, message):
     """Delivers unsent message to all instances where the recipent of the message is logged in"""
 
-    send_message(
+    send_frame(
         client,
-        RECEIVE_MESSAGE_COMMAND,
-        message.sender, message.recipient, message.message, message.time
+        codec.encode(RECEIVE_MESSAGE_COMMAND, message.sender, message.recipient, message.message, message.time),
+        message
     )
 
 
-def delete_account(client, username):
-    """Deletes account from records"""
+def take_unsent_messages(username, limit=OFFLINE_FLUSH_CHUNK, budget=None):
+    """Remove and return up to `limit` of the oldest messages queued for `username`.
+
+    With a `budget`, stop before the messages' fields would take more than that
+    many bytes of a frame (though the first message is always taken).
+    """
+
+    with user_locks[username]:
+        unsent_messages = unsent_message_queue.get(username)
+        if not unsent_messages:
+            return []
+        messages, size = [], 0
+        while unsent_messages and len(messages) < limit:
+            message = unsent_messages.popleft()
+            if budget is not None:
+                values = (message.sender, message.recipient, message.message, message.time)
+                cost = sum(len(value.encode()) for value in values) + 4 * codec.field_overhead
+                if messages and size + cost > budget:
+                    unsent_messages.extendleft([message])
+                    break
+                size += cost
+            messages.append(message)
+        return messages
+
+
+def requeue_unsent_messages(username, messages):
+    """Put messages that could not be handed to the client back at the front of the queue"""
 
     with user_locks[username]:
+        unsent_message_queue[username].extendleft(reversed(messages))
+
+
+def encode_unsent_messages(messages):
+    """Encode a chunk of queued messages as one RECEIVE_MESSAGES frame (one frame each in the padded format)"""
+
+    if codec.name == 'padded':
+        return b''.join(
+            codec.encode(RECEIVE_MESSAGE_COMMAND, m.sender, m.recipient, m.message, m.time) for m in messages)
+
+    fields = []
+    for m in messages:
+        fields += (m.sender, m.recipient, m.message, m.time)
+    return codec.encode(RECEIVE_MESSAGES_COMMAND, *fields)
+
+
+def take_unsent_frame(username, room=None):
+    """Remove the next chunk of messages queued for `username` and encode it, returning (messages, frame).
+
+    A chunk holds at most `OFFLINE_FLUSH_CHUNK` messages and, unless each goes in
+    a frame of its own, no more than fit in one frame (or in `room` bytes, if
+    given). A chunk that can't be encoded is put back, so its messages aren't
+    lost. Returns ([], None) when there is nothing to send.
+    """
+
+    budget = None if codec.name == 'padded' else min(codec.frame_budget, room or codec.frame_budget)
+    messages = take_unsent_messages(username, budget=budget)
+    if not messages:
+        return [], None
+    try:
+        return messages, encode_unsent_messages(messages)
+    except ProtocolError as e:
+        requeue_unsent_messages(username, messages)
+        print(f"Could not deliver {username}'s queued messages: {e}")
+        return [], None
+
+
+def refill_unsent_messages(client, username):
+    """Offer the messages queued for `username` to `client`'s outbox while it has room, without blocking.
+
+    This is the outbox's `refill` callback, run once the outbox has drained after
+    messages overflowed it onto the offline queue. Whatever doesn't fit is put
+    back and waits for the next refill.
+    """
+
+    outbox = client_outboxes.get(client)
+    if outbox is None:
+        return
+    while True:
+        # Chunks of half the limit fit once the outbox has drained to half
+        messages, frame = take_unsent_frame(username, outbox.limit // 2)
+        if not messages:
+            return
+        if not outbox.offer(frame):
+            requeue_unsent_messages(username, messages)
+            outbox.schedule_refill()
+            return
+        log_record(QUEUE_DRAINED, username, str(len(messages)))
+
+
+def flush_unsent_messages(client, username):
+    """Deliver every message queued for `username` to `client` in chunks, letting each chunk drain before the next"""
+
+    outbox = client_outboxes.get(client)
+    while True:
+        messages, frame = take_unsent_frame(username)
+        if not messages:
+            break
+        if not send_frame(client, frame):
+            requeue_unsent_messages(username, messages)
+            break
+        log_record(QUEUE_DRAINED, username, str(len(messages)))
+        if outbox is not None:
+            outbox.drain()
+
+
+async def flush_unsent_messages_async(client, username):
+    """Event loop version of `flush_unsent_messages`"""
+
+    outbox = client_outboxes.get(client)
+    while True:
+        messages, frame = take_unsent_frame(username)
+        if not messages:
+            break
+        if not send_frame(client, frame):
+            requeue_unsent_messages(username, messages)
+            break
+        log_record(QUEUE_DRAINED, username, str(len(messages)))
+        if outbox is not None:
+            await outbox.drain()
+
+
+def delete_account(client, username, password_hash):
+    """Deletes account from records if `password_hash` matches, checking and deleting as one step"""
+
+    with user_locks[username]:
+        if accounts.get(username) != password_hash:
+            send_message(client, DELETE_ACCOUNT_COMMAND, 'error')
+            return
         del accounts[username]
-        del unsent_message_queue[username]
+        unsent_message_queue.pop(username, None)
+        seq = log_record(ACCOUNT_DELETED, username)
+
+    # Group locks come before user locks, so the account leaves its groups after the user lock is released
+    leave_groups(username)
+
+    send_message_when_durable(client, seq, DELETE_ACCOUNT_COMMAND, 'success')
+
+
+def leave_groups(username):
+    """Remove `username` from every group they belong to"""
+
+    for group in groups.groups_of(username):
+        with group_locks[group], user_locks[username]:
+            groups.leave(group, username)
+
+
+def apply_log_record(record_type, fields):
+    """Replay one write-ahead log record against the server's state"""
+
+    if record_type == ACCOUNT_CREATED:
+        username, password_hash = fields
+        accounts[username] = password_hash
+    elif record_type == ACCOUNT_DELETED:
+        username, = fields
+        accounts.pop(username, None)
+        unsent_message_queue.pop(username, None)
+        leave_groups(username)
+    elif record_type == MESSAGE_SENT:
+        sender, recipient, message, time, queued = fields
+        packaged_message = UserMessage(sender, recipient, message, time)
+        messages[sender][recipient].append(packaged_message)
+        if queued == '1':
+            unsent_message_queue[recipient].append(packaged_message)
+    elif record_type == MESSAGE_QUEUED:
+        unsent_message_queue[fields[1]].append(UserMessage(*fields))
+    elif record_type == QUEUE_DRAINED:
+        recipient, count = fields
+        unsent_messages = unsent_message_queue[recipient]
+        for _ in range(min(int(count), len(unsent_messages))):
+            unsent_messages.popleft()
+    elif record_type == GROUP_CREATED:
+        groups.create(*fields)
+    elif record_type == GROUP_JOINED:
+        groups.join(*fields)
+    elif record_type == GROUP_LEFT:
+        groups.leave(*fields)
+    elif record_type == GROUP_MESSAGE_QUEUED:
+        member, sender, group, message, time = fields
+        unsent_message_queue[member].append(UserMessage(sender, group, message, time))
+
+
+def capture_state():
+    """Copy `accounts`, `messages`, `unsent_message_queue` and `groups` into plain containers for a snapshot"""
+
+    return {
+        'accounts': dict(accounts),
+        'messages': messages.export(),
+        'unsent': {
+            # Group messages also keep the group they were sent to
+            recipient: [(m.sender, m.message, m.time) if m.recipient == recipient else (m.sender, m.message, m.time, m.recipient)
+                        for m in unsent_messages]
+            for recipient, unsent_messages in unsent_message_queue.items() if unsent_messages
+        },
+        'groups': groups.export(),
+    }
+
+
+def restore_state(state):
+    """Replace the server's state with one produced by `capture_state`"""
+
+    accounts.clear()
+    accounts.update(state['accounts'])
+
+    messages.load(state['messages'])
+
+    unsent_message_queue.clear()
+    for recipient, unsent_messages in state['unsent'].items():
+        unsent_message_queue[recipient].extend(
+            UserMessage(m[0], m[3] if len(m) > 3 else recipient, m[1], m[2]) for m in unsent_messages)
+
+    # Snapshots from before groups existed have none
+    groups.load(state.get('groups', {}))
+
+
+def recover_state(directory, until=None):
+    """Load the newest snapshot in `directory` and replay the log segments after it (up to `until`), returning the number of records replayed"""
+
+    segment, state = load_latest_snapshot(directory, until)
+    if state is not None:
+        restore_state(state)
+
+    records = 0
+    for n in numbered_files(directory, SEGMENT_SUFFIX):
+        if n < segment or (until is not None and n >= until):
+            continue
+        for record_type, fields in read_log(segment_path(directory, n)):
+            apply_log_record(record_type, fields)
+            records += 1
+    return records
+
+
+def compact_log(directory, segment):
+    """Fold every log segment before `segment` into a new snapshot and delete what it replaces.
+
+    Runs in a child process (see `snapshot.Snapshotter`), so the state it rebuilds
+    is separate from the live server's.
+    """
+
+    recover_state(directory, segment)
 
-    send_message(client, DELETE_ACCOUNT_COMMAND, 'success')
+    # Leave expired messages out of the snapshot
+    compaction_retention = Retention(messages, conversation_locks)
+    if compaction_retention.enabled() and compaction_retention.expire_pass():
+        compaction_retention.expire_pass()
 
+    write_snapshot(directory, segment, capture_state())
+    remove_compacted_files(directory, segment)
 
-def quit(lock, client, username, address):
+
+def open_log(directory=DATA_DIRECTORY, fsync_policy=WAL_FSYNC_POLICY):
+    """Rebuild the server's state from the snapshot and write-ahead log in `directory`, then log all further changes to it"""
+
+    global wal
+
+    records = recover_state(directory)
+    wal = WriteAheadLog(directory, fsync_policy)
+    print(f"Recovered {len(accounts)} accounts from the snapshot and {records} log records in {directory}.")
+
+
+def start_snapshots(interval=SNAPSHOT_INTERVAL, min_records=SNAPSHOT_MIN_RECORDS):
+    """Periodically snapshot the write-ahead log in the background, truncating it each time"""
+
+    global snapshotter
+
+    snapshotter = Snapshotter(wal, compact_log, interval, min_records)
+
+
+def quit(client, username, address):
     """Logs out the instance of account `username` using socket `client`"""
 
+    # Log out `username` on the `client` socket
     if username:
-        with user_locks[username]:
-            # Log out `username` on the `client` socket
-            connected_clients[username].remove(client)
-
-            # If `username` maps to empty set, delete the `username`'s mapping entirely
-            if not connected_clients[username]:
-                del connected_clients[username]
+        disconnect_client(username, client)
 
-    with lock:
-        # Remove client lock
-        del client_locks[client]
+    # Remove client lock and frame reader, and stop pushing presence changes to it
+    presence.unsubscribe(client)
+    client_locks.pop(client, None)
+    client_readers.pop(client, None)
 
     if username:
         print(f"{username} has left the chat.")
     else:
         print(f"Connection from {address} was ended.")
 
-    client.close()
+    # Close once any queued frames have gone out
+    outbox = client_outboxes.pop(client, None)
+    if outbox is not None:
+        outbox.close()
+    else:
+        client.close()
+
+
+def dispatch_command(client, username, command, args):
+    """Run one command sent by `username` over `client`, returning False once the client has quit"""
+
+    if command == VIEW_USERS_COMMAND:
+        # List other active users based on wildcard query provided (if any)
+        list_users(client, username, *parse_view_users_request(args))
+    elif command == SEND_MESSAGE_COMMAND:
+        # Deliver message to user IF the recipient is logged in; otherwise, queue it.
+        deliver_new_message(client, *args)
+    elif command == CHECK_ACCOUNT_COMMAND:
+        # Returns to client whether an account is a registered account.
+        send_message(client, CHECK_ACCOUNT_COMMAND, str(args[0] in accounts))
+    elif command == MULTIPLE_LOGIN_COMMAND:
+        # Returns to client whether a user is currently logged in on multiple devices
+        send_message(client, MULTIPLE_LOGIN_COMMAND, str(len(connected_clients[username]) > 1))
+    elif command == LOGOUT_COMMAND:
+        # Logs out all instances of `username` aside from the one using socket `client`
+        with user_locks[username]:
+            for c in connected_clients.get(username, set()).copy():
+                if c != client:
+                    send_message(c, QUIT_COMMAND)
+        send_message(client, LOGOUT_COMMAND, 'success')
+    elif command == DELETE_ACCOUNT_COMMAND:
+        # Delete account if password is correct
+        delete_account(client, username, args[0])
+    elif command == HISTORY_COMMAND:
+        # Send a page of the conversation between `username` and another user, newest first
+        send_history(client, username, *args[:5])
+    elif command == SUBSCRIBE_PRESENCE_COMMAND:
+        # Send every online user, then push batches of users coming online or going offline
+        presence.subscribe(client, list(connected_clients))
+        send_message(client, SUBSCRIBE_PRESENCE_COMMAND, 'success')
+    elif command in (CREATE_GROUP_COMMAND, JOIN_GROUP_COMMAND, LEAVE_GROUP_COMMAND):
+        # Create, join or leave a group
+        change_group_membership(client, username, command, args[0])
+    elif command == SEND_GROUP_MESSAGE_COMMAND:
+        # Deliver a message to every other member of a group, queueing it for those offline
+        send_group_message(client, username, *args[:3])
+    elif command == QUIT_COMMAND:
+        return False
+    return True
+
+
+def dispatch_frame(client, username, frame):
+    """Run the command in `frame`, tagging any responses to it with the frame's request id and timing it"""
+
+    token = current_request.set((client, frame.request_id))
+    start = time.perf_counter()
+    failed = True
+    try:
+        result = dispatch_command(client, username, frame.command, frame.args)
+        failed = False
+        return result
+    finally:
+        metrics.observe(frame.command, time.perf_counter() - start, failed)
+        current_request.reset(token)
+
+
+async def dispatch_frame_async(client, username, frame):
+    """Event loop version of `dispatch_frame`, which streams VIEW_USERS results without blocking the loop"""
+
+    if frame.command == VIEW_USERS_COMMAND:
+        query, limit, cursor = parse_view_users_request(frame.args)
+        if limit == 0:
+            token = current_request.set((client, frame.request_id))
+            start = time.perf_counter()
+            failed = True
+            try:
+                await list_users_async(client, username, query, cursor)
+                failed = False
+            finally:
+                metrics.observe(frame.command, time.perf_counter() - start, failed)
+                current_request.reset(token)
+            return True
+    return dispatch_frame(client, username, frame)
+
+
+def start_refills(client, username):
+    """Have `client`'s outbox send it the messages that overflow onto `username`'s offline queue from now on"""
+
+    outbox = client_outboxes.get(client)
+    if outbox is not None:
+        outbox.refill = lambda: refill_unsent_messages(client, username)
+        # Anything that spilled while the queue was being flushed at login
+        outbox.schedule_refill()
+
+
+def handle_client(client, address):
+    """Handle the client connection"""
+
+    username = None
+    try:
+        username = login(client)
+        if not username:
+            return
+
+        # Send all messages that are queued immediately to client.
+        flush_unsent_messages(client, username)
+        start_refills(client, username)
+
+        while True:
+            message = process_message(client)
+            if message is None or not dispatch_frame(client, username, message):
+                break
+    except Exception as e:
+        # A malformed request ends this connection; log it rather than letting it end the thread before cleanup
+        print(f"Error handling connection from {address}: {e!r}")
+    finally:
+        quit(client, username, address)
+        # This thread handles no more requests
+        metrics.retire()
+
+
+class AsyncClientConnection:
+    """Wraps an asyncio stream pair so it can stand in for a client socket.
+
+    `send_message`, `quit` and the rest of the server only ever call `sendall` and
+    `close` on a client, so the command handlers run unchanged on the event loop.
+    Writes go straight into the transport buffer and never block the loop.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = codec.decoder()
+        self.frames = deque()
+
+    def sendall(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    async def read(self):
+        """Wait for the next full frame and return it, or None once the client disconnects"""
+
+        while not self.frames:
+            try:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    return None
+                self.frames.extend(self.decoder.feed(data))
+            except (OSError, ProtocolError):
+                return None
+        return self.frames.popleft()
 
 
-def handle_client(lock, client, address):
-    """Handle the client connection"""
+async def process_specific_message_async(client, desired_command):
+    """Event loop version of `process_specific_message`"""
+
+    message = await client.read()
+    if message is None:
+        print("The client disconnected.")
+        return None
+
+    command, args = message.command, message.args
+    if command == QUIT_COMMAND:
+        return None
+
+    if command != desired_command:
+        print("An error occurred.")
+        return None
+
+    return args
+
+
+async def login_async(client):
+    """Event loop version of `login`: login the user and return the username"""
 
-    username = login(lock, client)
-    if not username:
-        quit(lock, client, username, address)
+    message = await client.read()
+    if message is None:
+        return None
+    command, args = message.command, message.args
+    if command != LOGIN_COMMAND:
+        return None
+
+    username = args[0]
+    seq = None
+    if username in accounts:
+        # If the username exists, ask for password and check it against the stored password hash
+        send_message(client, LOGIN_COMMAND, "exists")
+        response = await process_specific_message_async(client, LOGIN_COMMAND)
+        if response is None:
+            return None
+
+        # Add the client to the connected clients list once the password matches
+        while not connect_client(username, client, response[0]):
+            send_message(client, LOGIN_COMMAND, "error")
+            response = await process_specific_message_async(client, LOGIN_COMMAND)
+            if response is None:
+                return None
+    else:
+        # Register the account, unless another client beat us to it with a different password
+        send_message(client, LOGIN_COMMAND, "new")
+        response = await process_specific_message_async(client, LOGIN_COMMAND)
+        if response is None:
+            return None
+        created, seq = create_account(username, response[0], client)
+        if not created and not connect_client(username, client, response[0]):
+            send_message(client, LOGIN_COMMAND, "error")
+            return None
+
+    send_message_when_durable(client, seq, LOGIN_COMMAND, "success")
+    print(f"{username} has joined the chat!")
+
+    return username
+
+
+async def handle_async_client(reader, writer):
+    """Handle one client connection on the event loop"""
+
+    client = AsyncClientConnection(reader, writer)
+    address = writer.get_extra_info('peername')
+    print(f"Accepted connection from {address}.")
+    client_locks[client] = Lock()
+    client_outboxes[client] = AsyncOutbox(writer, spill=spill_to_offline_queue)
+
+    username = None
+    try:
+        username = await login_async(client)
+        if not username:
+            return
+
+        # Send all messages that are queued immediately to client.
+        await flush_unsent_messages_async(client, username)
+        start_refills(client, username)
+
+        while True:
+            message = await client.read()
+            if message is None or not await dispatch_frame_async(client, username, message):
+                break
+    except Exception as e:
+        # A malformed request ends this connection; log it rather than letting it escape the task
+        print(f"Error handling connection from {address}: {e!r}")
+    finally:
+        quit(client, username, address)
+
+
+def raise_open_file_limit():
+    """Raise the soft file descriptor limit to the hard limit so one process can hold many sockets"""
+
+    try:
+        import resource
+    except ImportError:
         return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
 
-    # Send all messages that are queued immediately to client.
-    unsent_messages = unsent_message_queue[username]
-    while unsent_messages:
-        deliver_unsent_message(client, unsent_messages.pop(0))
 
-    while True:
-        message = process_message(client)
-        if message is None:
-            quit(lock, client, username, address)
-            break
-        command, args = message
-
-        if command == VIEW_USERS_COMMAND:
-            # List other active users based on wildcard query provided (if any)
-            list_users(client, username, args[0])
-        elif command == SEND_MESSAGE_COMMAND:
-            # Deliver message to user IF the recipient is logged in; otherwise, queue it.
-            deliver_new_message(lock, client, *args)
-        elif command == CHECK_ACCOUNT_COMMAND:
-            # Returns to client whether an account is a registered account.
-            send_message(client, CHECK_ACCOUNT_COMMAND, str(args[0] in accounts))
-        elif command == MULTIPLE_LOGIN_COMMAND:
-            # Returns to client whether a user is currently logged in on multiple devices
-            send_message(client, MULTIPLE_LOGIN_COMMAND, str(len(connected_clients[username]) > 1))
-        elif command == LOGOUT_COMMAND:
-            # Logs out all instances of `username` aside from the one using socket `client`
-            with user_locks[username]:
-                for c in connected_clients[username].copy():
-                    if c != client:
-                        send_message(c, QUIT_COMMAND)
-            send_message(client, LOGOUT_COMMAND, 'success')
-        elif command == DELETE_ACCOUNT_COMMAND:
-            # Delete account if password is correct
-            if args[0] == accounts[username]:
-                delete_account(client, username)
-            else:
-                send_message(client, DELETE_ACCOUNT_COMMAND, 'error')
-        elif command == QUIT_COMMAND:
-            quit(lock, client, username, address)
-            break
+async def serve_async(host, port):
+    """Accept and serve every client connection from a single event loop thread"""
 
+    server = await asyncio.start_server(
+        handle_async_client,
+        host, port, backlog=LISTEN_BACKLOG)
+    print(f"Server started on host {host} and port {port}. The clients will need this information to connect to the server.")
+
+    async with server:
+        await server.serve_forever()
 
-def start_server():
-    """Start the server"""
 
-    host = socket.gethostbyname(socket.gethostname())
-    port = PORT_NUMBER
+def start_threaded_server(host, port):
+    """Accept client connections and serve each one from its own thread"""
 
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     server.bind((host, port))
-    server.listen()
+    server.listen(LISTEN_BACKLOG)
     print(f"Server started on host {host} and port {port}. The clients will need this information to connect to the server.")
 
-    # Create global lock
-    global_lock = Lock()
-
     while True:
         client, address = server.accept()
         print(f"Accepted connection from {address}.")
 
-        # Create client lock
+        # Create client lock, frame reader and outbox
         client_locks[client] = Lock()
+        client_readers[client] = FrameReader(client, codec)
+        client_outboxes[client] = ThreadedOutbox(client, spill=spill_to_offline_queue)
 
         # Start client thread
         client_thread = threading.Thread(
-            target=handle_client, args=(global_lock, client, address))
+            target=handle_client, args=(client, address))
         client_thread.start()
 
 
+def admin_routes():
+    """Return the admin server's routes"""
+
+    return {
+        '/metrics': lambda query: ('text/plain; version=0.0.4; charset=utf-8', metrics.render()),
+        '/profile': profile_route,
+        '/tracemalloc': tracemalloc_route,
+    }
+
+
+def profile_route(query):
+    """Profile for `seconds` and answer with the collapsed stacks, or with the path of a `format=pstats` file"""
+
+    format = query.get('format', 'collapsed')
+    path = diagnostics.profile(float(query.get('seconds', PROFILE_SECONDS)), format)
+    if format == 'pstats':
+        return 'text/plain; charset=utf-8', f"Wrote profile to {path}.\n"
+    with open(path) as f:
+        return 'text/plain; charset=utf-8', f.read()
+
+
+def tracemalloc_route(query):
+    """Trace allocations for `seconds` and answer with the report"""
+
+    path = diagnostics.trace_allocations(float(query.get('seconds', PROFILE_SECONDS)))
+    with open(path) as f:
+        return 'text/plain; charset=utf-8', f.read()
+
+
+def start_retention(interval=RETENTION_INTERVAL):
+    """Expire messages past the retention limits from a background thread, if any limit is set"""
+
+    global retention
+
+    retention = Retention(messages, conversation_locks, interval=interval)
+    if retention.enabled():
+        retention.start()
+
+
+def start_spilling(data_directory):
+    """Let offline queues spill to `OFFLINE_SPILL_DIRECTORY`, else to the data directory, else to a temporary directory"""
+
+    global spill_directory
+
+    directory = OFFLINE_SPILL_DIRECTORY
+    if directory is None and data_directory:
+        directory = os.path.join(data_directory, 'offline')
+    if directory is None:
+        spill_directory = tempfile.TemporaryDirectory(prefix='chat-offline-')
+        directory = spill_directory.name
+    unsent_message_queue.spill_to(directory)
+
+
+def start_server(engine=SERVER_ENGINE, host=None, port=PORT_NUMBER, data_directory=DATA_DIRECTORY, fsync_policy=WAL_FSYNC_POLICY, admin_port=ADMIN_PORT):
+    """Start the server using the 'asyncio' (single event loop thread) or 'threaded' (thread per connection) engine"""
+
+    if host is None:
+        host = socket.gethostbyname(socket.gethostname())
+
+    if OFFLINE_QUEUE_OVERFLOW not in OFFLINE_OVERFLOW_POLICIES:
+        raise ValueError(f"Unknown offline queue overflow policy {OFFLINE_QUEUE_OVERFLOW!r}; expected one of {OFFLINE_OVERFLOW_POLICIES}.")
+
+    if admin_port:
+        start_admin_server(admin_routes(), port=admin_port)
+    diagnostics.install_signal_handlers()
+
+    # Before the log is replayed, so that rebuilding long queues doesn't fill memory
+    start_spilling(data_directory)
+    if data_directory:
+        open_log(data_directory, fsync_policy)
+        start_snapshots()
+    start_retention()
+    presence.start()
+
+    if engine == 'asyncio':
+        raise_open_file_limit()
+        asyncio.run(serve_async(host, port))
+    elif engine == 'threaded':
+        start_threaded_server(host, port)
+    else:
+        raise ValueError(f"Unknown server engine {engine!r}; expected 'asyncio' or 'threaded'.")
+
+
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Start the chat server.")
+    parser.add_argument('--engine', choices=['asyncio', 'threaded'], default=SERVER_ENGINE,
+                        help="how client connections are served")
+    parser.add_argument('--host', help="address to bind to (defaults to this machine's IP address)")
+    parser.add_argument('--port', type=int, default=PORT_NUMBER, help="port to listen on")
+    parser.add_argument('--data', default=DATA_DIRECTORY,
+                        help="directory holding the write-ahead log and snapshots ('' to disable persistence)")
+    parser.add_argument('--fsync', choices=['always', 'interval', 'os'], default=WAL_FSYNC_POLICY,
+                        help="when write-ahead log records are fsynced")
+    parser.add_argument('--admin-port', type=int, default=ADMIN_PORT,
+                        help="local port serving metrics and other admin endpoints (0 to disable)")
+    arguments = parser.parse_args()
+    start_server(arguments.engine, arguments.host, arguments.port, arguments.data, arguments.fsync, arguments.admin_port)
@@ -1,45 +1,171 @@
 from config import *
 import server
-from server import list_users, deliver_new_message, UserMessage
+from server import list_users, deliver_new_message, dispatch_frame, flush_unsent_messages, UserMessage
+from protocol import Frame, PaddedCodec
+from user_directory import UserDirectory
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from threading import Lock
 from datetime import datetime
+import asyncio
 
 class TestServerMethods(unittest.TestCase):
     mock_socket = MagicMock()
     server.client_locks[mock_socket] = Lock()
 
     def test_List_users_No_other_users_Returns_none(self):
-        server.connected_clients = {'user': None}
+        server.connected_clients = UserDirectory(None, {'user': None})
         self.assertIsNone(list_users(self.__class__.mock_socket, 'user', '*'))
 
     def test_List_users_Has_other_users_no_query_provided_Returns_all_other_users(self):
-        server.connected_clients = {'user1': None, 'user2': None}
+        server.connected_clients = UserDirectory(None, {'user1': None, 'user2': None})
         self.assertEqual(list_users(self.__class__.mock_socket, 'user1', '*'), ['user2'])
 
     def test_List_users_Has_other_users_query_matches_exists_Returns_matches(self):
-        server.connected_clients = {'user1': None, 'user2': None}
+        server.connected_clients = UserDirectory(None, {'user1': None, 'user2': None})
         self.assertEqual(list_users(self.__class__.mock_socket, 'user1', 'us*'), ['user2'])
 
     def test_List_users_Has_other_users_query_matches_exists_Returns_matches2(self):
-        server.connected_clients = {'user1': None, 'user2': None}
+        server.connected_clients = UserDirectory(None, {'user1': None, 'user2': None})
         self.assertEqual(list_users(self.__class__.mock_socket, 'user2', 'u?e?1'), ['user1'])
 
     def test_List_users_Has_other_users_no_query_matches_Returns_none(self):
-        server.connected_clients = {'user1': None, 'user2': None}
+        server.connected_clients = UserDirectory(None, {'user1': None, 'user2': None})
         self.assertIsNone(list_users(self.__class__.mock_socket, 'user1', 'p'))
 
     def test_List_users_Has_other_users_no_query_matches_Returns_none2(self):
-        server.connected_clients = {'user1': None, 'user2': None}
+        server.connected_clients = UserDirectory(None, {'user1': None, 'user2': None})
         self.assertIsNone(list_users(self.__class__.mock_socket, 'user1', 'u_s'))
 
+    def test_List_users_With_limit_Cursor_pages_through_all_other_users(self):
+        server.connected_clients = UserDirectory(None, {f'user{i}': None for i in range(10)})
+        pages, cursor = [], ''
+        while True:
+            self.__class__.mock_socket.reset_mock()
+            list_users(self.__class__.mock_socket, 'user4', 'user*', 3, cursor)
+            frame, = server.codec.decoder().feed(self.__class__.mock_socket.sendall.call_args[0][0])
+            cursor, *names = frame.args
+            pages.append(names)
+            if not cursor:
+                break
+        self.assertEqual(pages, [['user0', 'user1', 'user2'], ['user3', 'user5', 'user6'], ['user7', 'user8', 'user9']])
+
+    def test_List_users_Streamed_Splits_frames_within_bufsize_and_ends_with_marker(self):
+        names = [f'someone{i:04d}' for i in range(500)]
+        server.connected_clients = UserDirectory(None, dict.fromkeys(names))
+        with patch.object(server, 'codec', PaddedCodec()):
+            self.__class__.mock_socket.reset_mock()
+            list_users(self.__class__.mock_socket, 'me', '*', 0, '')
+            sent = [c[0][0] for c in self.__class__.mock_socket.sendall.call_args_list]
+            frames = server.codec.decoder().feed(b''.join(sent))
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(all(len(data) == BUFSIZE for data in sent))
+        self.assertEqual([f.args[0] for f in frames], [f.args[-1] for f in frames[:-1]] + [''])
+        self.assertEqual([name for f in frames for name in f.args[1:]], names)
+
     def test_Deliver_new_message_Happy_case_Returns_packaged_message(self):
         user1, user2 = 'a', 'b'
-        server.user_locks['b'] = Lock()
         now = str(datetime.now().strftime(TIME_FORMAT))
-        packed_msg = deliver_new_message(Lock(), self.__class__.mock_socket, user1, user2, 'hi', now)
+        packed_msg = deliver_new_message(self.__class__.mock_socket, user1, user2, 'hi', now)
         self.assertEqual(UserMessage(user1, user2, 'hi', now), packed_msg)
 
+    def test_Dispatch_frame_Request_id_Is_echoed_on_response(self):
+        server.accounts['a'] = 'hash'
+        self.__class__.mock_socket.reset_mock()
+        dispatch_frame(self.__class__.mock_socket, 'a', Frame(CHECK_ACCOUNT_COMMAND, ['a'], 41))
+        frame = self.__class__.mock_socket.sendall.call_args[0][0]
+        self.assertEqual(server.codec.decoder().feed(frame), [Frame(CHECK_ACCOUNT_COMMAND, ['True'], 41)])
+
+    def test_Dispatch_frame_History_Pages_newest_first_until_empty_cursor(self):
+        for i in range(5):
+            deliver_new_message(self.__class__.mock_socket, 'h1', 'h2', str(i), f'2023-03-01 10:0{i}')
+        pages, cursor = [], ''
+        while True:
+            self.__class__.mock_socket.reset_mock()
+            dispatch_frame(self.__class__.mock_socket, 'h2', Frame(HISTORY_COMMAND, ['h1', '', '', '2', cursor]))
+            frame, = server.codec.decoder().feed(self.__class__.mock_socket.sendall.call_args[0][0])
+            cursor = frame.args[0]
+            pages.append(frame.args[3::4])
+            if not cursor:
+                break
+        self.assertEqual(pages, [['4', '3'], ['2', '1'], ['0']])
+
+    def test_Dispatch_frame_History_Bad_time_bound_Replies_error(self):
+        self.__class__.mock_socket.reset_mock()
+        dispatch_frame(self.__class__.mock_socket, 'h2', Frame(HISTORY_COMMAND, ['h1', 'yesterday']))
+        frame, = server.codec.decoder().feed(self.__class__.mock_socket.sendall.call_args[0][0])
+        self.assertEqual(frame.args, ['error'])
+
+    def test_Flush_unsent_messages_Many_queued_Sends_ordered_chunks_and_empties_queue(self):
+        queued = [UserMessage('a', 'c', str(i), 'now') for i in range(OFFLINE_FLUSH_CHUNK * 2 + 1)]
+        server.unsent_message_queue['c'].extend(queued)
+        self.__class__.mock_socket.reset_mock()
+        flush_unsent_messages(self.__class__.mock_socket, 'c')
+        frames = server.codec.decoder().feed(b''.join(c[0][0] for c in self.__class__.mock_socket.sendall.call_args_list))
+        self.assertEqual([len(f.args) // 4 for f in frames], [OFFLINE_FLUSH_CHUNK, OFFLINE_FLUSH_CHUNK, 1])
+        self.assertEqual([arg for f in frames for arg in f.args[2::4]], [m.message for m in queued])
+        self.assertFalse(server.unsent_message_queue['c'])
+
+    def test_Flush_unsent_messages_Large_messages_Split_to_fit_frames_without_loss(self):
+        queued = [UserMessage('a', 'c', str(i) * 10000, 'now') for i in range(10)] * 20
+        server.unsent_message_queue['c'].extend(queued)
+        self.__class__.mock_socket.reset_mock()
+        flush_unsent_messages(self.__class__.mock_socket, 'c')
+        frames = server.codec.decoder().feed(b''.join(c[0][0] for c in self.__class__.mock_socket.sendall.call_args_list))
+        self.assertLess(len(frames[0].args) // 4, OFFLINE_FLUSH_CHUNK)
+        self.assertEqual([arg for f in frames for arg in f.args[2::4]], [m.message for m in queued])
+        self.assertFalse(server.unsent_message_queue['c'])
+
+    def test_Deliver_new_message_Full_queue_drop_oldest_Keeps_newest(self):
+        server.unsent_message_queue.pop('q', None)
+        with patch.object(server, 'OFFLINE_QUEUE_LIMIT', 3):
+            for i in range(5):
+                deliver_new_message(self.__class__.mock_socket, 'p', 'q', str(i), 'now')
+        self.assertEqual([m.message for m in server.unsent_message_queue['q']], ['2', '3', '4'])
+
+    def test_Deliver_new_message_Full_queue_reject_Replies_error_and_keeps_queue(self):
+        server.unsent_message_queue.pop('q', None)
+        with patch.object(server, 'OFFLINE_QUEUE_LIMIT', 3), patch.object(server, 'OFFLINE_QUEUE_OVERFLOW', 'reject'):
+            for i in range(3):
+                deliver_new_message(self.__class__.mock_socket, 'p', 'q', str(i), 'now')
+            self.__class__.mock_socket.reset_mock()
+            self.assertIsNone(deliver_new_message(self.__class__.mock_socket, 'p', 'q', 'refused', 'now'))
+        frame, = server.codec.decoder().feed(self.__class__.mock_socket.sendall.call_args[0][0])
+        self.assertEqual(frame.args, ['error'])
+        self.assertEqual([m.message for m in server.unsent_message_queue['q']], ['0', '1', '2'])
+        self.assertNotIn('refused', [m.message for m in server.messages['p']['q']])
+
+class TestAsyncClientHandler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.saved = (server.accounts, server.connected_clients)
+        server.accounts = UserDirectory()
+        server.connected_clients = UserDirectory(set)
+        self.server = await asyncio.start_server(server.handle_async_client, '127.0.0.1', 0)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        server.accounts, server.connected_clients = self.saved
+
+    async def test_Handle_async_client_Malformed_request_Quits_connection(self):
+        connections = (len(server.client_locks), len(server.client_outboxes))
+        reader, writer = await asyncio.open_connection(*self.server.sockets[0].getsockname())
+        decoder = server.codec.decoder()
+        for args in (['bad'], ['hash']):
+            writer.write(server.codec.encode(LOGIN_COMMAND, *args))
+        replies = []
+        while len(replies) < 2:
+            replies += decoder.feed(await asyncio.wait_for(reader.read(4096), 5))
+        self.assertEqual([frame.args for frame in replies], [['new'], ['success']])
+        self.assertIn('bad', server.connected_clients)
+
+        # A SEND_MESSAGE without its recipient, text and time
+        writer.write(server.codec.encode(SEND_MESSAGE_COMMAND, 'bad'))
+        self.assertEqual(await asyncio.wait_for(reader.read(4096), 5), b'')
+        self.assertNotIn('bad', server.connected_clients)
+        self.assertEqual((len(server.client_locks), len(server.client_outboxes)), connections)
+        writer.close()
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+"""Point-in-time snapshots of server state, used to compact the write-ahead log.
+
+A snapshot numbered `n` holds the state produced by every log segment before `n`,
+so recovery loads the newest snapshot and replays only segments `n` and later.
+
+Snapshots are taken without pausing the server. The `Snapshotter` thread rotates
+the log to a new segment (a cheap file switch) and hands the closed segments to
+a child process. The child loads the previous snapshot, replays the closed
+segments onto it and writes the result as the new snapshot. It then deletes the
+segments and snapshots that the new one replaces. The server's live state is
+never read, and the work runs outside its process, so message handling does
+not compete with it for the GIL.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import pickle
+import threading
+from config import *
+from wal import SEGMENT_SUFFIX, numbered_files, segment_path
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+def snapshot_path(directory, segment):
+    """Return the path of the snapshot that covers every log segment before `segment`"""
+
+    return os.path.join(directory, f'{segment:010d}{SNAPSHOT_SUFFIX}')
+
+
+def write_snapshot(directory, segment, state):
+    """Atomically write `state` as the snapshot covering every log segment before `segment`"""
+
+    path = snapshot_path(directory, segment)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+    # Make the rename itself durable
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def load_latest_snapshot(directory, until=None):
+    """Return (segment, state) for the newest snapshot (covering no segment from `until` on); (0, None) if there is none"""
+
+    segments = [n for n in numbered_files(directory, SNAPSHOT_SUFFIX) if until is None or n <= until]
+    if not segments:
+        return 0, None
+    with open(snapshot_path(directory, segments[-1]), 'rb') as f:
+        return segments[-1], pickle.load(f)
+
+
+def remove_compacted_files(directory, segment):
+    """Delete the log segments and snapshots superseded by the snapshot for `segment`"""
+
+    for n in numbered_files(directory, SEGMENT_SUFFIX):
+        if n < segment:
+            os.remove(segment_path(directory, n))
+    for n in numbered_files(directory, SNAPSHOT_SUFFIX):
+        if n < segment:
+            os.remove(snapshot_path(directory, n))
+
+
+class Snapshotter:
+    """Background thread that snapshots the log once enough records have been written since the last snapshot.
+
+    `compact(directory, segment)` is run in a child process to build the snapshot
+    for `segment`, so it must be a picklable module-level function.
+    """
+
+    def __init__(self, log, compact, interval=SNAPSHOT_INTERVAL, min_records=SNAPSHOT_MIN_RECORDS):
+        self.log = log
+        self.compact = compact
+        self.interval = interval
+        self.min_records = min_records
+        self.snapshotted = 0  # Sequence number of the last record covered by a snapshot
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Check for new records every `interval` seconds, snapshotting when there are at least `min_records`"""
+
+        while not self.stopped.wait(self.interval):
+            if self.log.written - self.snapshotted >= self.min_records:
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    # The closed segments are still on disk, so the next snapshot picks them up
+                    print(f"Snapshot failed: {e!r}")
+
+    def snapshot(self):
+        """Rotate the log and wait for a child process to compact the closed segments into a snapshot"""
+
+        written = self.log.written
+        segment = self.log.rotate()
+        self.executor.submit(self.compact, self.log.directory, segment).result()
+        self.snapshotted = written
+        return segment
+
+    def close(self):
+        """Stop taking snapshots, waiting for one in progress to finish"""
+
+        self.stopped.set()
+        self.thread.join()
+        self.executor.shutdown()
@@ -0,0 +1,204 @@
+"""Username directory with an ordered index for wildcard queries.
+
+`UserDirectory` is a dict keyed by username that also keeps its keys in a chunked sorted
+list. A VIEW_USERS query is then answered in pages without scanning every user:
+
+- a query without wildcards is a dict lookup;
+- a prefix query such as `b*` is a range of the sorted list;
+- any other query is matched against the range of names sharing its literal
+  prefix (everything before the first wildcard), using a compiled pattern from a
+  bounded LRU cache.
+
+The range is walked lazily from a cursor, so a page costs only the names read to fill it.
+"""
+from bisect import bisect_left, insort
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import chain
+import fnmatch
+import re
+import threading
+from config import *
+
+WILDCARDS = '*?['
+
+# Target number of names per chunk of a SortedNames; a chunk is split when it doubles
+CHUNK_SIZE = 512
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def parse_query(query):
+    """Split a wildcard query into its literal prefix and the compiled pattern it must match (None if the prefix alone decides)"""
+
+    literal = min((query.index(c) for c in WILDCARDS if c in query), default=len(query))
+    prefix, rest = query[:literal], query[literal:]
+    if rest in ('', '*'):
+        return prefix, None
+    return prefix, re.compile(fnmatch.translate(query))
+
+
+def prefix_bounds(prefix):
+    """Return (low, high) such that exactly the names starting with `prefix` sort in [low, high).
+
+    `prefix` must be non-empty and not end in the largest code point.
+    """
+
+    # Every name starting with `prefix` sorts below the prefix with its last character incremented
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SortedNames:
+    """Sorted set of names stored as a list of sorted chunks, so an insert or removal moves at most a chunk's worth of entries"""
+
+    def __init__(self):
+        self.chunks = []  # Sorted lists of names, in order
+        self.maxes = []   # Last name in each chunk
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return chain.from_iterable(self.chunks)
+
+    def add(self, name):
+        """Insert `name`, which must not already be present"""
+
+        self.size += 1
+        if not self.chunks:
+            self.chunks.append([name])
+            self.maxes.append(name)
+            return
+        i = min(bisect_left(self.maxes, name), len(self.chunks) - 1)
+        chunk = self.chunks[i]
+        insort(chunk, name)
+        self.maxes[i] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self.chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self.maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def remove(self, name):
+        """Remove `name`, which must be present"""
+
+        self.size -= 1
+        i = bisect_left(self.maxes, name)
+        chunk = self.chunks[i]
+        del chunk[bisect_left(chunk, name)]
+        if chunk:
+            self.maxes[i] = chunk[-1]
+        else:
+            del self.chunks[i]
+            del self.maxes[i]
+
+    def clear(self):
+        self.chunks.clear()
+        self.maxes.clear()
+        self.size = 0
+
+    def chunks_between(self, low, high=None, lock=None):
+        """Lazily yield the names from `low` (inclusive) to `high` (exclusive; None for no upper bound) as sorted lists, in order.
+
+        `lock`, if given, is the lock that guards changes to the names; it is held only while a chunk is found and copied.
+        """
+
+        while True:
+            with lock or nullcontext():
+                # A concurrent removal may have emptied the last chunk since the previous one was copied
+                i = bisect_left(self.maxes, low)
+                if i >= len(self.chunks):
+                    return
+                # Copy one chunk at a time, so concurrent inserts and removals don't disturb iteration
+                chunk = self.chunks[i][:]
+            start = bisect_left(chunk, low)
+            if high is not None and chunk[-1] >= high:
+                yield chunk[start:bisect_left(chunk, high)]
+                return
+            yield chunk[start:]
+            # Resume after the last name seen, wherever it now lives
+            low = chunk[-1] + '\0'
+
+
+class UserDirectory(dict):
+    """Dict keyed by username whose keys are also kept sorted for range lookups.
+
+    Like a `defaultdict`, a missing key is created with `default_factory()` when
+    `default_factory` is given.
+    """
+
+    def __init__(self, default_factory=None, *args, **kwargs):
+        super().__init__()
+        self.default_factory = default_factory
+        self.names = SortedNames()
+        self.lock = threading.RLock()
+        self.update(*args, **kwargs)
+
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        with self.lock:
+            # Another thread may have created it first
+            if key not in self:
+                self[key] = self.default_factory()
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key not in self:
+                self.names.add(key)
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+            self.names.remove(key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self:
+                return super().pop(key, *default)
+            self.names.remove(key)
+            return super().pop(key)
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                self[key] = default
+            return super().__getitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+            self.names.clear()
+
+    def popitem(self):
+        with self.lock:
+            key, value = super().popitem()
+            self.names.remove(key)
+            return key, value
+
+    def __reduce__(self):
+        return type(self), (self.default_factory, dict(self))
+
+    def iter_match(self, query, after=None):
+        """Lazily yield the usernames matching wildcard `query` that sort after `after` (if given), in sorted order"""
+
+        prefix, pattern = parse_query(query)
+        # The smallest name sorting after `after` is `after` followed by the lowest code point
+        low = prefix if after is None else max(prefix, after + '\0')
+        if pattern is None and prefix == query:
+            if query in self and query >= low:
+                yield query
+            return
+        high = None
+        if prefix and prefix[-1] != chr(0x10ffff):
+            high = prefix_bounds(prefix)[1]
+        elif pattern is None:
+            # A prefix ending in the largest code point has no upper bound, so its names are matched instead
+            pattern = re.compile(fnmatch.translate(query))
+        for chunk in self.names.chunks_between(low, high, self.lock):
+            # Filtering a whole chunk at once keeps the per-name work out of Python bytecode
+            yield from chunk if pattern is None else filter(pattern.match, chunk)
@@ -0,0 +1,85 @@
+from user_directory import UserDirectory, parse_query
+import fnmatch
+import random
+import re
+import threading
+import unittest
+
+
+class TestUserDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = UserDirectory(None, {name: None for name in ('bob', 'bobby', 'alice', 'carol', 'bo')})
+
+    def test_Iter_match_Star_Returns_all_sorted(self):
+        self.assertEqual(list(self.directory.iter_match('*')), ['alice', 'bo', 'bob', 'bobby', 'carol'])
+
+    def test_Iter_match_Prefix_query_Returns_range(self):
+        self.assertEqual(list(self.directory.iter_match('bob*')), ['bob', 'bobby'])
+        self.assertEqual(list(self.directory.iter_match('d*')), [])
+
+    def test_Iter_match_Exact_query_Returns_only_that_name(self):
+        self.assertEqual(list(self.directory.iter_match('bob')), ['bob'])
+        self.assertEqual(list(self.directory.iter_match('dave')), [])
+
+    def test_Iter_match_After_deletes_Index_follows_dict(self):
+        del self.directory['bob']
+        self.directory.pop('carol')
+        self.directory['bz'] = None
+        self.assertEqual(list(self.directory.iter_match('b*')), ['bo', 'bobby', 'bz'])
+        self.assertEqual(list(self.directory.names), sorted(self.directory))
+
+    def test_Popitem_Removes_name_from_index(self):
+        key, _ = self.directory.popitem()
+        self.assertNotIn(key, list(self.directory.iter_match('*')))
+        self.assertEqual(list(self.directory.names), sorted(self.directory))
+
+    def test_Iter_match_After_cursor_Resumes_in_order(self):
+        self.assertEqual(list(self.directory.iter_match('*', 'bob')), ['bobby', 'carol'])
+        self.assertEqual(list(self.directory.iter_match('bo*', 'bo')), ['bob', 'bobby'])
+        self.assertEqual(list(self.directory.iter_match('?o*', 'bob')), ['bobby'])
+        self.assertEqual(list(self.directory.iter_match('bob', 'bob')), [])
+
+    def test_Missing_key_With_default_factory_Creates_entry(self):
+        directory = UserDirectory(set)
+        directory['a'].add(1)
+        self.assertEqual(list(directory.iter_match('*')), ['a'])
+        self.assertEqual(directory['a'], {1})
+
+    def test_Iter_match_Random_queries_Agree_with_fnmatch_scan(self):
+        rng = random.Random(7)
+        names = {''.join(rng.choice('abc[') for _ in range(rng.randint(1, 5))) for _ in range(300)}
+        directory = UserDirectory(None, dict.fromkeys(names))
+        for query in ('a*', 'ab?', '*c', 'a*b*', '[ab]c*', 'b[c]*', 'c', '[a', 'a[*', '?', ''):
+            pattern = re.compile(fnmatch.translate(query))
+            self.assertEqual(list(directory.iter_match(query)), sorted(filter(pattern.match, names)), query)
+
+    def test_Sorted_names_Many_inserts_and_removals_Stay_sorted_across_chunks(self):
+        rng = random.Random(3)
+        names = [f'user{i}' for i in range(5000)]
+        rng.shuffle(names)
+        directory = UserDirectory(None, dict.fromkeys(names))
+        for name in names[:2500]:
+            del directory[name]
+        self.assertGreater(len(directory.names.chunks), 1)
+        self.assertEqual(list(directory.names), sorted(names[2500:]))
+        self.assertEqual(list(directory.iter_match('user12*')), sorted(n for n in names[2500:] if n.startswith('user12')))
+
+    def test_Iter_match_Concurrent_removals_Yields_remaining_names_in_order(self):
+        names = [f'user{i:05}' for i in range(20000)]
+        directory = UserDirectory(None, dict.fromkeys(names))
+        remover = threading.Thread(target=lambda: [directory.pop(name) for name in reversed(names)])
+        matched = []
+        for name in directory.iter_match('user*'):
+            if not matched:
+                remover.start()
+            matched.append(name)
+        remover.join()
+        self.assertEqual(matched, sorted(matched))
+        self.assertEqual(len(directory), 0)
+
+    def test_Parse_query_Repeated_query_Reuses_compiled_pattern(self):
+        self.assertIs(parse_query('x?z*')[1], parse_query('x?z*')[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+"""Write-ahead log for server state.
+
+Every change to accounts, message history and offline queues is appended to the
+log before it is acknowledged, and the server rebuilds its in-memory state from
+the log at startup. Each record is a CRC32 checksum followed by a frame in the
+framed wire format, whose command byte is the record type.
+
+How appended records reach the disk is set by `WAL_FSYNC_POLICY`:
+
+- 'always': a record is durable only once fsynced. A background syncer thread
+  fsyncs whatever has been appended since its last fsync, so concurrent writers
+  share each fsync (group commit).
+- 'interval': the syncer fsyncs every `WAL_FSYNC_INTERVAL` seconds and writers
+  never wait.
+- 'os': records are written to the OS page cache and never explicitly fsynced.
+"""
+from collections import deque
+import os
+import struct
+import threading
+import zlib
+from config import *
+from protocol import FramedCodec, ProtocolError
+
+FSYNC_POLICIES = ('always', 'interval', 'os')
+
+# Record types
+ACCOUNT_CREATED = 1  # [username, password_hash]
+ACCOUNT_DELETED = 2  # [username]
+MESSAGE_SENT = 3     # [sender, recipient, message, time, queued ('1' if it went to the offline queue)]
+MESSAGE_QUEUED = 4   # [sender, recipient, message, time]: put on the offline queue after a live delivery overflowed
+QUEUE_DRAINED = 5    # [recipient, count]: the `count` oldest queued messages were delivered
+GROUP_CREATED = 6    # [group, creator]
+GROUP_JOINED = 7     # [group, username]
+GROUP_LEFT = 8       # [group, username]
+GROUP_MESSAGE_QUEUED = 9  # [member, sender, group, message, time]: a group message put on a member's offline queue
+
+_CRC = struct.Struct('>I')
+_codec = FramedCodec()
+
+SEGMENT_SUFFIX = '.wal'
+
+
+def segment_path(directory, segment):
+    """Return the path of log segment number `segment` in `directory`"""
+
+    return os.path.join(directory, f'{segment:010d}{SEGMENT_SUFFIX}')
+
+
+def numbered_files(directory, suffix):
+    """Return the numbers of the files in `directory` named `<number><suffix>`, in ascending order"""
+
+    if not os.path.isdir(directory):
+        return []
+    numbers = []
+    for name in os.listdir(directory):
+        stem, found, rest = name.partition(suffix)
+        if found and not rest and stem.isdigit():
+            numbers.append(int(stem))
+    return sorted(numbers)
+
+
+def encode_record(record_type, *fields):
+    """Serialize a record as its checksum followed by a frame"""
+
+    frame = _codec.encode(record_type, *fields)
+    return _CRC.pack(zlib.crc32(frame)) + frame
+
+
+def decode_record(data, offset=0):
+    """Decode the record at `offset` in `data`, returning (record_type, fields, end offset), or None if it is torn or corrupt"""
+
+    header = _CRC.size + 4
+    if len(data) - offset < header:
+        return None
+    (checksum,) = _CRC.unpack_from(data, offset)
+    length = int.from_bytes(data[offset + _CRC.size:offset + header], 'big')
+    end = offset + header + length
+    if end > len(data):
+        return None
+    frame = data[offset + _CRC.size:end]
+    if zlib.crc32(frame) != checksum:
+        return None
+    try:
+        record_type, fields, _ = _codec.decode_payload(frame[4:])
+    except ProtocolError:
+        return None
+    return record_type, fields, end
+
+
+def read_log(path):
+    """Return every intact (record_type, fields) pair in the log at `path`.
+
+    A torn or corrupt record at the end of the file (e.g. from a crash mid-write) is
+    cut off, so later appends start from the last good record.
+    """
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    records = []
+    offset = 0
+    while True:
+        record = decode_record(data, offset)
+        if record is None:
+            break
+        record_type, fields, offset = record
+        records.append((record_type, fields))
+
+    if offset != len(data):
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+    return records
+
+
+class WriteAheadLog:
+    """Appends records to segment files in a directory and tracks which of them are durable.
+
+    Writing starts in a fresh segment numbered `segment` (by default one past any
+    segment already in the directory).
+    """
+
+    def __init__(self, directory, fsync_policy=WAL_FSYNC_POLICY, fsync_interval=WAL_FSYNC_INTERVAL, segment=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy!r}; expected one of {FSYNC_POLICIES}.")
+        os.makedirs(directory, exist_ok=True)
+        if segment is None:
+            segment = max(numbered_files(directory, SEGMENT_SUFFIX), default=0) + 1
+        self.directory = directory
+        self.segment = segment
+        self.path = segment_path(directory, segment)
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.file = open(self.path, 'ab', buffering=0)
+        self.condition = threading.Condition()
+        self.sync_lock = threading.Lock()  # Held while fsyncing, so a rotated-out file is not closed mid-fsync
+        self.written = 0        # Sequence number of the last record written
+        self.synced = 0         # Sequence number of the last record known to be durable
+        self.callbacks = deque()  # (sequence number, callback) pairs waiting to become durable
+        self.closed = False
+        self.thread = None
+        if fsync_policy != 'os':
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def append(self, record_type, *fields):
+        """Write a record and return its sequence number; it may not be durable yet"""
+
+        record = encode_record(record_type, *fields)
+        with self.condition:
+            self.file.write(record)
+            self.written += 1
+            if self.fsync_policy == 'os':
+                self.synced = self.written
+            elif self.fsync_policy == 'always':
+                self.condition.notify_all()
+            return self.written
+
+    def wait(self, seq):
+        """Block until record `seq` is durable under this log's fsync policy"""
+
+        with self.condition:
+            while self.synced < seq and not self.closed:
+                self.condition.wait()
+
+    def when_durable(self, seq, callback):
+        """Call `callback` once record `seq` is durable: right away if it already is, else from the syncer thread"""
+
+        with self.condition:
+            if self.synced < seq and not self.closed:
+                self.callbacks.append((seq, callback))
+                return
+        callback()
+
+    def run(self):
+        """Syncer thread: fsync newly written records and release everything waiting on them"""
+
+        while True:
+            with self.condition:
+                if self.fsync_policy == 'always':
+                    while self.synced == self.written and not self.closed:
+                        self.condition.wait()
+                elif not self.closed:
+                    self.condition.wait(self.fsync_interval)
+                if self.closed:
+                    break
+                target = self.written
+                file = self.file
+
+            if target > self.synced:
+                with self.sync_lock:
+                    # A file closed by `rotate` was fsynced there, records up to `target` included
+                    if not file.closed:
+                        os.fsync(file.fileno())
+            self.mark_synced(target)
+
+    def rotate(self):
+        """Continue logging in a new segment and return its number; every earlier segment is then complete and durable"""
+
+        with self.condition:
+            old_file = self.file
+            self.segment += 1
+            self.path = segment_path(self.directory, self.segment)
+            self.file = open(self.path, 'ab', buffering=0)
+            target = self.written
+
+        with self.sync_lock:
+            os.fsync(old_file.fileno())
+            old_file.close()
+        self.mark_synced(target)
+        return self.segment
+
+    def mark_synced(self, target):
+        """Record that everything up to `target` is durable and run the callbacks that were waiting on it"""
+
+        with self.condition:
+            self.synced = max(self.synced, target)
+            ready = []
+            while self.callbacks and self.callbacks[0][0] <= self.synced:
+                ready.append(self.callbacks.popleft()[1])
+            self.condition.notify_all()
+        for callback in ready:
+            try:
+                callback()
+            except Exception as e:
+                # A failed callback must not stop the syncer, or every later one would wait forever
+                print(f"Durability callback failed: {e!r}")
+
+    def close(self):
+        """Stop the syncer, fsync anything outstanding and close the file"""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        os.fsync(self.file.fileno())
+        self.mark_synced(self.written)
+        self.file.close()
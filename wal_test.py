@@ -0,0 +1,219 @@
+from config import *
+import server
+from snapshot import Snapshotter, SNAPSHOT_SUFFIX
+from groups import Groups
+from history import MessageHistory, UserMessage
+from offline_queue import OfflineQueues
+from user_directory import UserDirectory
+from wal import WriteAheadLog, read_log, encode_record, numbered_files, segment_path, MESSAGE_SENT, ACCOUNT_CREATED, QUEUE_DRAINED, SEGMENT_SUFFIX
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+from threading import Lock
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.wal')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_Read_log_Appended_records_Round_trip(self):
+        log = WriteAheadLog(self.directory.name, 'os')
+        log.append(ACCOUNT_CREATED, 'a', 'hash')
+        log.append(MESSAGE_SENT, 'a', 'b', 'hi|there', 'now', '1')
+        log.close()
+        self.assertEqual(read_log(log.path), [
+            (ACCOUNT_CREATED, ['a', 'hash']),
+            (MESSAGE_SENT, ['a', 'b', 'hi|there', 'now', '1'])
+        ])
+
+    def test_Read_log_Torn_tail_Is_truncated(self):
+        with open(self.path, 'wb') as f:
+            f.write(encode_record(ACCOUNT_CREATED, 'a', 'hash'))
+            f.write(encode_record(ACCOUNT_CREATED, 'b', 'hash')[:-3])
+        self.assertEqual(read_log(self.path), [(ACCOUNT_CREATED, ['a', 'hash'])])
+        self.assertEqual(os.path.getsize(self.path), len(encode_record(ACCOUNT_CREATED, 'a', 'hash')))
+
+    def test_Read_log_Corrupt_record_Stops_replay(self):
+        record = bytearray(encode_record(ACCOUNT_CREATED, 'b', 'hash'))
+        record[-1] ^= 0xff
+        with open(self.path, 'wb') as f:
+            f.write(encode_record(ACCOUNT_CREATED, 'a', 'hash') + bytes(record))
+        self.assertEqual(read_log(self.path), [(ACCOUNT_CREATED, ['a', 'hash'])])
+
+    def test_Always_policy_Concurrent_writers_Share_fsyncs(self):
+        log = WriteAheadLog(self.directory.name, 'always')
+        real_fsync = os.fsync
+        fsyncs = []
+
+        def counting_fsync(fd):
+            fsyncs.append(fd)
+            real_fsync(fd)
+
+        def writer():
+            for i in range(50):
+                log.wait(log.append(MESSAGE_SENT, 'a', 'b', str(i), 'now', '0'))
+
+        with patch('wal.os.fsync', counting_fsync):
+            threads = [threading.Thread(target=writer) for _ in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(log.synced, 1000)
+        self.assertLess(len(fsyncs), 1000)
+        log.close()
+
+    def test_Rotate_Continues_in_new_segment(self):
+        log = WriteAheadLog(self.directory.name, 'always')
+        first = log.segment
+        log.append(ACCOUNT_CREATED, 'a', 'hash')
+        second = log.rotate()
+        self.assertEqual(log.synced, 1)
+        log.wait(log.append(ACCOUNT_CREATED, 'b', 'hash'))
+        log.close()
+        self.assertEqual(numbered_files(self.directory.name, SEGMENT_SUFFIX), [first, second])
+        self.assertEqual(read_log(segment_path(self.directory.name, first)), [(ACCOUNT_CREATED, ['a', 'hash'])])
+        self.assertEqual(read_log(segment_path(self.directory.name, second)), [(ACCOUNT_CREATED, ['b', 'hash'])])
+
+    def test_When_durable_Always_policy_Calls_back_after_sync(self):
+        log = WriteAheadLog(self.directory.name, 'always')
+        done = threading.Event()
+        log.when_durable(log.append(ACCOUNT_CREATED, 'a', 'hash'), done.set)
+        self.assertTrue(done.wait(5))
+        log.close()
+
+
+class TestServerRecovery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'data')
+        self.saved = (server.accounts, server.messages, server.unsent_message_queue, server.connected_clients, server.groups, server.wal)
+        self.reset_state()
+
+    def tearDown(self):
+        server.wal.close()
+        server.accounts, server.messages, server.unsent_message_queue, server.connected_clients, server.groups, server.wal = self.saved
+        self.directory.cleanup()
+
+    def reset_state(self):
+        server.accounts = UserDirectory()
+        server.messages = MessageHistory()
+        server.unsent_message_queue = OfflineQueues()
+        server.connected_clients = UserDirectory(set)
+        server.groups = Groups()
+
+    def test_Open_log_After_restart_Rebuilds_accounts_history_and_queues(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        server.open_log(self.path, 'always')
+        for username in ('x', 'y'):
+            server.accounts[username] = 'hash'
+            server.log_record(ACCOUNT_CREATED, username, 'hash')
+        for i in range(5):
+            server.deliver_new_message(client, 'x', 'y', str(i), 'now')
+        server.flush_unsent_messages(client, 'y')
+        server.deliver_new_message(client, 'y', 'x', 'late', 'now')
+        server.wal.close()
+        before = (dict(server.accounts), list(server.messages['x']['y']), list(server.unsent_message_queue['x']))
+
+        self.reset_state()
+        server.open_log(self.path, 'always')
+        after = (dict(server.accounts), list(server.messages['x']['y']), list(server.unsent_message_queue['x']))
+        self.assertEqual(before, after)
+        self.assertFalse(server.unsent_message_queue['y'])
+        del server.client_locks[client]
+
+    def test_Open_log_After_restart_Rebuilds_groups_and_queued_group_messages(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        server.open_log(self.path, 'always')
+        server.change_group_membership(client, 'x', CREATE_GROUP_COMMAND, 'team')
+        for username in ('y', 'z', 'gone'):
+            server.change_group_membership(client, username, JOIN_GROUP_COMMAND, 'team')
+        server.change_group_membership(client, 'gone', LEAVE_GROUP_COMMAND, 'team')
+        server.send_group_message(client, 'x', 'team', 'hello', 'now')
+        server.flush_unsent_messages(client, 'z')
+        server.wal.close()
+
+        for restart in ('log', 'snapshot'):
+            if restart == 'snapshot':
+                state = server.capture_state()
+                self.reset_state()
+                server.restore_state(state)
+            else:
+                self.reset_state()
+                server.open_log(self.path, 'always')
+            self.assertEqual(server.groups.export(), {'team': ['x', 'y', 'z']})
+            self.assertEqual(list(server.unsent_message_queue['y']), [UserMessage('x', 'team', 'hello', 'now')])
+            self.assertFalse(server.unsent_message_queue['z'])
+        del server.client_locks[client]
+
+    def test_Open_log_Offline_queue_limit_Replays_evictions(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        server.open_log(self.path, 'always')
+        with patch.object(server, 'OFFLINE_QUEUE_LIMIT', 2):
+            for i in range(5):
+                server.deliver_new_message(client, 'x', 'y', str(i), 'now')
+        server.wal.close()
+
+        self.reset_state()
+        server.open_log(self.path, 'always')
+        self.assertEqual([m.message for m in server.unsent_message_queue['y']], ['3', '4'])
+        self.assertEqual(len(server.messages['x']['y']), 5)
+        del server.client_locks[client]
+
+    def test_Snapshot_Truncates_log_and_restart_loads_snapshot_plus_tail(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        server.open_log(self.path, 'always')
+        for username in ('x', 'y'):
+            server.accounts[username] = 'hash'
+            server.log_record(ACCOUNT_CREATED, username, 'hash')
+        for i in range(5):
+            server.deliver_new_message(client, 'x', 'y', str(i), 'now')
+
+        snapshotter = Snapshotter(server.wal, server.compact_log, interval=3600)
+        segment = snapshotter.snapshot()
+        snapshotter.close()
+        self.assertEqual(numbered_files(self.path, SEGMENT_SUFFIX), [segment])
+        self.assertEqual(numbered_files(self.path, SNAPSHOT_SUFFIX), [segment])
+
+        server.take_unsent_messages('y', 2)
+        server.log_record(QUEUE_DRAINED, 'y', '2')
+        server.deliver_new_message(client, 'y', 'x', 'late', 'now')
+        server.wal.close()
+        before = (dict(server.accounts), list(server.messages['x']['y']), list(server.unsent_message_queue['y']))
+
+        self.reset_state()
+        server.open_log(self.path, 'always')
+        after = (dict(server.accounts), list(server.messages['x']['y']), list(server.unsent_message_queue['y']))
+        self.assertEqual(before, after)
+        self.assertEqual([m.message for m in server.unsent_message_queue['x']], ['late'])
+        del server.client_locks[client]
+
+    def test_Send_when_durable_Client_quits_before_sync_Syncer_keeps_running(self):
+        client = MagicMock()
+        server.client_locks[client] = Lock()
+        server.open_log(self.path, 'always')
+        # Hold up the fsync so the client is gone by the time its acknowledgement is due
+        with server.wal.sync_lock:
+            seq = server.log_record(ACCOUNT_CREATED, 'x', 'hash')
+            server.send_message_when_durable(client, seq, LOGIN_COMMAND, 'success')
+            server.quit(client, None, 'address')
+        server.wal.wait(seq)
+        client.sendall.assert_not_called()
+
+        done = threading.Event()
+        server.wal.when_durable(server.log_record(ACCOUNT_CREATED, 'y', 'hash'), done.set)
+        self.assertTrue(done.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()